@@ -0,0 +1,55 @@
+'''
+Epochs/sec of CentralizedTrainer.train_one_epoch with a torch DataLoader vs. TensorBatchLoader.
+
+Uses synthetic WISDM-shaped windows, so no fold files are needed:
+
+    python benchmark_batching.py --samples 5460 --epochs 5
+'''
+
+import argparse
+import logging
+import time
+
+import torch
+import torch.utils.data as data
+
+from centralized_trainer import CentralizedTrainer
+from data_loader import TensorBatchLoader
+from main import SimpleMLP
+
+
+def epochs_per_sec(loader, args, epochs):
+    torch.manual_seed(0)
+    dataset = [len(loader.dataset), 0, loader, loader, {}, {}, {}, 6]
+    trainer = CentralizedTrainer(dataset, SimpleMLP(), torch.device("cpu"), args)
+    trainer.train_one_epoch(0)  # warm-up
+    start = time.perf_counter()
+    for epoch in range(epochs):
+        trainer.train_one_epoch(epoch)
+    return epochs / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=5460, help='training windows (fold train size)')
+    parser.add_argument('--epochs', type=int, default=5, help='timed epochs per configuration')
+    parser.add_argument('--batch_sizes', type=str, default='32,64,128,300,1024,0',
+                        help='comma separated; 0 means the full dataset')
+    args = parser.parse_args()
+    args.client_optimizer, args.lr, args.wd = "sgd", 0.1, 0.001
+    logging.disable(logging.INFO)
+
+    x = torch.randn(args.samples, 30, 3)
+    y = torch.randint(0, 6, (args.samples,))
+    ds = data.TensorDataset(x, y)
+
+    print("%10s %18s %18s %8s" % ("batch", "DataLoader ep/s", "TensorBatch ep/s", "speedup"))
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        batch_size = batch_size or args.samples
+        before = epochs_per_sec(data.DataLoader(ds, batch_size=batch_size, shuffle=True), args, args.epochs)
+        after = epochs_per_sec(TensorBatchLoader(ds, batch_size=batch_size, shuffle=True), args, args.epochs)
+        print("%10d %18.2f %18.2f %7.1fx" % (batch_size, before, after, after / before))
+
+
+if __name__ == "__main__":
+    main()
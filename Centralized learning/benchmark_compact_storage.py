@@ -0,0 +1,94 @@
+'''
+Memory and accuracy of float32, float16 and int16 window storage (main.py --storage).
+
+For every fold, loads the fold once per storage mode and reports the bytes of the
+windows in memory and of the fold cache on disk. It then trains the same SimpleMLP
+(same seed, same batches) for --epochs with CentralizedTrainer and reports the test
+accuracy. Without data/train/fold_N_train.json, the other folds' test windows stand
+in as the training set:
+
+    python benchmark_compact_storage.py --folds 1-5 --epochs 30
+'''
+
+import argparse
+import logging
+import os
+import random
+
+import numpy as np
+import torch
+
+from benchmark_data_parallel import stand_in_fold
+from centralized_trainer import CentralizedTrainer
+from data_loader import fold_cache_path, load_partition_data_fed_wisdm2011
+from main import create_model, parse_folds
+
+STORAGES = ["float32", "float16", "int16"]
+
+
+def run(args, fold_idx, storage):
+    """(window bytes in memory, fold cache bytes, max dequantization error, best and final test acc)."""
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    dataset = list(load_partition_data_fed_wisdm2011(batch_size=args.batch_size, fold_idx=fold_idx,
+                                                     storage=storage)[1:])
+    train, test = dataset[2].dataset, dataset[3].dataset
+    memory = sum(ds.tensors[0].nbytes for ds in (train, test))
+    disk = sum(os.path.getsize(fold_cache_path("data/%s/fold_%d_%s.json" % (split, fold_idx, split), storage))
+               for split in ("train", "test"))
+    error = max(float((ds.dequantize(ds.tensors[0]) - ref).abs().max())
+                for ds, ref in ((train, args.reference[0]), (test, args.reference[1])))
+
+    trainer_args = argparse.Namespace(epochs=args.epochs, lr=args.lr, wd=0.001, client_optimizer="sgd",
+                                      hidden_nodes=40, frequency_of_train_acc_report=args.epochs,
+                                      checkpoint_frequency=args.epochs)
+    trainer = CentralizedTrainer(dataset, create_model(trainer_args, "simple_mlp", 6), torch.device("cpu"),
+                                 trainer_args)
+    trainer.train()
+    return memory, disk, error, trainer.best_test_acc, trainer.final_test_acc
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folds', type=str, default='1-5', help='folds to compare, e.g. 1-5 or 1,3')
+    parser.add_argument('--epochs', type=int, default=30, help='training epochs per fold and storage')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--lr', type=float, default=0.1, help='learning rate')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {storage: [] for storage in STORAGES}
+    json_bytes = []
+    cwd = os.getcwd()
+    for fold_idx in parse_folds(args.folds):
+        workdir = cwd
+        if not os.path.exists(os.path.join(cwd, "data", "train", "fold_%d_train.json" % fold_idx)):
+            workdir = stand_in_fold(fold_idx)
+        os.chdir(workdir)
+        try:
+            reference = load_partition_data_fed_wisdm2011(fold_idx=fold_idx)
+            args.reference = [reference[i].dataset.tensors[0] for i in (3, 4)]
+            json_bytes.append(sum(os.path.getsize("data/%s/fold_%d_%s.json" % (split, fold_idx, split))
+                                  for split in ("train", "test")))
+            for storage in STORAGES:
+                results[storage].append(run(args, fold_idx, storage))
+        finally:
+            os.chdir(cwd)
+    if workdir != cwd:
+        print("no training folds in data/train; trained on the other folds' test windows")
+
+    print("%d folds, %d epochs, JSON fold files %.2f MB per fold" % (len(json_bytes), args.epochs,
+                                                                  np.mean(json_bytes) / 1e6))
+    print("%8s %12s %12s %10s %14s %18s %18s" % ("storage", "memory MB", "cache MB", "saved", "max abs err",
+                                                "best test acc", "final test acc"))
+    base = np.mean([r[0] for r in results["float32"]])
+    for storage in STORAGES:
+        memory, disk, error, best, final = (np.array(column) for column in zip(*results[storage]))
+        print("%8s %12.2f %12.2f %9.0f%% %14.2e %11.2f ± %4.2f %11.2f ± %4.2f" % (
+            storage, memory.mean() / 1e6, disk.mean() / 1e6, 100 * (1 - memory.mean() / base), error.max(),
+            best.mean(), best.std(), final.mean(), final.std()))
+
+
+if __name__ == "__main__":
+    main()
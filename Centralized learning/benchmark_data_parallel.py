@@ -0,0 +1,92 @@
+'''
+Epoch time of gloo data-parallel training (main.py --data_parallel 1) from 1 to N processes.
+
+Launches main.py with torchrun on this host once per --nprocs value, with the same
+global --batch_size, and reads the epoch events of rank 0's --metrics_path file. The
+first epoch is left out as warm-up. Without data/train/fold_N_train.json, the other
+folds' test windows stand in as the training set:
+
+    python benchmark_data_parallel.py --nprocs 1 2 4 8 --epochs 5 --batch_size 256
+'''
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def stand_in_fold(fold_idx):
+    """A working directory whose fold_idx trains on the test windows of the other folds."""
+    workdir = tempfile.mkdtemp()
+    x, y = [], []
+    for other in range(1, 6):
+        with open(os.path.join(HERE, "data", "test", "fold_%d_test.json" % other)) as f:
+            user = json.load(f)["user_data"]["merged_user"]
+        if other == fold_idx:
+            test = user
+        else:
+            x += user["x"]
+            y += user["y"]
+    for split, user in (("train", {"x": x, "y": y}), ("test", test)):
+        os.makedirs(os.path.join(workdir, "data", split))
+        with open(os.path.join(workdir, "data", split, "fold_%d_%s.json" % (fold_idx, split)), "w") as f:
+            json.dump({"users": ["merged_user"], "user_data": {"merged_user": user},
+                       "num_samples": {"merged_user": len(user["y"])}}, f)
+    return workdir
+
+
+def run(args, workdir, nproc):
+    """(mean epoch seconds, samples/s, final test accuracy) of one torchrun launch."""
+    metrics_path = os.path.join(workdir, "ddp_metrics_%d.jsonl" % nproc)
+    command = [sys.executable, "-m", "torch.distributed.run", "--standalone", "--nproc_per_node", str(nproc),
+               os.path.join(HERE, "main.py"), "--data_parallel", "1", "--fold_idx", str(args.fold_idx),
+               "--epochs", str(args.epochs), "--batch_size", str(args.batch_size), "--lr", str(args.lr),
+               "--frequency_of_train_acc_report", str(args.epochs), "--metrics_path", metrics_path,
+               "--checkpoint_path", os.path.join(workdir, "ddp_best_%d.pth" % nproc),
+               "--state_path", os.path.join(workdir, "ddp_state_%d.pth" % nproc)]
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.threads))
+    result = subprocess.run(command, cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        sys.exit(result.stdout[-3000:])
+    with open(metrics_path) as f:
+        epochs = [e for e in map(json.loads, f) if e["event"] == "epoch"][1:]
+    test_acc = float(re.findall(r"Test Accuracy=([0-9.]+)%", result.stdout)[-1])
+    return (np.mean([e["seconds"] for e in epochs]), np.mean([e["samples_per_s"] for e in epochs]), test_acc)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nprocs', type=int, nargs='+', default=[1, 2, 4], help='processes per launch')
+    parser.add_argument('--fold_idx', type=int, default=1, help='cross-validation fold')
+    parser.add_argument('--epochs', type=int, default=5, help='epochs per launch (the first is warm-up)')
+    parser.add_argument('--batch_size', type=int, default=256, help='global batch size')
+    parser.add_argument('--lr', type=float, default=0.1, help='learning rate')
+    parser.add_argument('--threads', type=int, default=1, help='OMP_NUM_THREADS of each process')
+    args = parser.parse_args()
+
+    workdir = os.getcwd()
+    if not os.path.exists(os.path.join(workdir, "data", "train", "fold_%d_train.json" % args.fold_idx)):
+        workdir = stand_in_fold(args.fold_idx)
+        print("no training fold in data/train; training on the other folds' test windows in %s" % workdir)
+
+    print("%d cores, global batch %d, %d thread(s) per process" % (os.cpu_count() or 1, args.batch_size,
+                                                                  args.threads))
+    print("%6s %12s %12s %10s %12s %10s" % ("procs", "epoch s", "samples/s", "speedup", "efficiency", "test acc"))
+    baseline = None
+    for nproc in args.nprocs:
+        seconds, samples_per_s, test_acc = run(args, workdir, nproc)
+        baseline = baseline or samples_per_s
+        print("%6d %12.3f %12.0f %9.2fx %11.0f%% %9.2f%%" % (nproc, seconds, samples_per_s, samples_per_s / baseline,
+                                                            100 * samples_per_s / baseline / nproc, test_acc))
+
+
+if __name__ == "__main__":
+    main()
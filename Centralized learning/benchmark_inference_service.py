@@ -0,0 +1,170 @@
+'''
+Throughput and latency of inference_server.py with and without micro-batching.
+
+Starts the server in a subprocess once per mode, "single" (--max_batch 1, one
+forward pass per request) and "batched" (--max_batch/--max_wait_ms), and drives it
+with --concurrency closed-loop connections: each sends a one-window request, waits
+for its answer and sends the next, for --seconds. Windows are taken from
+data/test/fold_N_test.json when it exists and are random otherwise. The test windows
+are stored normalized, so they are turned back into raw windows with the fold's
+train/fold_N_stats.json, which the server normalizes them with. Before the load, every
+window is sent once and the answers are checked against the model run locally on the
+stored windows, and scored against their labels. Without --checkpoint_path a randomly
+initialized SimpleMLP is served:
+
+    python benchmark_inference_service.py --checkpoint_path best_model.pth --fold_idx 2 --concurrency 1 16 64
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from inference_server import load_model, load_stats
+from main import create_model
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_windows(args):
+    """
+    (request payloads, normalized windows, labels) of up to 1000 windows of the fold's
+    test set, or of random windows with labels None.
+    """
+    path = os.path.join(args.data_dir, "test", "fold_%d_test.json" % args.fold_idx)
+    if not os.path.exists(path):
+        x = np.random.RandomState(0).normal(0.0, 1.0, (1000, 30, 3)).astype(np.float32)
+        return [request(i, w) for i, w in enumerate(x)], x, None
+    with open(path) as f:
+        user = json.load(f)["user_data"]["merged_user"]
+    x = np.asarray(user["x"], dtype=np.float32)[:1000]
+    y = np.asarray(user["y"], dtype=np.int64)[:1000]
+    raw = x
+    stats = load_stats(os.path.join(args.data_dir, "train", "fold_%d_stats.json" % args.fold_idx))
+    if stats is not None:
+        # Undo generate_json_data.py's normalization; the server applies it again
+        mean, std = stats
+        raw = x * (std + 1e-8) + mean
+    return [request(i, w) for i, w in enumerate(raw)], x, y
+
+
+def request(request_id, window):
+    return json.dumps({"id": request_id, "window": np.round(window, 4).tolist()}).encode() + b"\n"
+
+
+async def wait_for_port(host, port, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def client(host, port, requests, offset, stop, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    i = offset
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        writer.write(requests[i % len(requests)])
+        response = json.loads(await reader.readline())
+        assert "labels" in response, response
+        latencies.append(time.perf_counter() - start)
+        i += 1
+    writer.close()
+
+
+async def labels_of(host, port, requests):
+    """The label the server answers for each request, in order."""
+    reader, writer = await asyncio.open_connection(host, port)
+    labels = []
+    for payload in requests:
+        writer.write(payload)
+        response = json.loads(await reader.readline())
+        assert "labels" in response, response
+        labels += response["labels"]
+    writer.close()
+    return np.asarray(labels)
+
+
+def check_labels(labels, model, x, y):
+    """Fail unless the served labels are the model's on the stored windows; print their accuracy."""
+    with torch.no_grad():
+        expected = model(torch.from_numpy(x.reshape(len(x), -1))).argmax(dim=1).numpy()
+    # The payloads carry 4 decimals, which may flip a window on a decision boundary
+    agree = np.mean(labels == expected)
+    assert agree >= 0.99, "server labels agree with the model on only %.1f%% of the windows" % (100 * agree)
+    line = "server labels match the model on %.1f%% of the windows" % (100 * agree)
+    if y is not None:
+        line += ", accuracy %.2f%% (model on the stored windows %.2f%%)" % (100 * np.mean(labels == y),
+                                                                            100 * np.mean(expected == y))
+    print(line)
+
+
+async def load(host, port, requests, concurrency, seconds):
+    """(requests/s, latencies in s) of `concurrency` closed-loop connections."""
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, requests, i * 97, start + seconds, latencies)
+                           for i in range(concurrency)])
+    return len(latencies) / (time.perf_counter() - start), np.asarray(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint_path', type=str, default='',
+                        help='SimpleMLP best model (default: a randomly initialized one)')
+    parser.add_argument('--fold_idx', type=int, default=1, help='fold of the test windows and stats')
+    parser.add_argument('--data_dir', type=str, default='data', help='directory holding the fold files')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64], help='concurrent connections')
+    parser.add_argument('--seconds', type=float, default=5.0, help='load duration per point')
+    parser.add_argument('--max_batch', type=int, default=64, help='batched mode: windows per forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=2.0, help='batched mode: batch wait')
+    parser.add_argument('--port', type=int, default=8750, help='port of the server')
+    args = parser.parse_args()
+
+    checkpoint_path = args.checkpoint_path
+    if not checkpoint_path:
+        torch.manual_seed(0)
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), "random_mlp.pth")
+        torch.save(create_model(args, "simple_mlp", 6).state_dict(), checkpoint_path)
+    requests, x, y = test_windows(args)
+
+    print("%s, %d distinct windows, %.0f s per point" % (checkpoint_path, len(requests), args.seconds))
+    modes = [("single", ["--max_batch", "1", "--max_wait_ms", "0"]),
+             ("batched", ["--max_batch", str(args.max_batch), "--max_wait_ms", str(args.max_wait_ms)])]
+    for mode, options in modes:
+        server = subprocess.Popen([sys.executable, os.path.join(HERE, "inference_server.py"),
+                                   "--checkpoint_path", checkpoint_path, "--fold_idx", str(args.fold_idx),
+                                   "--data_dir", args.data_dir, "--port", str(args.port)] + options,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_for_port("127.0.0.1", args.port))
+            if mode == "single":
+                check_labels(asyncio.run(labels_of("127.0.0.1", args.port, requests)), load_model(checkpoint_path),
+                             x, y)
+                print("%8s %12s %12s %12s %12s" % ("mode", "connections", "req/s", "p50 ms", "p99 ms"))
+            for concurrency in args.concurrency:
+                throughput, latencies = asyncio.run(load("127.0.0.1", args.port, requests, concurrency,
+                                                         args.seconds))
+                print("%8s %12d %12.0f %12.3f %12.3f" % (mode, concurrency, throughput,
+                                                         1000 * np.percentile(latencies, 50),
+                                                         1000 * np.percentile(latencies, 99)))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
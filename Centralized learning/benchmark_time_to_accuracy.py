@@ -0,0 +1,172 @@
+'''
+Epochs and wall-clock time to a target test accuracy (main.py --target_acc / --lr_schedule).
+
+For every fold, first trains the fixed baseline: --epochs at a constant --lr with no
+early stopping, as main.py does by default. Unless --target is given, the target is
+--target_fraction of the baseline's mean best test accuracy over the folds. Each
+--lr_schedules run then trains the same SimpleMLP (same seed, same batches) until it
+reaches the target or stops improving for --patience epochs. Reported per schedule:
+epochs and seconds until the target (the baseline's are read off its test events),
+how many folds reached it, and the best and final test accuracy.
+
+--local_epochs also runs the FedAvg simulation (--clients clients, all selected every
+round) with those local epoch counts, and reports the rounds and total local epochs
+per client until the global model reaches the target. Without
+data/train/fold_N_train.json, the other folds' test windows stand in as the training set:
+
+    python benchmark_time_to_accuracy.py --folds 1-5 --epochs 100 --lr_schedules constant step cosine onecycle
+'''
+
+import argparse
+import logging
+import os
+import random
+import tempfile
+
+import numpy as np
+import torch
+
+from benchmark_data_parallel import stand_in_fold
+from centralized_trainer import CentralizedTrainer
+from data_loader import load_partition_data_fed_wisdm2011
+from fedavg_simulator import FedAvgSimulator
+from main import create_model, parse_folds, partition_clients
+from schedules import SCHEDULES
+
+
+def seed():
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+
+def trainer_args(args, **options):
+    namespace = argparse.Namespace(epochs=args.epochs, lr=args.lr, wd=0.001, client_optimizer="sgd",
+                                   batch_size=args.batch_size, hidden_nodes=40,
+                                   frequency_of_train_acc_report=args.epochs, checkpoint_frequency=args.epochs,
+                                   checkpoint_path=os.path.join(args.tmp, "best_model.pth"),
+                                   state_path=os.path.join(args.tmp, "train_state.pth"), keep_checkpoints=1,
+                                   lr_step_size=args.lr_step_size, lr_gamma=args.lr_gamma)
+    for key, value in options.items():
+        setattr(namespace, key, value)
+    return namespace
+
+
+def time_to_target(tests, target, key="epoch"):
+    """(epochs or rounds, seconds) until the first test event at or above target; (nan, nan) if none."""
+    for event in tests:
+        if event["acc"] >= target:
+            return event[key] + 1, event["elapsed"]
+    return np.nan, np.nan
+
+
+def centralized(args, fold_idx, schedule, target, patience):
+    """(epochs run, seconds run, test events, best test acc, final test acc)."""
+    seed()
+    dataset = load_partition_data_fed_wisdm2011(batch_size=args.batch_size, fold_idx=fold_idx)[1:]
+    options = trainer_args(args, lr_schedule=schedule, target_acc=target, patience=patience,
+                           min_delta=args.min_delta)
+    trainer = CentralizedTrainer(dataset, create_model(options, "simple_mlp", 6), torch.device("cpu"), options)
+    trainer.train()
+    return (trainer.epochs_run, trainer.train_seconds, trainer.metrics.select("test"), trainer.best_test_acc,
+            trainer.final_test_acc)
+
+
+def federated(args, fold_idx, local_epochs, target):
+    """(rounds to target, local epochs to target, seconds to target, best acc) of one FedAvg simulation."""
+    seed()
+    options = trainer_args(args, epochs=local_epochs, comm_round=args.rounds, client_num_per_round=args.clients,
+                           partition_method="hetero", partition_alpha=0.5, target_acc=target, patience=0,
+                           checkpoint_frequency=args.rounds)
+    dataset = load_partition_data_fed_wisdm2011(batch_size=args.batch_size, fold_idx=fold_idx)[1:]
+    dataset = partition_clients(options, dataset, args.clients)
+    simulator = FedAvgSimulator(dataset, create_model(options, "simple_mlp", 6), torch.device("cpu"), options)
+    simulator.train()
+    rounds, seconds = time_to_target(simulator.metrics.select("test"), target, key="round")
+    return rounds, rounds * local_epochs, seconds, simulator.best_test_acc
+
+
+def mean_std(values, fmt):
+    values = np.asarray(values, dtype=float)
+    if np.isnan(values).all():
+        return "%15s" % "-"
+    # Folds that never reached the target are left out of the mean
+    return fmt % (np.nanmean(values), np.nanstd(values))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folds', type=str, default='1-5', help='folds to compare, e.g. 1-5 or 1,3')
+    parser.add_argument('--epochs', type=int, default=100, help='baseline epochs and the budget of every run')
+    parser.add_argument('--batch_size', type=int, default=300, help='batch size')
+    parser.add_argument('--lr', type=float, default=0.1, help='learning rate (peak of onecycle)')
+    parser.add_argument('--lr_schedules', type=str, nargs='+', default=SCHEDULES, choices=SCHEDULES,
+                        help='schedules to run with early stopping')
+    parser.add_argument('--lr_step_size', type=int, default=30, help='step schedule: epochs between drops')
+    parser.add_argument('--lr_gamma', type=float, default=0.1, help='step schedule: factor of each drop')
+    parser.add_argument('--target', type=float, default=0, help='target test accuracy (%%); 0 derives it')
+    parser.add_argument('--target_fraction', type=float, default=0.98,
+                        help='target as a fraction of the baseline mean best test accuracy')
+    parser.add_argument('--patience', type=int, default=10, help='plateau patience in epochs')
+    parser.add_argument('--min_delta', type=float, default=0.0, help='smallest gain counted by --patience')
+    parser.add_argument('--local_epochs', type=int, nargs='*', default=[], help='FedAvg local epochs to compare')
+    parser.add_argument('--clients', type=int, default=10, help='FedAvg clients')
+    parser.add_argument('--rounds', type=int, default=50, help='FedAvg round budget')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    # Best models and training states of the runs
+    args.tmp = tempfile.mkdtemp()
+
+    cwd = os.getcwd()
+    workdirs = {}
+    for fold_idx in parse_folds(args.folds):
+        workdirs[fold_idx] = cwd
+        if not os.path.exists(os.path.join(cwd, "data", "train", "fold_%d_train.json" % fold_idx)):
+            workdirs[fold_idx] = stand_in_fold(fold_idx)
+    if any(workdir != cwd for workdir in workdirs.values()):
+        print("no training folds in data/train; trained on the other folds' test windows")
+
+    def each_fold(fn, *fn_args):
+        results = []
+        for fold_idx, workdir in workdirs.items():
+            os.chdir(workdir)
+            try:
+                results.append(fn(args, fold_idx, *fn_args))
+            finally:
+                os.chdir(cwd)
+        return results
+
+    baseline = each_fold(centralized, "constant", 0, 0)
+    target = args.target or args.target_fraction * np.mean([r[3] for r in baseline])
+    runs = [("baseline %d ep" % args.epochs, baseline)]
+    runs += [(schedule, each_fold(centralized, schedule, target, args.patience)) for schedule in args.lr_schedules]
+    federated_runs = [(local_epochs, each_fold(federated, local_epochs, target)) for local_epochs in args.local_epochs]
+
+    print("%d folds, budget %d epochs, lr %g, target %.2f%% test accuracy, patience %d"
+          % (len(workdirs), args.epochs, args.lr, target, args.patience))
+    print("%-18s %8s %15s %15s %15s %15s %15s %15s" % ("run", "reached", "epochs to tgt", "seconds to tgt",
+                                                       "epochs run", "seconds run", "best test acc",
+                                                       "final test acc"))
+    for name, results in runs:
+        epochs_run, seconds_run, tests, best, final = zip(*results)
+        reached = [time_to_target(t, target) for t in tests]
+        print("%-18s %6d/%d %s %s %s %s %s %s" % (
+            name, sum(not np.isnan(r[0]) for r in reached), len(results),
+            mean_std([r[0] for r in reached], "%7.1f ± %5.1f"), mean_std([r[1] for r in reached], "%7.2f ± %5.2f"),
+            mean_std(epochs_run, "%7.1f ± %5.1f"), mean_std(seconds_run, "%7.2f ± %5.2f"),
+            mean_std(best, "%7.2f ± %5.2f"), mean_std(final, "%7.2f ± %5.2f")))
+
+    if federated_runs:
+        print("FedAvg, %d clients per round, budget %d rounds" % (args.clients, args.rounds))
+        print("%-18s %8s %15s %15s %15s %15s" % ("local epochs", "reached", "rounds to tgt", "local ep to tgt",
+                                                 "seconds to tgt", "best test acc"))
+        for local_epochs, results in federated_runs:
+            rounds, epochs, seconds, best = zip(*results)
+            print("%-18d %6d/%d %s %s %s %s" % (
+                local_epochs, sum(not np.isnan(r) for r in rounds), len(rounds),
+                mean_std(rounds, "%7.1f ± %5.1f"), mean_std(epochs, "%7.1f ± %5.1f"),
+                mean_std(seconds, "%7.2f ± %5.2f"), mean_std(best, "%7.2f ± %5.2f")))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,19 @@
+import os
+import sys
+import time
+
 import torch
 import torch.nn as nn
 # import wandb
 import logging
 
+from checkpoint import CheckpointWriter, rng_state, set_rng_state
+# metrics.py is shared with the CoAP server and lives next to it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Federated learning",
+                                "Server Binaries and Source Code"))
+from metrics import MetricsRecorder
+from schedules import EarlyStopping, make_scheduler
+
 
 class CentralizedTrainer(object):
     def __init__(self, dataset, model, device, args):
@@ -15,6 +26,11 @@ class CentralizedTrainer(object):
         self.train_global = train_data_global
         self.test_global = test_data_global
         self.model = model.to(self.device)
+        # With --data_parallel the model is wrapped in DistributedDataParallel; checkpoints hold the inner module
+        self.module = getattr(self.model, "module", self.model)
+        # Metrics are summed over the ranks, and only rank 0 writes checkpoints and metrics files
+        self.distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.is_main = not self.distributed or torch.distributed.get_rank() == 0
 
         # Classification loss
         self.criterion = nn.CrossEntropyLoss()
@@ -32,20 +48,119 @@ class CentralizedTrainer(object):
                 lr=self.args.lr,
                 weight_decay=self.args.wd
             )
+        # --lr_schedule: stepped after every epoch, or after every batch for onecycle
+        self.scheduler, self.schedule_per_batch = make_scheduler(self.optimizer, self.args, len(self.train_global))
+        # --target_acc / --patience end the run before --epochs
+        self.stopper = EarlyStopping(getattr(self.args, "target_acc", 0.0), getattr(self.args, "patience", 0),
+                                     getattr(self.args, "min_delta", 0.0))
+        self.stop_reason = None
+        self.epochs_run = 0
+        self.train_seconds = 0.0
 
         # Best accuracy tracker
         self.best_test_acc = 0.0
+        self.final_test_acc = 0.0
+        self.checkpoint_path = getattr(self.args, "checkpoint_path", "best_model.pth")
+        # Best models and resumable training states are written on a background thread
+        self.checkpoints = CheckpointWriter(getattr(self.args, "state_path", "train_state.pth"),
+                                            getattr(self.args, "keep_checkpoints", 2))
+        self.start_epoch = 0
+
+        # Epoch, batch and evaluation timings; written out when --metrics_path is set
+        self.metrics = MetricsRecorder((getattr(self.args, "metrics_path", "") if self.is_main else "") or None,
+                                       keep=["test", "stop"])
 
     def train(self):
-        for epoch in range(self.args.epochs):
-            self.train_one_epoch(epoch)
-            self.eval_and_log(epoch)
+        if getattr(self.args, "resume", 0):
+            self.resume()
+        self.train_start = time.perf_counter()
+        try:
+            for epoch in range(self.start_epoch, self.args.epochs):
+                self.train_one_epoch(epoch)
+                if self.scheduler is not None and not self.schedule_per_batch:
+                    self.scheduler.step()
+                test_acc = self.eval_and_log(epoch)
+                self.epochs_run = epoch + 1
+                if test_acc is not None:
+                    # Every rank sees the same all-reduced accuracy, so they all stop together
+                    self.stop_reason = self.stopper.update(epoch, test_acc)
+                if self.is_main and (self.stop_reason or
+                                     self.is_report_epoch(epoch, getattr(self.args, "checkpoint_frequency", 1))):
+                    self.checkpoints.save_state(self.training_state(epoch), epoch)
+                if self.stop_reason:
+                    break
+        finally:
+            self.checkpoints.close()
+        self.train_seconds = time.perf_counter() - self.train_start
+        self.metrics.record("stop", epoch=self.epochs_run - 1, reason=self.stop_reason or "epochs",
+                            seconds=self.train_seconds, final_test_acc=self.final_test_acc,
+                            best_test_acc=self.best_test_acc)
+        self.metrics.close()
+        self.log_timings()
+        self.log_stop()
+
+    def training_state(self, epoch_idx):
+        """Everything needed to continue after epoch_idx as if the run had not stopped."""
+        return {"epoch": epoch_idx, "model": self.module.state_dict(), "optimizer": self.optimizer.state_dict(),
+                "scheduler": self.scheduler.state_dict() if self.scheduler is not None else None,
+                "stopper": self.stopper.state_dict(),
+                "best_test_acc": self.best_test_acc, "final_test_acc": self.final_test_acc, "rng": rng_state()}
+
+    def resume(self):
+        if self.checkpoints.latest() is None:
+            logging.info("no training state to resume from, starting at epoch 0")
+            return
+        state = self.checkpoints.load()
+        self.module.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        if self.scheduler is not None and state.get("scheduler") is not None:
+            self.scheduler.load_state_dict(state["scheduler"])
+        if "stopper" in state:
+            self.stopper.load_state_dict(state["stopper"])
+        self.best_test_acc = state["best_test_acc"]
+        self.final_test_acc = state["final_test_acc"]
+        self.start_epoch = state["epoch"] + 1
+        set_rng_state(state["rng"])
+        logging.info("resumed after epoch %d, best test accuracy %.2f%%" % (state["epoch"], self.best_test_acc))
+
+    def log_timings(self):
+        epochs = self.metrics.summary("epoch")
+        if not epochs:
+            return
+        batches = self.metrics.summary("batch")[None]["seconds"]
+        logging.info("%d epochs: %.3fs mean (%.0f samples/s), batch %.2fms mean / %.2fms p99"
+                     % (epochs[None]["count"], epochs[None]["seconds"]["mean"],
+                        epochs[None]["samples_per_s"]["mean"], 1000 * batches["mean"], 1000 * batches["p99"]))
+
+    def log_stop(self):
+        logging.info("stopped after %d/%d epochs, %.1fs: %s (best %.2f%%, final %.2f%%)"
+                     % (self.epochs_run, self.args.epochs, self.train_seconds,
+                        self.stopper.describe(self.stop_reason), self.best_test_acc, self.final_test_acc))
+
+    def all_reduce(self, *values):
+        """Each value summed over the ranks; the values themselves when not distributed."""
+        if not self.distributed:
+            return values
+        totals = torch.tensor([float(v) for v in values], dtype=torch.float64, device=self.device)
+        torch.distributed.all_reduce(totals)
+        return totals.tolist()
+
+    def is_report_epoch(self, epoch_idx, frequency):
+        """True every `frequency` epochs and on the last epoch."""
+        return (epoch_idx + 1) % max(1, frequency) == 0 or epoch_idx == self.args.epochs - 1
 
     def train_one_epoch(self, epoch_idx):
         self.model.train()
-        correct, total, running_loss = 0, 0, 0.0
-
-        for x, labels in self.train_global:
+        if hasattr(self.train_global, "set_epoch"):
+            self.train_global.set_epoch(epoch_idx)
+        # Accumulated on the device and read back once per epoch, not once per batch
+        correct = torch.zeros((), dtype=torch.int64, device=self.device)
+        running_loss = torch.zeros((), device=self.device)
+        total = 0
+
+        # Batch times are host-side: on a GPU they measure launching the step, not running it
+        epoch_start = batch_start = time.perf_counter()
+        for batch_idx, (x, labels) in enumerate(self.train_global):
             x = x.view(x.size(0), -1).to(self.device)
             labels = labels.to(self.device)
 
@@ -54,47 +169,79 @@ class CentralizedTrainer(object):
             loss = self.criterion(outputs, labels)
             loss.backward()
             self.optimizer.step()
+            if self.schedule_per_batch:
+                self.scheduler.step()
 
-            running_loss += loss.item()
-            _, predicted = torch.max(outputs, 1)
+            running_loss += loss.detach()
+            correct += (outputs.argmax(1) == labels).sum()
             total += labels.size(0)
-            correct += (predicted == labels).sum().item()
 
+            now = time.perf_counter()
+            self.metrics.record("batch", epoch=epoch_idx, batch=batch_idx, samples=labels.size(0),
+                                seconds=now - batch_start)
+            batch_start = now
+
+        correct, running_loss, total, batches = self.all_reduce(correct.item(), running_loss.item(), total,
+                                                                len(self.train_global))
         acc = 100.0 * correct / total
-        avg_loss = running_loss / len(self.train_global)
+        avg_loss = running_loss / batches
+        seconds = time.perf_counter() - epoch_start
+        self.metrics.record("epoch", epoch=epoch_idx, seconds=seconds, samples_per_s=total / seconds,
+                            loss=avg_loss, acc=acc, lr=self.optimizer.param_groups[0]["lr"])
 
         logging.info(f"[Epoch {epoch_idx}] Train Loss={avg_loss:.4f}, Accuracy={acc:.2f}%")
+        return avg_loss, acc
 
     def eval_and_log(self, epoch_idx):
+        """
+        Log train/test metrics on their report epochs and save the best model.
+        Returns the test accuracy, or None when the test set was not evaluated.
+
+        The full pass over the training set only runs every frequency_of_train_acc_report
+        epochs; in between, the metrics accumulated by train_one_epoch are what gets logged.
+        """
         # Train metrics
-        train_loss, train_acc = self.compute_metrics(self.train_global)
-        # Test metrics
-        test_loss, test_acc = self.compute_metrics(self.test_global)
+        if self.is_report_epoch(epoch_idx, getattr(self.args, "frequency_of_train_acc_report", 1)):
+            with self.metrics.timer("eval", epoch=epoch_idx, split="train"):
+                train_loss, train_acc = self.compute_metrics(self.train_global)
+            logging.info(f"[Epoch {epoch_idx}] Train Accuracy={train_acc:.2f}%, Loss={train_loss:.4f}")
 
-        logging.info(f"[Epoch {epoch_idx}] Train Accuracy={train_acc:.2f}%, Loss={train_loss:.4f}")
+        # Test metrics
+        if not self.is_report_epoch(epoch_idx, getattr(self.args, "frequency_of_test_acc_report", 1)):
+            return None
+        with self.metrics.timer("eval", epoch=epoch_idx, split="test"):
+            test_loss, test_acc = self.compute_metrics(self.test_global)
         logging.info(f"[Epoch {epoch_idx}] Test Accuracy={test_acc:.2f}%, Loss={test_loss:.4f}")
+        # Wall-clock seconds since train() started, for time-to-accuracy
+        self.metrics.record("test", epoch=epoch_idx, elapsed=time.perf_counter() - self.train_start, acc=test_acc)
 
+        self.final_test_acc = test_acc
 
         # Save best model
         if test_acc > self.best_test_acc:
             self.best_test_acc = test_acc
-            torch.save(self.model.state_dict(), "best_model.pth")
-            logging.info(f"New best model saved with Test Accuracy={test_acc:.2f}%")
+            if self.is_main:
+                self.checkpoints.save(self.module.state_dict(), self.checkpoint_path)
+                logging.info(f"New best model saved with Test Accuracy={test_acc:.2f}%")
+        return test_acc
 
     def compute_metrics(self, dataloader):
         """Compute average loss and accuracy for a given dataloader."""
         self.model.eval()
-        correct, total, loss_sum = 0, 0, 0.0
+        correct = torch.zeros((), dtype=torch.int64, device=self.device)
+        loss_sum = torch.zeros((), device=self.device)
+        total = 0
         with torch.no_grad():
             for x, labels in dataloader:
                 x = x.view(x.size(0), -1).to(self.device)
                 labels = labels.to(self.device)
-                outputs = self.model(x)
-                loss_sum += self.criterion(outputs, labels).item()
-                _, predicted = torch.max(outputs, 1)
+                # The inner module: the ranks' shards can differ by a batch, so no collectives here
+                outputs = self.module(x)
+                loss_sum += self.criterion(outputs, labels)
+                correct += (outputs.argmax(1) == labels).sum()
                 total += labels.size(0)
-                correct += (predicted == labels).sum().item()
 
-        avg_loss = loss_sum / len(dataloader)
+        correct, loss_sum, total, batches = self.all_reduce(correct.item(), loss_sum.item(), total, len(dataloader))
+        avg_loss = loss_sum / batches
         accuracy = 100.0 * correct / total
         return avg_loss, accuracy
@@ -0,0 +1,118 @@
+import copy
+import glob
+import logging
+import os
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def rng_state():
+    """
+    Python, NumPy and torch (CPU and CUDA) generator states, as tensors and plain
+    Python values so that torch.load() can read them back with weights_only.
+    """
+    kind, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {"python": random.getstate(), "torch": torch.get_rng_state(),
+             "numpy": (kind, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian)}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    kind, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((kind, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def snapshot(state):
+    """A copy of `state` that later training steps cannot modify, with tensors moved to the CPU."""
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return copy.deepcopy(state)
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints on a background thread.
+
+    save() snapshots the state on the caller's thread and returns. One worker thread
+    serializes the snapshots in order, each to a temporary file that is then renamed
+    over the target, so an interrupted write never leaves a truncated checkpoint.
+    Training-state checkpoints of state_path are named <root>_epoch<N><ext>, and only
+    the newest `keep` of them are kept. A failed write is raised by the next save()
+    or close().
+    """
+
+    def __init__(self, state_path, keep=2):
+        self.state_path_root = os.path.splitext(state_path)
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def state_path(self, epoch):
+        root, ext = self.state_path_root
+        return "%s_epoch%d%s" % (root, epoch, ext)
+
+    def state_paths(self):
+        """Existing training-state checkpoints, oldest first."""
+        root, ext = self.state_path_root
+        pattern = re.compile(re.escape(root) + r"_epoch(\d+)" + re.escape(ext) + "$")
+        found = [(int(m.group(1)), p) for p in glob.glob(glob.escape(root) + "_epoch*" + ext)
+                 for m in [pattern.match(p)] if m]
+        return [p for _, p in sorted(found)]
+
+    def latest(self):
+        paths = self.state_paths()
+        return paths[-1] if paths else None
+
+    def save(self, state, path):
+        """Queue `state` for writing to `path`."""
+        self.check()
+        self.futures.append(self.executor.submit(self._write, snapshot(state), path))
+
+    def save_state(self, state, epoch):
+        """Queue a training-state checkpoint for `epoch` and drop the ones past `keep`."""
+        self.save(state, self.state_path(epoch))
+        self.futures.append(self.executor.submit(self._prune))
+
+    def _write(self, state, path):
+        tmp_path = "%s.tmp%d" % (path, os.getpid())
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _prune(self):
+        for path in self.state_paths()[:-self.keep] if self.keep > 0 else []:
+            os.remove(path)
+
+    def check(self):
+        """Raise the error of any finished write."""
+        pending = []
+        for future in self.futures:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self.futures = pending
+
+    def close(self):
+        """Wait for the queued writes."""
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def load(self, path=None):
+        path = path or self.latest()
+        logging.info("resuming from %s" % path)
+        return torch.load(path, map_location="cpu")
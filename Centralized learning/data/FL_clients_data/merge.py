@@ -1,5 +1,10 @@
-import re
+import argparse
+import glob
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 # Define the activities and their corresponding one-hot encoded labels.
 ACTIVITY_LABELS = {
@@ -10,87 +15,153 @@ ACTIVITY_LABELS = {
     "Sitting": [0.0, 0.0, 0.0, 0.0, 1.0, 0.0],
     "Standing": [0.0, 0.0, 0.0, 0.0, 0.0, 1.0],
 }
+# Numeric label index of each activity (position of the 1.0 in its one-hot vector).
+ACTIVITY_INDEX = {name: label.index(1.0) for name, label in ACTIVITY_LABELS.items()}
 
 # The number of client files you have.
 CLIENT_COUNT = 9
 
+CHUNK_SIZE = 1 << 20
+
+# An activity header '//// ActivityName' or a data record '{...}'
+_TOKEN = re.compile(r'////\s*(\w+)|\{([^}]*)\}')
+
 
-def parse_and_merge_data_to_single_file():
+def iter_tokens(file, chunk_size=CHUNK_SIZE):
     """
-    Parses sensor data from all client files, merges all records into a
-    single list, appends the correct label, and writes everything
-    to a single output CSV file.
+    Stream (activity_name, None) and (None, record_str) tokens from a client file.
+
+    The file is read in chunks; a chunk is only scanned up to its last newline or
+    closing brace, and a record still open at that point is carried into the next one.
+    """
+    tail = ''
+    while True:
+        chunk = file.read(chunk_size)
+        buf = tail + chunk
+        safe = len(buf) if not chunk else max(buf.rfind('\n'), buf.rfind('}')) + 1
+        pos = 0
+        for match in _TOKEN.finditer(buf, 0, safe):
+            yield match.group(1), match.group(2)
+            pos = match.end()
+        open_record = buf.find('{', pos, safe)
+        tail = buf[open_record if open_record >= 0 else safe:]
+        if not chunk:
+            return
+
+
+def _parse_records(records, filename, activity_name, warnings):
+    """Convert one activity's records to a 2-D float array, reporting malformed ones."""
+    cleaned = [r.replace('\n', '').strip() for r in records]
+    cleaned = [r for r in cleaned if r]
+    if not cleaned:
+        return []
+    fields = [[p for p in r.split(',') if p.strip()] for r in cleaned]
+    widths = {len(f) for f in fields}
+    if len(widths) == 1:
+        try:
+            # Fast path: one bulk conversion for the whole section
+            return list(np.array([p for f in fields for p in f], dtype=np.float64).reshape(len(fields), -1))
+        except ValueError:
+            pass
+
+    rows = []
+    for record_str, parts in zip(cleaned, fields):
+        try:
+            rows.append(np.array(parts, dtype=np.float64))
+        except ValueError as e:
+            warnings.append(
+                f"  ⚠️  Warning: Could not parse a record in '{filename}' for activity '{activity_name}'. Error: {e}")
+            warnings.append(f"     Problematic data snippet: '{record_str[:50]}...'")
+    return rows
+
+
+def parse_client_file(filename):
+    """Parse one client dump; returns (records, label indices, warning lines)."""
+    rows, labels, warnings = [], [], []
+    activity_name, records = None, []
+
+    def flush():
+        if activity_name in ACTIVITY_LABELS:
+            parsed = _parse_records(records, filename, activity_name, warnings)
+            rows.extend(parsed)
+            labels.extend([ACTIVITY_INDEX[activity_name]] * len(parsed))
+
+    with open(filename, 'r') as file:
+        for header, record in iter_tokens(file):
+            if header is not None:
+                flush()
+                activity_name, records = header.strip(), []
+            else:
+                records.append(record)
+    flush()
+    return rows, np.array(labels, dtype=np.int64), warnings
+
+
+def _client_number(filename):
+    digits = re.findall(r'\d+', os.path.basename(filename))
+    return int(digits[-1]) if digits else -1
+
+
+def parse_and_merge_data_to_single_file(filenames=None, output_prefix="all_activities_merged",
+                                        write_csv=True, workers=None):
+    """
+    Parses sensor data from all client files in parallel and merges all records into
+    '<output_prefix>.npz' (float32 x, int64 label index y, client number) and,
+    optionally, the one-hot '<output_prefix>.csv'.
     """
     print("Starting data merging process...")
 
-    # A single list to hold all records from all activities and clients.
-    all_records = []
+    if filenames is None:
+        filenames = sorted(glob.glob("Client *.txt"), key=_client_number)
+        for i in range(1, CLIENT_COUNT + 1):
+            # Check that the expected client files exist.
+            if f"Client {i}.txt" not in filenames:
+                print(f"⚠️  Warning: File 'Client {i}.txt' not found. Skipping.")
 
-    # Loop through each client file from Client 1.txt to Client 9.txt
-    for i in range(1, CLIENT_COUNT + 1):
-        filename = f"Client {i}.txt"
-
-        # Check if the file exists before trying to open it.
-        if not os.path.exists(filename):
-            print(f"⚠️  Warning: File '{filename}' not found. Skipping.")
-            continue
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(parse_client_file, filenames))
 
+    all_rows, all_labels, all_clients = [], [], []
+    for filename, (rows, labels, warnings) in zip(filenames, results):
         print(f"Processing '{filename}'...")
-
-        with open(filename, 'r') as file:
-            content = file.read()
-
-        # Split the file content by activity sections.
-        # The pattern looks for '//// ActivityName' and uses it as a delimiter.
-        parts = re.split(r'////\s*(\w+)', content)
-
-        # Iterate over the parts, two at a time (activity name, then its data block)
-        for j in range(1, len(parts), 2):
-            activity_name = parts[j].strip()
-            activity_data_block = parts[j + 1]
-
-            if activity_name in ACTIVITY_LABELS:
-                # Find all data records enclosed in curly braces {}
-                records = re.findall(r'\{(.*?)\}', activity_data_block, re.DOTALL)
-
-                label = ACTIVITY_LABELS[activity_name]
-
-                for record_str in records:
-                    # Clean up the string: remove newlines and leading/trailing spaces.
-                    cleaned_str = record_str.replace('\n', '').strip()
-                    if not cleaned_str:
-                        continue
-
-                    # Split the string of numbers by commas and convert them to floats.
-                    try:
-                        data_points = [float(p) for p in cleaned_str.split(',') if p.strip()]
-                        # Append the list of data points and its corresponding label to the master list.
-                        all_records.append((data_points, label))
-                    except ValueError as e:
-                        print(
-                            f"  ⚠️  Warning: Could not parse a record in '{filename}' for activity '{activity_name}'. Error: {e}")
-                        print(f"     Problematic data snippet: '{cleaned_str[:50]}...'")
-
-    # --- Write the merged data to a SINGLE output file ---
-    print("\nWriting all merged data to a single file...")
-    if not all_records:
+        for line in warnings:
+            print(line)
+        all_rows.extend(rows)
+        all_labels.append(labels)
+        all_clients.append(np.full(len(labels), _client_number(filename), dtype=np.int16))
+
+    # --- Write the merged data ---
+    print("\nWriting all merged data...")
+    if not all_rows:
         print("No data was found in any client file. Output file will not be created.")
         return
 
-    output_filename = "all_activities_merged.csv"
-    with open(output_filename, 'w') as f:
-        # Iterate through the master list and write each record to the file
-        for data_points, label in all_records:
-            # Create comma-separated strings for the data and the label
-            data_str = ",".join(map(str, data_points))
-            label_str = ",".join(map(str, label))
-            # Write a single line with all data points followed by the label components
-            f.write(f"{data_str},{label_str}\n")
+    labels = np.concatenate(all_labels)
+    widths = {len(row) for row in all_rows}
+    if len(widths) == 1:
+        np.savez(output_prefix + ".npz", x=np.stack(all_rows).astype(np.float32), y=labels,
+                 client=np.concatenate(all_clients), activities=np.array(list(ACTIVITY_INDEX)))
+        print(f"✅ Successfully created '{output_prefix}.npz' with {len(all_rows)} total records.")
+    else:
+        print(f"⚠️  Warning: records have different lengths {sorted(widths)}; '{output_prefix}.npz' not written.")
 
-    print(f"✅ Successfully created '{output_filename}' with {len(all_records)} total records.")
+    if write_csv:
+        label_strs = {ACTIVITY_INDEX[name]: ",".join(map(str, label)) for name, label in ACTIVITY_LABELS.items()}
+        with open(output_prefix + ".csv", 'w') as f:
+            # A single line with all data points followed by the label components
+            f.writelines(f"{','.join(map(str, row.tolist()))},{label_strs[label]}\n"
+                         for row, label in zip(all_rows, labels.tolist()))
+        print(f"✅ Successfully created '{output_prefix}.csv' with {len(all_rows)} total records.")
 
 
 # This makes the script executable
 if __name__ == "__main__":
-    parse_and_merge_data_to_single_file()
-    print("\nScript finished successfully! 🎉")
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', help="client dumps (default: every 'Client N.txt' here)")
+    parser.add_argument('--output', default="all_activities_merged", help="output path without extension")
+    parser.add_argument('--no_csv', action='store_true', help="only write the binary .npz output")
+    parser.add_argument('--workers', type=int, default=None, help="parallel parser processes")
+    args = parser.parse_args()
+
+    parse_and_merge_data_to_single_file(args.files or None, args.output, not args.no_csv, args.workers)
+    print("\nScript finished successfully! 🎉")
@@ -0,0 +1,103 @@
+'''
+Timing comparison of generate_json_data.py against the original per-window loop.
+
+Runs on a synthetic WISDM-shaped stream (no raw file needed), checks that the
+vectorized windowing reproduces the loop's windows and labels exactly, and times
+the sequential vs. parallel fold serialization.
+
+    python benchmark_generate.py --rows 1098203 --step 15
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.model_selection import StratifiedKFold
+from concurrent.futures import ProcessPoolExecutor
+
+import generate_json_data as gen
+
+
+def segment_windows_loop(df_subset, n_time_steps, step):
+    """Step 5 as it was written before vectorization, kept as the reference."""
+    X, y = [], []
+    for i in range(0, len(df_subset) - n_time_steps, step):
+        xs = df_subset["x-axis"].values[i: i + n_time_steps]
+        ys = df_subset["y-axis"].values[i: i + n_time_steps]
+        zs = df_subset["z-axis"].values[i: i + n_time_steps]
+
+        # The label for a window is the most frequent activity within it
+        label = np.atleast_1d(stats.mode(df_subset["label"].values[i: i + n_time_steps])[0])[0]
+
+        X.append([xs, ys, zs])
+        y.append(label)
+    return np.transpose(np.array(X), (0, 2, 1)), np.array(y)
+
+
+def synthetic_stream(rows, seed=0):
+    """Accelerometer rows with activity runs of random length, like the raw WISDM file."""
+    rng = np.random.default_rng(seed)
+    run_lengths = rng.integers(20, 2000, size=rows // 20 + 1)
+    labels = np.repeat(rng.integers(0, 6, size=len(run_lengths)), run_lengths)[:rows]
+    xyz = rng.normal(0.0, 5.0, size=(rows, 3)).round(8)
+    return pd.DataFrame({"x-axis": xyz[:, 0], "y-axis": xyz[:, 1], "z-axis": xyz[:, 2], "label": labels})
+
+
+def time_folds(X, y, parallel):
+    splits = list(StratifiedKFold(n_splits=gen.N_FOLDS, shuffle=True, random_state=42).split(X, y))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.makedirs("train")
+        os.makedirs("test")
+        try:
+            start = time.perf_counter()
+            if parallel:
+                workers = max(1, min(gen.N_FOLDS, os.cpu_count() or 1))
+                with ProcessPoolExecutor(max_workers=workers, initializer=gen._init_fold_worker,
+                                         initargs=(X, y)) as pool:
+                    list(pool.map(gen.save_fold, range(1, gen.N_FOLDS + 1), *zip(*splits)))
+            else:
+                gen._init_fold_worker(X, y)
+                for fold_idx, (train_idx, test_idx) in enumerate(splits, start=1):
+                    gen.save_fold(fold_idx, train_idx, test_idx)
+            return time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=131784,
+                        help='stream length (default: ~PERCENT_DATA=0.12 of WISDM)')
+    parser.add_argument('--step', type=int, default=gen.STEP, help='window step')
+    parser.add_argument('--skip_loop', action='store_true', help='do not run the slow reference loop')
+    args = parser.parse_args()
+
+    df = synthetic_stream(args.rows)
+    print(f"rows={args.rows} window={gen.N_TIME_STEPS} step={args.step} cpus={os.cpu_count()}")
+
+    start = time.perf_counter()
+    X, y = gen.segment_windows(df, gen.N_TIME_STEPS, args.step)
+    t_vec = time.perf_counter() - start
+    print(f"windowing, vectorized: {t_vec:8.3f}s  ({len(X)} windows)")
+
+    if not args.skip_loop:
+        start = time.perf_counter()
+        X_ref, y_ref = segment_windows_loop(df, gen.N_TIME_STEPS, args.step)
+        t_loop = time.perf_counter() - start
+        assert np.array_equal(X, X_ref) and np.array_equal(y, y_ref), "vectorized windows differ"
+        print(f"windowing, loop:       {t_loop:8.3f}s  (identical output, {t_loop / t_vec:.0f}x slower)")
+
+    t_seq = time_folds(X, y, parallel=False)
+    t_par = time_folds(X, y, parallel=True)
+    print(f"folds, sequential:     {t_seq:8.3f}s")
+    print(f"folds, parallel:       {t_par:8.3f}s  ({t_seq / t_par:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
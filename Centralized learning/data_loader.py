@@ -2,6 +2,10 @@
 
 import json
 import logging
+import os
+import struct
+
+import numpy as np
 import torch
 import torch.utils.data as data
 from tqdm import tqdm
@@ -17,74 +21,345 @@ DEFAULT_BATCH_SIZE = 300
 _USERS = 'users'
 _USER_DATA = "user_data"
 
-def load_partition_data_fed_wisdm2011(data_dir=None, batch_size=1,fold_idx=1):
+# Binary fold cache layout: magic | uint64 header length | JSON header | aligned x block | aligned y block.
+# Every user's windows are one row range of the x and y blocks, in header order.
+_CACHE_SUFFIX = '.npcache'
+_CACHE_MAGIC = b'FCFOLD02'
+_CACHE_ALIGN = 64
+
+# Window storage: float32, float16, or int16 with a per-axis scale and offset
+STORAGE_DTYPES = {"float32": np.float32, "float16": np.float16, "int16": np.int16}
+
+
+def _align(offset):
+    return offset + (-offset % _CACHE_ALIGN)
+
+
+def _source_key(json_path):
+    """Identify a JSON fold file by its size and modification time."""
+    st = os.stat(json_path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _read_cache_header(cache_path):
+    """Return (header, data_start) of a fold cache, or (None, 0) if it is not one."""
+    with open(cache_path, 'rb') as f:
+        if f.read(len(_CACHE_MAGIC)) != _CACHE_MAGIC:
+            return None, 0
+        (header_len,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, _align(len(_CACHE_MAGIC) + 8 + header_len)
+
+
+def quantization(xs):
+    """
+    Per-axis (scale, offset) mapping the windows in `xs` onto the int16 range.
+
+    The axis is the last dimension; offset is the middle of each axis' range and
+    scale spreads the range over -32767..32767.
+    """
+    axes = xs[0].shape[-1]
+    lo = np.min([x.reshape(-1, axes).min(0) for x in xs if x.size], axis=0)
+    hi = np.max([x.reshape(-1, axes).max(0) for x in xs if x.size], axis=0)
+    scale = np.where(hi > lo, (hi - lo) / 65534.0, 1.0)
+    return scale.astype(np.float32), ((hi + lo) / 2).astype(np.float32)
+
+
+def quantize(x, storage, scale=None, offset=None):
+    """x (float32, last dimension the axes) in the `storage` dtype."""
+    if storage == "int16":
+        return np.clip(np.rint((x - offset) / scale), -32767, 32767).astype(np.int16)
+    return x.astype(STORAGE_DTYPES[storage])
+
+
+def _build_fold_cache(json_path, cache_path, storage="float32"):
+    """Parse a JSON fold once and write all users' windows as one x (in `storage`) and one int64 y block."""
+    logging.info("building fold cache %s" % cache_path)
+    key = _source_key(json_path)
+    with open(json_path, 'r') as f:
+        fold = json.load(f)
+
+    xs = [np.asarray(fold[_USER_DATA][str(user_id)]['x'], dtype=np.float32) for user_id in fold[_USERS]]
+    ys = [np.asarray(fold[_USER_DATA][str(user_id)]['y'], dtype=np.int64) for user_id in fold[_USERS]]
+    scale, offset = quantization(xs) if storage == "int16" and xs else (None, None)
+    users = [{"id": user_id, "num": len(y)} for user_id, y in zip(fold[_USERS], ys)]
+    # A user without windows parses to shape (0,), which does not concatenate with (n, 30, 3)
+    xs = [x for x in xs if x.size] or [np.zeros((0,), np.float32)]
+    x = np.ascontiguousarray(quantize(np.concatenate(xs), storage, scale, offset))
+    y = np.concatenate(ys) if ys else np.zeros((0,), np.int64)
+    del fold, xs, ys
+
+    header = {"source": key, "storage": storage, _USERS: users, "x_shape": list(x.shape), "x_offset": 0,
+              "y_offset": _align(x.nbytes)}
+    if scale is not None:
+        header.update(scale=scale.tolist(), offset=offset.tolist())
+    header = json.dumps(header).encode('utf-8')
+    data_start = _align(len(_CACHE_MAGIC) + 8 + len(header))
+
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_CACHE_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for block_offset, arr in ((0, x), (_align(x.nbytes), y)):
+            f.seek(data_start + block_offset)
+            f.write(arr.tobytes())
+        f.truncate(data_start + _align(x.nbytes) + y.nbytes)
+    os.replace(tmp_path, cache_path)
+
+
+def fold_cache_path(json_path, storage="float32"):
+    """fold_N_train.npcache for float32 windows, fold_N_train.<storage>.npcache otherwise."""
+    root = os.path.splitext(json_path)[0]
+    return root + _CACHE_SUFFIX if storage == "float32" else "%s.%s%s" % (root, storage, _CACHE_SUFFIX)
+
+
+def load_fold_cache(json_path, storage="float32"):
+    """
+    Return (x, y, {user_id: rows}, (scale, offset)) for a JSON fold, memory-mapped from its binary cache.
+
+    The cache is written next to the JSON file on first use and rebuilt whenever the
+    JSON's size or mtime changes. x and y hold every user's windows, user after user,
+    and rows is the slice of each user's. They are copy-on-write maps of the cache,
+    so torch.from_numpy() wraps them without copying or parsing anything. The windows
+    are stored as `storage`; (scale, offset) are the per-axis int16 quantization
+    (see quantization()), and (None, None) for float32 and float16.
+    """
+    cache_path = fold_cache_path(json_path, storage)
+    header = None
+    if os.path.exists(cache_path):
+        header, data_start = _read_cache_header(cache_path)
+    if header is None or header["source"] != _source_key(json_path) or header.get("storage", "float32") != storage:
+        _build_fold_cache(json_path, cache_path, storage)
+        header, data_start = _read_cache_header(cache_path)
+
+    x_shape = tuple(header["x_shape"])
+    if x_shape[0] == 0:
+        # An empty file cannot be mapped
+        x, y = np.zeros(x_shape, dtype=STORAGE_DTYPES[storage]), np.zeros((0,), dtype=np.int64)
+    else:
+        x = np.memmap(cache_path, dtype=STORAGE_DTYPES[storage], mode='c', shape=x_shape,
+                      offset=data_start + header["x_offset"])
+        y = np.memmap(cache_path, dtype=np.int64, mode='c', shape=(x_shape[0],),
+                      offset=data_start + header["y_offset"])
+    rows = {}
+    start = 0
+    for entry in header[_USERS]:
+        rows[entry["id"]] = slice(start, start + entry["num"])
+        start += entry["num"]
+    scale, offset = header.get("scale"), header.get("offset")
+    if scale is not None:
+        scale, offset = np.asarray(scale, dtype=np.float32), np.asarray(offset, dtype=np.float32)
+    return x, y, rows, (scale, offset)
+
+
+class WindowDataset(data.TensorDataset):
+    """
+    TensorDataset of (x, y) windows whose x may be stored as float16 or int16.
+
+    dequantize() turns a batch of stored windows back into float32: a cast for
+    float16, x * scale + offset per axis (the last dimension of the stored windows)
+    for int16. TensorBatchLoader applies it to every batch it gathers, so only the
+    batch in flight is ever float32.
+    """
+
+    def __init__(self, x, y, scale=None, offset=None):
+        super(WindowDataset, self).__init__(x, y)
+        self.scale = None if scale is None else torch.as_tensor(scale, dtype=torch.float32)
+        self.offset = None if offset is None else torch.as_tensor(offset, dtype=torch.float32)
+
+    def dequantize(self, x):
+        if x.dtype == torch.float32:
+            return x
+        if self.scale is None:
+            return x.float()
+        scale, offset = self.scale.to(x.device), self.offset.to(x.device)
+        return torch.addcmul(offset, x.float().view(-1, len(scale)), scale).view(x.shape)
+
+    def subset(self, idx):
+        """The windows at `idx`, stored the same way."""
+        x, y = self.tensors
+        return WindowDataset(x[idx], y[idx], self.scale, self.offset)
+
+
+class TensorBatchLoader(object):
+    """
+    Drop-in replacement for a DataLoader over an in-memory TensorDataset.
+
+    Each epoch draws one random permutation and gathers every batch with a single
+    index_select (or a plain slice when not shuffling), instead of one __getitem__
+    per sample followed by default_collate.
+
+    With num_replicas > 1 it iterates over shard `rank` only, like a DataLoader with a
+    DistributedSampler: every rank draws the same permutation (seeded with seed plus
+    the epoch given to set_epoch) and takes every num_replicas-th sample of it. With
+    `even`, the permutation is padded by repeating its head so every rank gets the
+    same number of samples and batches, which DistributedDataParallel needs.
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, drop_last=False, generator=None,
+                 num_replicas=1, rank=0, even=True, seed=0):
+        self.dataset = dataset
+        self.tensors = dataset.tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.even = even
+        self.seed = seed
+        self.epoch = 0
+        # Stored float16 / int16 windows are turned back into float32 one batch at a time
+        self.dequantize = getattr(dataset, "dequantize", None)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def num_samples(self):
+        """Samples this rank iterates over per epoch."""
+        n = len(self.dataset)
+        if self.num_replicas == 1:
+            return n
+        if self.even:
+            return (n + self.num_replicas - 1) // self.num_replicas
+        return len(range(self.rank, n, self.num_replicas))
+
+    def __len__(self):
+        n = self.num_samples()
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def shard(self):
+        """This rank's sample indices for the current epoch."""
+        n = len(self.dataset)
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(n, generator=generator)
+        else:
+            indices = torch.arange(n)
+        if self.even:
+            total = self.num_samples() * self.num_replicas
+            indices = torch.cat([indices, indices[:total - n]])
+        return indices[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        for batch in self.batches():
+            if self.dequantize is not None:
+                batch = (self.dequantize(batch[0]),) + tuple(batch[1:])
+            yield batch
+
+    def batches(self):
+        stop = len(self) * self.batch_size
+        if self.num_replicas > 1:
+            indices = self.shard()
+            for start in range(0, stop, self.batch_size):
+                idx = indices[start:start + self.batch_size]
+                yield tuple(t.index_select(0, idx) for t in self.tensors)
+        elif self.shuffle:
+            perm = torch.randperm(len(self.dataset), generator=self.generator)
+            for start in range(0, stop, self.batch_size):
+                idx = perm[start:start + self.batch_size]
+                yield tuple(t.index_select(0, idx) for t in self.tensors)
+        else:
+            for start in range(0, stop, self.batch_size):
+                yield tuple(t[start:start + self.batch_size] for t in self.tensors)
+
+
+def _client_views(x, y, rows, desc):
+    """
+    The global (x, y) tensors of a fold, wrapping its memory-mapped cache blocks, and
+    a list of per-client (x, y) slices of them.
+
+    Nothing is copied: every window is stored once, in the page cache, and loading is
+    linear in the number of clients.
+    """
+    full_x, full_y = torch.from_numpy(x), torch.from_numpy(y)
+    views = []
+    with tqdm(total=len(rows), desc=desc) as pbar:
+        for client_rows in rows.values():
+            views.append((full_x[client_rows], full_y[client_rows]))
+            pbar.update(1)
+    return full_x, full_y, views
+
+
+def partition_indices(labels, client_num, partition_method="hetero", partition_alpha=0.5, seed=0):
+    """
+    Split sample indices between `client_num` simulated clients.
+
+    "homo" is a uniform random split; "hetero" gives every class to the clients in
+    Dirichlet(partition_alpha) proportions (label skew), as in FedML's non-IID split.
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.asarray(labels)
+    n = len(labels)
+    if partition_method == "homo":
+        return [np.sort(part) for part in np.array_split(rng.permutation(n), client_num)]
+
+    min_require = min(10, n // (2 * client_num))
+    for attempt in range(100):
+        idx_batch = [[] for _ in range(client_num)]
+        for k in np.unique(labels):
+            idx_k = rng.permutation(np.where(labels == k)[0])
+            proportions = rng.dirichlet(np.repeat(partition_alpha, client_num))
+            # Stop feeding clients that already hold their share of the data
+            proportions *= np.array([len(batch) < n / client_num for batch in idx_batch])
+            proportions /= proportions.sum()
+            cuts = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
+            for batch, part in zip(idx_batch, np.split(idx_k, cuts)):
+                batch.extend(part.tolist())
+        if min(len(batch) for batch in idx_batch) >= min_require:
+            break
+    else:
+        # Many clients and a small alpha: top up the smallest clients from the largest
+        for batch in idx_batch:
+            while len(batch) < max(min_require, 1):
+                batch.append(max(idx_batch, key=len).pop())
+    return [np.sort(np.array(batch, dtype=np.int64)) for batch in idx_batch]
+
+
+def load_partition_data_fed_wisdm2011(data_dir=None, batch_size=1,fold_idx=1, storage="float32"):
     print("load_partition_data_fed_wisdm2011 START")
     print("batch_size", batch_size)
     print("fold_idx", fold_idx)
     train_file_path = 'data/train/' + f"fold_{fold_idx}_train.json"
     test_file_path = 'data/test/' + f"fold_{fold_idx}_test.json"
-    with open(train_file_path, 'r') as train_f, open(test_file_path, 'r') as test_f:
-        train_data = json.load(train_f)
-        test_data = json.load(test_f)
-
-        client_ids_train = train_data[_USERS]
-        client_ids_test = test_data[_USERS]
-        client_num = len(client_ids_train)
-
-        full_x_train = torch.tensor([], dtype=torch.float32)
-        full_y_train = torch.tensor([], dtype=torch.int64)
-        full_x_test = torch.tensor([], dtype=torch.float32)
-        full_y_test = torch.tensor([], dtype=torch.int64)
-        train_data_local_dict = {}
-        test_data_local_dict = {}
-
-        # Process train data
-        with tqdm(total=len(client_ids_train), desc='train data') as pbar:
-            for i, client_id in enumerate(client_ids_train):
-                client_x = train_data[_USER_DATA][str(client_id)]['x']
-                client_y = train_data[_USER_DATA][str(client_id)]['y']
-
-                # client_x_win, client_y_win = reshape_to_windows(client_x, client_y)
-                client_x_win = torch.tensor(client_x, dtype=torch.float32)
-                client_y_win = torch.tensor(client_y, dtype=torch.int64)
-                train_ds = data.TensorDataset(client_x_win, client_y_win)
-                train_dl = data.DataLoader(train_ds, batch_size=batch_size, shuffle=True, drop_last=False)
-                train_data_local_dict[i] = train_dl
-
-                full_x_train = torch.cat((full_x_train, client_x_win), 0)
-                full_y_train = torch.cat((full_y_train, client_y_win), 0)
-                pbar.update(1)
-
-        # Process test data
-        with tqdm(total=len(client_ids_test), desc='test data') as pbar1:
-            for i, client_id in enumerate(client_ids_test):
-                client_x = test_data[_USER_DATA][str(client_id)]['x']
-                client_y = test_data[_USER_DATA][str(client_id)]['y']
-
-                # Convert to tensors
-                client_x_win = torch.tensor(client_x, dtype=torch.float32)
-                client_y_win = torch.tensor(client_y, dtype=torch.int64)
-
-                test_ds = data.TensorDataset(client_x_win, client_y_win)
-                test_dl = data.DataLoader(test_ds, batch_size=batch_size, shuffle=False, drop_last=False)
-                test_data_local_dict[i] = test_dl
-
-                full_x_test = torch.cat((full_x_test, client_x_win), 0)
-                full_y_test = torch.cat((full_y_test, client_y_win), 0)
-                pbar1.update(1)
-
-        # Global datasets
-        train_ds = data.TensorDataset(full_x_train, full_y_train)
-        test_ds = data.TensorDataset(full_x_test, full_y_test)
-        train_data_global = data.DataLoader(train_ds, batch_size=batch_size, shuffle=True, drop_last=False)
-        test_data_global = data.DataLoader(test_ds, batch_size=batch_size, shuffle=False, drop_last=False)
-
-        train_data_num = len(train_data_global.dataset)
-        test_data_num = len(test_data_global.dataset)
-        print("train_data_num:", train_data_num)
-        print("test_data_num:", test_data_num)
-        data_local_num_dict = {i: len(train_data_local_dict[i].dataset) for i in train_data_local_dict}
-        output_dim = 6  # WISDM classes
+    x_train, y_train, rows_train, train_quantization = load_fold_cache(train_file_path, storage)
+    x_test, y_test, rows_test, test_quantization = load_fold_cache(test_file_path, storage)
+
+    client_num = len(rows_train)
+
+    train_data_local_dict = {}
+    test_data_local_dict = {}
+
+    # Process train data
+    full_x_train, full_y_train, train_views = _client_views(x_train, y_train, rows_train, 'train data')
+    for i, (client_x_win, client_y_win) in enumerate(train_views):
+        train_ds = WindowDataset(client_x_win, client_y_win, *train_quantization)
+        train_dl = TensorBatchLoader(train_ds, batch_size=batch_size, shuffle=True, drop_last=False)
+        train_data_local_dict[i] = train_dl
+
+    # Process test data
+    full_x_test, full_y_test, test_views = _client_views(x_test, y_test, rows_test, 'test data')
+    for i, (client_x_win, client_y_win) in enumerate(test_views):
+        test_ds = WindowDataset(client_x_win, client_y_win, *test_quantization)
+        test_dl = TensorBatchLoader(test_ds, batch_size=batch_size, shuffle=False, drop_last=False)
+        test_data_local_dict[i] = test_dl
+
+    # Global datasets
+    train_ds = WindowDataset(full_x_train, full_y_train, *train_quantization)
+    test_ds = WindowDataset(full_x_test, full_y_test, *test_quantization)
+    train_data_global = TensorBatchLoader(train_ds, batch_size=batch_size, shuffle=True, drop_last=False)
+    test_data_global = TensorBatchLoader(test_ds, batch_size=batch_size, shuffle=False, drop_last=False)
+
+    train_data_num = len(train_data_global.dataset)
+    test_data_num = len(test_data_global.dataset)
+    print("train_data_num:", train_data_num)
+    print("test_data_num:", test_data_num)
+    data_local_num_dict = {i: len(train_data_local_dict[i].dataset) for i in train_data_local_dict}
+    output_dim = 6  # WISDM classes
 
     return client_num, train_data_num, test_data_num, train_data_global, test_data_global, \
         data_local_num_dict, train_data_local_dict, test_data_local_dict, output_dim
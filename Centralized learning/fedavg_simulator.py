@@ -0,0 +1,225 @@
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from checkpoint import CheckpointWriter, rng_state, set_rng_state
+# metrics.py is shared with the CoAP server and lives next to it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Federated learning",
+                                "Server Binaries and Source Code"))
+from metrics import MetricsRecorder
+from schedules import EarlyStopping
+
+
+class FedAvgSimulator(object):
+    """
+    FedAvg simulation of the FedCoRE clients on one CPU.
+
+    Every selected client's copy of the SimpleMLP is held in stacked weight tensors
+    (clients x out x in), so one local SGD step for all clients is a pair of batched
+    matmuls. After `epochs` local epochs the copies are averaged, weighted by
+    train_data_local_num_dict, into the global model.
+    """
+
+    def __init__(self, dataset, model, device, args):
+        self.device = device
+        self.args = args
+
+        [train_data_num, test_data_num, train_data_global, test_data_global,
+         train_data_local_num_dict, train_data_local_dict, test_data_local_dict, class_num] = dataset
+
+        if self.args.client_optimizer != "sgd":
+            raise ValueError("FedAvg simulation only supports client_optimizer=sgd, got %s"
+                             % self.args.client_optimizer)
+
+        self.test_global = test_data_global
+        self.model = model.to(self.device)
+        self.client_ids = sorted(train_data_local_dict)
+        self.local_num = torch.tensor([train_data_local_num_dict[c] for c in self.client_ids],
+                                      dtype=torch.float32, device=self.device)
+
+        # All clients' windows in one buffer; client c owns rows offsets[c]:offsets[c] + local_num[c]
+        xs, ys = zip(*(train_data_local_dict[c].dataset.tensors for c in self.client_ids))
+        # Kept in the fold's storage dtype; each step's batch is dequantized on its own
+        self.x = torch.cat([x.reshape(x.size(0), -1) for x in xs]).to(self.device)
+        self.dequantize = getattr(train_data_local_dict[self.client_ids[0]].dataset, "dequantize", None)
+        self.y = torch.cat(ys).to(self.device)
+        sizes = self.local_num.long()
+        self.offsets = torch.cumsum(sizes, 0) - sizes
+
+        self.lr = self.args.lr
+        self.momentum = getattr(self.args, "momentum", 0.9)
+        self.best_test_acc = 0.0
+        self.final_test_acc = 0.0
+        self.metrics = MetricsRecorder(getattr(self.args, "metrics_path", "") or None, keep=["test", "stop"])
+        self.checkpoints = CheckpointWriter(getattr(self.args, "state_path", "train_state.pth"),
+                                            getattr(self.args, "keep_checkpoints", 2))
+        self.start_round = 0
+        # --target_acc / --patience end the simulation before --comm_round
+        self.stopper = EarlyStopping(getattr(self.args, "target_acc", 0.0), getattr(self.args, "patience", 0),
+                                     getattr(self.args, "min_delta", 0.0))
+        self.stop_reason = None
+        self.rounds_run = 0
+
+    def client_sampling(self, round_idx):
+        """Same sampling as FedML's FedAvg: seeded by the round, without replacement."""
+        client_num_in_total = len(self.client_ids)
+        client_num_per_round = min(self.args.client_num_per_round, client_num_in_total)
+        if client_num_per_round == client_num_in_total:
+            return np.arange(client_num_in_total)
+        np.random.seed(round_idx)
+        return np.sort(np.random.choice(range(client_num_in_total), client_num_per_round, replace=False))
+
+    def train(self):
+        if getattr(self.args, "resume", 0):
+            self.resume()
+        try:
+            self.train_rounds()
+        finally:
+            self.checkpoints.close()
+
+    def train_rounds(self):
+        train_start = time.perf_counter()
+        for round_idx in range(self.start_round, self.args.comm_round):
+            selected = torch.as_tensor(self.client_sampling(round_idx), device=self.device)
+            logging.info("[Round %d] %d clients" % (round_idx, len(selected)))
+
+            start = time.perf_counter()
+            weights = self.local_train(selected)
+            local_seconds = time.perf_counter() - start
+            self.aggregate(weights, self.local_num[selected])
+            self.metrics.record("round", round=round_idx, clients=len(selected), local_train=local_seconds,
+                                aggregate=time.perf_counter() - start - local_seconds)
+
+            if (round_idx + 1) % max(1, getattr(self.args, "frequency_of_test_acc_report", 1)) == 0 \
+                    or round_idx == self.args.comm_round - 1:
+                test_acc = self.eval_and_log(round_idx)
+                self.metrics.record("test", round=round_idx, elapsed=time.perf_counter() - train_start, acc=test_acc)
+                self.stop_reason = self.stopper.update(round_idx, test_acc)
+            self.rounds_run = round_idx + 1
+            if self.stop_reason or (round_idx + 1) % max(1, getattr(self.args, "checkpoint_frequency", 1)) == 0 \
+                    or round_idx == self.args.comm_round - 1:
+                # Local momentum restarts every round, so the global model is the whole state
+                self.checkpoints.save_state({"round": round_idx, "model": self.model.state_dict(),
+                                             "stopper": self.stopper.state_dict(),
+                                             "best_test_acc": self.best_test_acc,
+                                             "final_test_acc": self.final_test_acc, "rng": rng_state()}, round_idx)
+            if self.stop_reason:
+                break
+        seconds = time.perf_counter() - train_start
+        self.metrics.record("stop", round=self.rounds_run - 1, reason=self.stop_reason or "rounds", seconds=seconds,
+                            final_test_acc=self.final_test_acc, best_test_acc=self.best_test_acc)
+        logging.info("stopped after %d/%d rounds, %.1fs: %s (best %.2f%%, final %.2f%%)"
+                     % (self.rounds_run, self.args.comm_round, seconds,
+                        self.stopper.describe(self.stop_reason, "rounds"), self.best_test_acc, self.final_test_acc))
+        self.metrics.close()
+
+    def resume(self):
+        if self.checkpoints.latest() is None:
+            logging.info("no training state to resume from, starting at round 0")
+            return
+        state = self.checkpoints.load()
+        self.model.load_state_dict(state["model"])
+        self.best_test_acc = state["best_test_acc"]
+        self.final_test_acc = state["final_test_acc"]
+        if "stopper" in state:
+            self.stopper.load_state_dict(state["stopper"])
+        self.start_round = state["round"] + 1
+        set_rng_state(state["rng"])
+        logging.info("resumed after round %d, best test accuracy %.2f%%" % (state["round"], self.best_test_acc))
+
+    def stacked_global_weights(self, client_num):
+        """The global model's (fc1.weight, fc1.bias, fc2.weight, fc2.bias), one copy per client."""
+        params = [self.model.fc1.weight, self.model.fc1.bias, self.model.fc2.weight, self.model.fc2.bias]
+        return [p.detach().unsqueeze(0).repeat(client_num, *([1] * p.dim())).requires_grad_()
+                for p in params]
+
+    def epoch_batches(self, selected):
+        """
+        Shuffle every selected client's rows for one epoch.
+
+        Returns (idx, mask) of shape (clients, steps, batch_size): idx indexes self.x and
+        mask marks real samples, since clients with less data run out of batches first.
+        """
+        batch_size = self.args.batch_size
+        sizes = self.local_num[selected].long()
+        steps = int((sizes.max() + batch_size - 1) // batch_size)
+        width = steps * batch_size
+
+        # A random key per slot, with padding slots pushed to the end, gives a
+        # per-client permutation of 0..size-1 followed by the padding.
+        slot = torch.arange(width, device=self.device).expand(len(selected), width)
+        keys = torch.rand(len(selected), width, device=self.device)
+        keys = keys.masked_fill(slot >= sizes.unsqueeze(1), 2.0)
+        perm = keys.argsort(dim=1)
+        mask = slot < sizes.unsqueeze(1)
+        idx = torch.where(mask, perm + self.offsets[selected].unsqueeze(1), torch.zeros_like(perm))
+        return idx.view(len(selected), steps, batch_size), mask.view(len(selected), steps, batch_size)
+
+    def local_train(self, selected):
+        """Run `epochs` local epochs of momentum SGD on every selected client at once."""
+        w1, b1, w2, b2 = weights = self.stacked_global_weights(len(selected))
+        velocity = [torch.zeros_like(w) for w in weights]
+
+        for epoch in range(self.args.epochs):
+            idx, mask = self.epoch_batches(selected)
+            for step in range(idx.size(1)):
+                step_mask = mask[:, step].float()
+                count = step_mask.sum(1)
+                active = count > 0
+
+                x = self.x[idx[:, step]]
+                if self.dequantize is not None:
+                    x = self.dequantize(x)
+                hidden = torch.relu(torch.baddbmm(b1.unsqueeze(1), x, w1.transpose(1, 2)))
+                out = torch.baddbmm(b2.unsqueeze(1), hidden, w2.transpose(1, 2))
+                loss = F.cross_entropy(out.flatten(0, 1), self.y[idx[:, step]].flatten(), reduction='none')
+                # Sum of the clients' mean batch losses: each client's gradient is its own
+                loss = ((loss.view_as(step_mask) * step_mask).sum(1) / count.clamp(min=1)).sum()
+                grads = torch.autograd.grad(loss, weights)
+
+                with torch.no_grad():
+                    for w, g, v in zip(weights, grads, velocity):
+                        a = active.float().view(-1, *([1] * (w.dim() - 1)))
+                        # Clients without a batch this step keep their weights and momentum
+                        v.mul_(1 + a * (self.momentum - 1)).add_(g)
+                        w.sub_(self.lr * a * v)
+        return [w.detach() for w in weights]
+
+    def aggregate(self, weights, sample_num):
+        """Weighted average of the clients' stacked weights into the global model."""
+        alpha = sample_num / sample_num.sum()
+        params = [self.model.fc1.weight, self.model.fc1.bias, self.model.fc2.weight, self.model.fc2.bias]
+        with torch.no_grad():
+            for p, w in zip(params, weights):
+                p.copy_(torch.tensordot(alpha, w, dims=1))
+
+    def eval_and_log(self, round_idx):
+        test_loss, test_acc = self.compute_metrics(self.test_global)
+        logging.info(f"[Round {round_idx}] Test Accuracy={test_acc:.2f}%, Loss={test_loss:.4f}")
+        self.final_test_acc = test_acc
+        if test_acc > self.best_test_acc:
+            self.best_test_acc = test_acc
+            self.checkpoints.save(self.model.state_dict(), getattr(self.args, "checkpoint_path", "best_model.pth"))
+            logging.info(f"New best model saved with Test Accuracy={test_acc:.2f}%")
+        return test_acc
+
+    def compute_metrics(self, dataloader):
+        """Compute average loss and accuracy of the global model for a given dataloader."""
+        self.model.eval()
+        correct = torch.zeros((), dtype=torch.int64, device=self.device)
+        loss_sum = torch.zeros((), device=self.device)
+        total = 0
+        with torch.no_grad():
+            for x, labels in dataloader:
+                x = x.view(x.size(0), -1).to(self.device)
+                labels = labels.to(self.device)
+                outputs = self.model(x)
+                loss_sum += F.cross_entropy(outputs, labels)
+                correct += (outputs.argmax(1) == labels).sum()
+                total += labels.size(0)
+        return loss_sum.item() / len(dataloader), 100.0 * correct.item() / total
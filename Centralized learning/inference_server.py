@@ -0,0 +1,242 @@
+'''
+HAR inference service for a trained SimpleMLP.
+
+Loads the checkpoint once and answers classification requests over TCP (or a Unix
+socket with --unix). A request is one line of JSON holding one raw (unnormalized)
+30x3 accelerometer window, or a list of them:
+
+    {"id": 7, "window": [[x, y, z], ...]}
+    {"id": 8, "windows": [[[x, y, z], ...], ...]}
+
+and its response is one line with the predicted labels and activity names, in the
+order of the windows:
+
+    {"id": 7, "labels": [5], "activities": ["Walking"]}
+
+Windows are normalized on the server with the fold's training stats
+(train/fold_N_stats.json, written by generate_json_data.py). Concurrent requests are
+coalesced into micro-batches of up to --max_batch windows: a batch is run as soon as
+it is full, or --max_wait_ms after its first window arrived. --max_batch 1 runs one
+forward pass per request:
+
+    python inference_server.py --checkpoint_path best_model.pth --fold_idx 2 --port 8750 --max_batch 64 --max_wait_ms 2
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+from main import create_model
+# metrics.py is shared with the CoAP server and lives next to it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Federated learning",
+                                "Server Binaries and Source Code"))
+from metrics import MetricsRecorder
+
+N_TIME_STEPS = 30
+N_AXES = 3
+
+# LabelEncoder order of generate_json_data.py
+ACTIVITIES = ["Downstairs", "Jogging", "Sitting", "Standing", "Upstairs", "Walking"]
+
+
+def load_model(checkpoint_path):
+    """SimpleMLP from a best-model state_dict, sized from the checkpoint's weights."""
+    state = torch.load(checkpoint_path, map_location="cpu")
+    hidden_nodes, output_dim = state["fc1.weight"].shape[0], state["fc2.weight"].shape[0]
+    model = create_model(argparse.Namespace(hidden_nodes=hidden_nodes), "simple_mlp", output_dim)
+    model.load_state_dict(state)
+    model.eval()
+    return model
+
+
+def load_stats(stats_path):
+    """Per-axis (mean, std) of a fold's training windows; None when the file is missing."""
+    if not os.path.exists(stats_path):
+        return None
+    with open(stats_path) as f:
+        stats = json.load(f)
+    return np.asarray(stats["mean"], dtype=np.float32), np.asarray(stats["std"], dtype=np.float32)
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent predict() calls into forward passes of up to max_batch windows."""
+
+    def __init__(self, model, stats=None, max_batch=64, max_wait=0.002, metrics=None):
+        self.model = model
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.pending = deque()
+        self.pending_windows = 0
+        self.wakeup = asyncio.Event()
+        self.full = asyncio.Event()
+
+    async def predict(self, windows):
+        """Labels of a (n, 30, 3) array of raw windows."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((windows, future, time.perf_counter()))
+        self.pending_windows += len(windows)
+        self.wakeup.set()
+        if self.pending_windows >= self.max_batch:
+            self.full.set()
+        return await future
+
+    def take(self):
+        """Pop the oldest requests, up to max_batch windows but at least one request."""
+        batch, windows = [], 0
+        while self.pending and (not batch or windows + len(self.pending[0][0]) <= self.max_batch):
+            request = self.pending.popleft()
+            batch.append(request)
+            windows += len(request[0])
+        self.pending_windows -= windows
+        if not self.pending:
+            self.wakeup.clear()
+        if self.pending_windows < self.max_batch:
+            self.full.clear()
+        return batch
+
+    def forward(self, x):
+        if self.stats is not None:
+            mean, std = self.stats
+            x = (x - mean) / (std + 1e-8)
+        with torch.no_grad():
+            logits = self.model(torch.from_numpy(x.reshape(len(x), -1)))
+        return logits.argmax(dim=1).numpy()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            if self.pending_windows < self.max_batch and self.max_wait > 0:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self.take()
+            start = time.perf_counter()
+            try:
+                labels = self.forward(np.concatenate([windows for windows, _, _ in batch]))
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            seconds = time.perf_counter() - start
+            offset = 0
+            for windows, future, _ in batch:
+                if not future.done():
+                    future.set_result(labels[offset:offset + len(windows)])
+                offset += len(windows)
+            if self.metrics is not None:
+                self.metrics.record("batch", requests=len(batch), windows=len(labels), seconds=seconds,
+                                    queued=start - batch[0][2])
+
+
+def request_windows(request):
+    """The (n, 30, 3) float32 windows of a decoded request."""
+    windows = request["windows"] if "windows" in request else [request["window"]]
+    return np.asarray(windows, dtype=np.float32).reshape(len(windows), N_TIME_STEPS, N_AXES)
+
+
+class InferenceServer(object):
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def answer(self, line, writer):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            labels = await self.batcher.predict(request_windows(request))
+            response = {"id": request_id, "labels": labels.tolist(),
+                        "activities": [ACTIVITIES[i] if i < len(ACTIVITIES) else str(i) for i in labels]}
+        except Exception as e:
+            response = {"id": request_id, "error": "%s: %s" % (type(e).__name__, e)}
+        writer.write(json.dumps(response).encode() + b"\n")
+
+    async def handle(self, reader, writer):
+        # Requests of a connection are answered as their batches complete; match them by id
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(self.answer(line, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    model = load_model(args.checkpoint_path)
+    stats_path = args.stats_path or os.path.join(args.data_dir, "train", "fold_%d_stats.json" % args.fold_idx)
+    stats = load_stats(stats_path)
+    if stats is None:
+        logging.warning("%s not found; windows are expected to be normalized already" % stats_path)
+    # Batch events are only kept with --metrics_path; the recorder holds them in memory
+    metrics = MetricsRecorder(args.metrics_path) if args.metrics_path else None
+    batcher = MicroBatcher(model, stats, args.max_batch, args.max_wait_ms / 1000.0, metrics)
+    server = InferenceServer(batcher)
+    if args.unix:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix)
+        logging.info("Serving %s on %s" % (args.checkpoint_path, args.unix))
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        logging.info("Serving %s on %s:%d" % (args.checkpoint_path, args.host, args.port))
+    logging.info("Micro-batches of up to %d windows, waiting up to %.1f ms" % (args.max_batch, args.max_wait_ms))
+    batching = asyncio.ensure_future(batcher.run())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        batching.cancel()
+        if metrics is not None:
+            batches = metrics.summary("batch")
+            if batches:
+                summary = batches[None]
+                logging.info("%d batches, %.1f windows/batch, forward p50 %.3f ms / p99 %.3f ms" % (
+                    summary["count"], summary["windows"]["mean"], 1000 * summary["seconds"]["p50"],
+                    1000 * summary["seconds"]["p99"]))
+            metrics.close()
+
+
+def add_args(parser):
+    parser.add_argument('--checkpoint_path', type=str, default='best_model.pth', help='SimpleMLP best model')
+    parser.add_argument('--fold_idx', type=int, default=1, help='fold whose normalization stats are applied')
+    parser.add_argument('--data_dir', type=str, default='data', help='directory holding train/fold_N_stats.json')
+    parser.add_argument('--stats_path', type=str, default='', help='normalization stats (overrides --fold_idx)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8750, help='TCP port to listen on')
+    parser.add_argument('--unix', type=str, default='', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--max_batch', type=int, default=64, help='windows per forward pass (1: no batching)')
+    parser.add_argument('--max_wait_ms', type=float, default=2.0,
+                        help='how long a batch waits for more windows after its first one')
+    parser.add_argument('--num_threads', type=int, default=1, help='torch intra-op threads')
+    parser.add_argument('--metrics_path', type=str, default='', help='record batch events to this JSONL/CSV file')
+    return parser
+
+
+if __name__ == "__main__":
+    args = add_args(argparse.ArgumentParser()).parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    torch.set_num_threads(args.num_threads)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -1,9 +1,12 @@
 import argparse
 import logging
+import multiprocessing
 import os
 import random
 import socket
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import psutil
@@ -12,7 +15,9 @@ import torch
 from torch.nn.parallel import DistributedDataParallel
 
 from centralized_trainer import CentralizedTrainer
-from data_loader import load_partition_data_fed_wisdm2011
+from data_loader import TensorBatchLoader, load_partition_data_fed_wisdm2011, partition_indices
+from fedavg_simulator import FedAvgSimulator
+from schedules import SCHEDULES
 
 
 
@@ -26,7 +31,10 @@ def add_args(parser):
                         help='neural network used in training')
 
     parser.add_argument('--data_parallel', type=int, default=0,
-                        help='if distributed training')
+                        help='1: data-parallel training with one process per rank, launched by torchrun')
+
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'],
+                        help='torch.distributed backend of --data_parallel (gloo: CPU, nccl: one GPU per rank)')
 
     parser.add_argument('--dataset', type=str, default='fed_wisdm2011', metavar='N',
                         help='dataset used for training')
@@ -57,11 +65,35 @@ def add_args(parser):
 
     parser.add_argument('--wd', help='weight decay parameter;', type=float, default=0.001)
 
+    parser.add_argument('--lr_schedule', type=str, default='constant', choices=SCHEDULES,
+                        help='learning-rate schedule over --epochs (onecycle peaks at --lr)')
+
+    parser.add_argument('--lr_step_size', type=int, default=30,
+                        help='step schedule: epochs between learning-rate drops')
+
+    parser.add_argument('--lr_gamma', type=float, default=0.1,
+                        help='step schedule: factor of each learning-rate drop')
+
+    parser.add_argument('--target_acc', type=float, default=0,
+                        help='stop once the test accuracy (%%) reaches this; 0 trains for the full --epochs')
+
+    parser.add_argument('--patience', type=int, default=0,
+                        help='stop after this many epochs (rounds) without a test accuracy improvement; 0 never')
+
+    parser.add_argument('--min_delta', type=float, default=0.0,
+                        help='smallest test accuracy gain (%%) that counts as an improvement for --patience')
+
+    parser.add_argument('--storage', type=str, default='float32', choices=['float32', 'float16', 'int16'],
+                        help='how windows are stored in the fold cache and in memory (int16: per-axis scale/offset)')
+
+    parser.add_argument('--hidden_nodes', type=int, default=40,
+                        help='hidden layer width of simple_mlp (the firmware uses 40)')
+
     parser.add_argument('--epochs', type=int, default=100, metavar='EP',
                         help='how many epochs will be trained locally')
 
     parser.add_argument('--comm_round', type=int, default=0,
-                        help='how many round of communications we shoud use')
+                        help='how many round of communications we shoud use; > 0 runs the FedAvg simulation')
 
     parser.add_argument('--is_mobile', type=int, default=0,
                         help='whether the program is running on the FedML-Mobile server side')
@@ -90,18 +122,43 @@ def add_args(parser):
     parser.add_argument('--local_rank', type=int, default=0,
                         help='given by torch.distributed.launch')
 
+    parser.add_argument('--fold_idx', type=int, default=2,
+                        help='cross-validation fold used for a single run')
+
+    parser.add_argument('--folds', type=str, default='',
+                        help='run cross-validation on these folds concurrently, e.g. 1-5 or 1,3,5')
+
+    parser.add_argument('--checkpoint_path', type=str, default='best_model.pth',
+                        help='where the best model is saved')
+
+    parser.add_argument('--state_path', type=str, default='train_state.pth',
+                        help='resumable training state; saved as <name>_epoch<N>.pth')
+
+    parser.add_argument('--checkpoint_frequency', type=int, default=1,
+                        help='save the training state every this many epochs (rounds)')
+
+    parser.add_argument('--keep_checkpoints', type=int, default=2,
+                        help='how many training states to keep')
+
+    parser.add_argument('--resume', type=int, default=0,
+                        help='continue from the newest training state under --state_path')
+
+    parser.add_argument('--metrics_path', type=str, default='',
+                        help='JSONL (or .csv) file receiving epoch, batch and round timing events')
+
 
     args = parser.parse_args()
     return args
 
 
-def load_data(dataset_name): #modified
+def load_data(args, dataset_name, fold_idx): #modified
     args_batch_size = args.batch_size
     if dataset_name == "fed_wisdm2011":
-        logging.info("load_data. dataset_name = %s" % dataset_name)
+        logging.info("load_data. dataset_name = %s, fold_idx = %d" % (dataset_name, fold_idx))
         client_num, train_data_num, test_data_num, train_data_global, test_data_global, \
             train_data_local_num_dict, train_data_local_dict, test_data_local_dict, \
-        class_num = load_partition_data_fed_wisdm2011(batch_size=args.batch_size,fold_idx=2)
+        class_num = load_partition_data_fed_wisdm2011(batch_size=args.batch_size,fold_idx=fold_idx,
+                                                      storage=getattr(args, "storage", "float32"))
 
         """
         For shallow NN or linear models, 
@@ -135,17 +192,117 @@ class SimpleMLP(nn.Module):
         return x
 
 
+def partition_clients(args, dataset, client_num):
+    """Re-split the global training set between `client_num` simulated clients."""
+    [train_data_num, test_data_num, train_data_global, test_data_global,
+     train_data_local_num_dict, train_data_local_dict, test_data_local_dict, class_num] = dataset
+    y = train_data_global.dataset.tensors[1]
+    parts = partition_indices(y.numpy(), client_num, args.partition_method, args.partition_alpha)
+    train_data_local_dict = {}
+    for i, idx in enumerate(parts):
+        idx = torch.from_numpy(idx)
+        local_ds = train_data_global.dataset.subset(idx)
+        train_data_local_dict[i] = TensorBatchLoader(local_ds, batch_size=args.batch_size, shuffle=True)
+    train_data_local_num_dict = {i: len(parts[i]) for i in train_data_local_dict}
+    logging.info("partitioned %d samples between %d clients (%s, alpha=%s), min/max = %d/%d"
+                 % (train_data_num, client_num, args.partition_method, args.partition_alpha,
+                    min(train_data_local_num_dict.values()), max(train_data_local_num_dict.values())))
+    args.client_num_in_total = client_num
+    return [train_data_num, test_data_num, train_data_global, test_data_global,
+            train_data_local_num_dict, train_data_local_dict, {}, class_num]
+
+
+def shard_dataset(args, dataset):
+    """
+    Replace the global loaders with this rank's shards, for --data_parallel.
+
+    --batch_size stays the global batch: each rank trains on its share of it, and
+    DistributedDataParallel averages the gradients, so one step matches one
+    single-process step on the same samples.
+    """
+    [train_data_num, test_data_num, train_data_global, test_data_global,
+     train_data_local_num_dict, train_data_local_dict, test_data_local_dict, class_num] = dataset
+    batch_size = max(1, -(-args.batch_size // args.world_size))
+    train_data_global = TensorBatchLoader(train_data_global.dataset, batch_size=batch_size, shuffle=True,
+                                          num_replicas=args.world_size, rank=args.rank)
+    # Test shards are not padded, so every window is counted once in the all-reduced metrics
+    test_data_global = TensorBatchLoader(test_data_global.dataset, batch_size=batch_size, shuffle=False,
+                                         num_replicas=args.world_size, rank=args.rank, even=False)
+    logging.info("rank %d/%d: %d train windows in %d batches of %d" % (
+        args.rank, args.world_size, train_data_global.num_samples(), len(train_data_global), batch_size))
+    return [train_data_num, test_data_num, train_data_global, test_data_global,
+            train_data_local_num_dict, train_data_local_dict, test_data_local_dict, class_num]
+
+
 def create_model(args, model_name, output_dim):
     logging.info("create_model. model_name = %s, output_dim = %s" % (model_name, output_dim))
     model = None
 
     if model_name == "simple_mlp":
-        logging.info("Simple MLP (90-40-6)")
-        model = SimpleMLP(input_nodes=90, hidden_nodes=40, output_nodes=output_dim)
+        hidden_nodes = getattr(args, "hidden_nodes", 40)
+        logging.info("Simple MLP (90-%d-%d)" % (hidden_nodes, output_dim))
+        model = SimpleMLP(input_nodes=90, hidden_nodes=hidden_nodes, output_nodes=output_dim)
 
     return model
 
 
+def parse_folds(folds):
+    """Parse a fold list such as "1-5" or "1,3-5" into [1, 3, 4, 5]."""
+    fold_ids = []
+    for part in folds.split(','):
+        first, _, last = part.strip().partition('-')
+        fold_ids.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(fold_ids))
+
+
+def run_fold(args, fold_idx, num_threads):
+    """Train one fold in a worker process and return its accuracy summary."""
+    torch.set_num_threads(num_threads)
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    root, ext = os.path.splitext(args.checkpoint_path)
+    args.checkpoint_path = "%s_fold%d%s" % (root, fold_idx, ext)
+    root, ext = os.path.splitext(args.state_path)
+    args.state_path = "%s_fold%d%s" % (root, fold_idx, ext)
+    if args.metrics_path:
+        root, ext = os.path.splitext(args.metrics_path)
+        args.metrics_path = "%s_fold%d%s" % (root, fold_idx, ext)
+
+    start = time.time()
+    dataset = load_data(args, "fed_wisdm2011", fold_idx)
+    model = create_model(args, model_name=args.model, output_dim=dataset[-1])
+    trainer = CentralizedTrainer(dataset, model, torch.device("cpu"), args)
+    trainer.train()
+    return {"fold": fold_idx, "best_test_acc": trainer.best_test_acc,
+            "final_test_acc": trainer.final_test_acc, "seconds": time.time() - start,
+            "epochs": trainer.epochs_run, "checkpoint": args.checkpoint_path}
+
+
+def run_cross_validation(args, fold_ids):
+    """Train every fold concurrently, one process per fold, and print a summary table."""
+    workers = max(1, min(len(fold_ids), os.cpu_count() or 1))
+    # Split the cores between the workers so their intra-op thread pools don't oversubscribe
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    logging.info("cross-validation on folds %s: %d processes x %d threads" % (fold_ids, workers, num_threads))
+
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        futures = [pool.submit(run_fold, args, fold_idx, num_threads) for fold_idx in fold_ids]
+        results = [future.result() for future in futures]
+
+    best = np.array([r["best_test_acc"] for r in results])
+    final = np.array([r["final_test_acc"] for r in results])
+    print("%-6s %14s %15s %10s %8s  %s" % ("fold", "best test acc", "final test acc", "time (s)", "epochs",
+                                           "checkpoint"))
+    for r in results:
+        print("%-6d %13.2f%% %14.2f%% %10.1f %8d  %s" % (r["fold"], r["best_test_acc"], r["final_test_acc"],
+                                                         r["seconds"], r["epochs"], r["checkpoint"]))
+    print("%-6s %6.2f ± %5.2f%% %7.2f ± %5.2f%%" % ("mean", best.mean(), best.std(), final.mean(), final.std()))
+    return results
+
+
 if __name__ == "__main__":
 
     # parse python script input parameters
@@ -156,15 +313,17 @@ if __name__ == "__main__":
     process_id = 0
 
     if args.data_parallel == 1:
-        # torch.distributed.init_process_group(
-        #         backend="nccl", world_size=args.world_size, init_method="env://")
+        if args.folds or args.comm_round > 0:
+            parser.error("--data_parallel trains a single fold centrally; drop --folds and --comm_round")
+        # Rank, world size and rendezvous address come from torchrun's environment
         torch.distributed.init_process_group(
-                backend="nccl", init_method="env://")
+                backend=args.dist_backend, init_method="env://")
         args.rank = torch.distributed.get_rank()
-        gpu_util = args.gpu_util.split(',')
-        gpu_util = [int(item.strip()) for item in gpu_util]
-        # device = torch.device("cuda", local_rank)
-        torch.cuda.set_device(gpu_util[args.rank])
+        args.world_size = torch.distributed.get_world_size()
+        if args.dist_backend == "nccl":
+            gpu_util = args.gpu_util.split(',')
+            gpu_util = [int(item.strip()) for item in gpu_util]
+            torch.cuda.set_device(gpu_util[args.rank])
         process_id = args.rank
     else:
         args.rank = 0
@@ -181,6 +340,9 @@ if __name__ == "__main__":
                         format=str(
                             process_id) + ' - %(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
                         datefmt='%a, %d %b %Y %H:%M:%S')
+    if process_id != 0:
+        # The metrics are all-reduced, so rank 0's log lines stand for every rank
+        logging.getLogger().setLevel(logging.WARNING)
     hostname = socket.gethostname()
     logging.info("#############process ID = " + str(process_id) +
                  ", host name = " + hostname + "########" +
@@ -194,13 +356,38 @@ if __name__ == "__main__":
 
     logging.info("process_id = %d, size = %d" % (process_id, args.world_size))
 
+    if args.folds:
+        run_cross_validation(args, parse_folds(args.folds))
+        sys.exit(0)
+
     # load data
-    dataset = load_data("fed_wisdm2011")
+    requested_client_num = args.client_num_in_total
+    # Rank 0 builds the fold cache before the other ranks map it
+    if args.data_parallel == 1 and args.rank != 0:
+        torch.distributed.barrier()
+    dataset = load_data(args, "fed_wisdm2011", args.fold_idx)
+    if args.data_parallel == 1 and args.rank == 0:
+        torch.distributed.barrier()
+    if args.comm_round > 0 and requested_client_num > args.client_num_in_total:
+        dataset = partition_clients(args, dataset, requested_client_num)
     [train_data_num, test_data_num, train_data_global, test_data_global,
      train_data_local_num_dict, train_data_local_dict, test_data_local_dict, class_num] = dataset
     print("class_num= ",class_num)
     model = create_model(args, model_name=args.model, output_dim=dataset[-1])
 
     device = torch.device("cpu")
-    single_trainer = CentralizedTrainer(dataset, model, device, args)
-    single_trainer.train()
+    if args.data_parallel == 1:
+        dataset = shard_dataset(args, dataset)
+        if args.dist_backend == "nccl":
+            device = torch.device("cuda", torch.cuda.current_device())
+            model = DistributedDataParallel(model.to(device), device_ids=[device.index])
+        else:
+            model = DistributedDataParallel(model)
+    if args.comm_round > 0:
+        simulator = FedAvgSimulator(dataset, model, device, args)
+        simulator.train()
+    else:
+        single_trainer = CentralizedTrainer(dataset, model, device, args)
+        single_trainer.train()
+    if args.data_parallel == 1:
+        torch.distributed.destroy_process_group()
@@ -0,0 +1,74 @@
+'''
+Learning-rate schedules and early stopping for CentralizedTrainer and FedAvgSimulator.
+
+--lr_schedule picks the schedule of --lr over the --epochs budget:
+
+    constant  --lr throughout
+    step      multiplied by --lr_gamma every --lr_step_size epochs
+    cosine    cosine decay from --lr to 0 at the last epoch
+    onecycle  warm-up to --lr over the first 30% of the steps, then annealing to ~0,
+              updated after every batch
+
+EarlyStopping ends a run when the test accuracy reaches --target_acc, or when it
+has not improved by more than --min_delta for --patience epochs (rounds).
+'''
+
+import torch
+
+SCHEDULES = ["constant", "step", "cosine", "onecycle"]
+
+
+def make_scheduler(optimizer, args, steps_per_epoch):
+    """(scheduler, per_batch) for --lr_schedule; scheduler is None for constant."""
+    schedule = getattr(args, "lr_schedule", "constant")
+    epochs = args.epochs
+    if schedule == "step":
+        return torch.optim.lr_scheduler.StepLR(optimizer, step_size=getattr(args, "lr_step_size", 30),
+                                               gamma=getattr(args, "lr_gamma", 0.1)), False
+    if schedule == "cosine":
+        return torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(1, epochs)), False
+    if schedule == "onecycle":
+        # The optimizer's momentum is cycled against the learning rate as well
+        return torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=args.lr,
+                                                   total_steps=max(1, epochs * steps_per_epoch)), True
+    if schedule != "constant":
+        raise ValueError("unknown lr_schedule %s, expected one of %s" % (schedule, SCHEDULES))
+    return None, False
+
+
+class EarlyStopping(object):
+    """
+    Tracks the test accuracy of every evaluated epoch. update() returns "target"
+    once it reaches target_acc, "plateau" after `patience` epochs without an
+    improvement above min_delta, and None otherwise. 0 disables either criterion.
+    """
+
+    def __init__(self, target_acc=0.0, patience=0, min_delta=0.0):
+        self.target_acc = target_acc
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_acc = float("-inf")
+        self.best_epoch = -1
+
+    def update(self, epoch_idx, acc):
+        if self.target_acc and acc >= self.target_acc:
+            return "target"
+        if acc > self.best_acc + self.min_delta:
+            self.best_acc, self.best_epoch = acc, epoch_idx
+        elif self.patience and epoch_idx - self.best_epoch >= self.patience:
+            return "plateau"
+        return None
+
+    def describe(self, reason, unit="epochs"):
+        """Log text of an update() result; None means the budget was used up."""
+        if reason == "target":
+            return "reached %.2f%% test accuracy" % self.target_acc
+        if reason == "plateau":
+            return "no improvement for %d %s" % (self.patience, unit)
+        return "%s budget used up" % unit[:-1]
+
+    def state_dict(self):
+        return {"best_acc": self.best_acc, "best_epoch": self.best_epoch}
+
+    def load_state_dict(self, state):
+        self.best_acc, self.best_epoch = state["best_acc"], state["best_epoch"]
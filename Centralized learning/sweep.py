@@ -0,0 +1,192 @@
+'''
+Hyperparameter sweep of the centralized SimpleMLP with successive halving.
+
+Every fold is loaded once, in the parent process, into shared memory; the worker
+processes attach to those tensors when they start instead of each parsing and
+copying the data. Trials are configurations from the grid (or --num_trials random
+draws from it). All trials train --min_epochs epochs, then only the best 1/--eta
+by test accuracy (averaged over the folds) continue to eta times as many epochs,
+and so on up to --epochs. Workers return the model and optimizer state at the end
+of each rung, so survivors continue where they stopped:
+
+    python sweep.py --folds 2 --lr 0.01 0.03 0.1 0.3 --batch_size 32 100 300 \
+        --client_optimizer sgd adam --hidden_nodes 20 40 80 --epochs 100 --output sweep.csv
+'''
+
+import argparse
+import csv
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from centralized_trainer import CentralizedTrainer
+from data_loader import TensorBatchLoader, load_partition_data_fed_wisdm2011
+from main import create_model, parse_folds
+
+GRID = ["lr", "batch_size", "wd", "client_optimizer", "hidden_nodes"]
+
+# Fold tensors of a worker process, attached once by _attach_folds()
+_folds = None
+
+
+def load_shared_folds(fold_ids):
+    """{fold: (x_train, y_train, x_test, y_test)}, moved to shared memory."""
+    folds = {}
+    for fold_idx in fold_ids:
+        dataset = load_partition_data_fed_wisdm2011(fold_idx=fold_idx)
+        x_train, y_train = dataset[3].dataset.tensors
+        x_test, y_test = dataset[4].dataset.tensors
+        folds[fold_idx] = tuple(t.share_memory_() for t in (x_train, y_train, x_test, y_test))
+    return folds
+
+
+def _attach_folds(folds, num_threads):
+    global _folds
+    _folds = folds
+    torch.set_num_threads(num_threads)
+    # The trainer's per-epoch lines of hundreds of trials would drown the rung summaries
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def run_rung(config, fold_idx, start_epoch, stop_epoch, state):
+    """
+    Train one trial on one fold from start_epoch to stop_epoch.
+
+    Returns the test accuracy of every epoch and the model / optimizer state to
+    continue from.
+    """
+    seed = hash((config["trial"], fold_idx, start_epoch)) % (2 ** 31)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    x_train, y_train, x_test, y_test = _folds[fold_idx]
+    train_global = TensorBatchLoader(data.TensorDataset(x_train, y_train), batch_size=config["batch_size"],
+                                     shuffle=True)
+    test_global = TensorBatchLoader(data.TensorDataset(x_test, y_test), batch_size=1000, shuffle=False)
+    dataset = [len(y_train), len(y_test), train_global, test_global, {}, {}, {}, 6]
+
+    args = argparse.Namespace(epochs=stop_epoch, **{k: config[k] for k in GRID})
+    trainer = CentralizedTrainer(dataset, create_model(args, "simple_mlp", 6), torch.device("cpu"), args)
+    if state is not None:
+        trainer.model.load_state_dict(state["model"])
+        trainer.optimizer.load_state_dict(state["optimizer"])
+
+    test_acc = []
+    start = time.time()
+    for epoch in range(start_epoch, stop_epoch):
+        trainer.train_one_epoch(epoch)
+        test_acc.append(trainer.compute_metrics(test_global)[1])
+    state = {"model": trainer.model.state_dict(), "optimizer": trainer.optimizer.state_dict()}
+    return test_acc, state, time.time() - start
+
+
+def rung_epochs(min_epochs, eta, epochs):
+    """Epoch budgets of the successive-halving rungs: min_epochs * eta^k, ending at epochs."""
+    rungs = [min(min_epochs, epochs)]
+    while rungs[-1] < epochs:
+        rungs.append(min(rungs[-1] * eta, epochs))
+    return rungs
+
+
+def make_trials(args):
+    grid = [dict(zip(GRID, values)) for values in itertools.product(*(getattr(args, k) for k in GRID))]
+    if args.num_trials and args.num_trials < len(grid):
+        grid = random.Random(args.seed).sample(grid, args.num_trials)
+    for trial, config in enumerate(grid):
+        config["trial"] = trial
+    return grid
+
+
+def run_sweep(args):
+    fold_ids = parse_folds(args.folds)
+    trials = make_trials(args)
+    rungs = rung_epochs(args.min_epochs, args.eta, args.epochs)
+    workers = max(1, min(args.workers or os.cpu_count() or 1, len(trials) * len(fold_ids)))
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    logging.info("%d trials x folds %s, rungs at epochs %s, %d processes x %d threads"
+                 % (len(trials), fold_ids, rungs, workers, num_threads))
+
+    folds = load_shared_folds(fold_ids)
+    history = {(t["trial"], f): [] for t in trials for f in fold_ids}
+    states = {key: None for key in history}
+    seconds = {t["trial"]: 0.0 for t in trials}
+    alive = list(trials)
+    start_epoch = 0
+
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_attach_folds,
+                             initargs=(folds, num_threads)) as pool:
+        for rung, stop_epoch in enumerate(rungs):
+            futures = {(t["trial"], f): pool.submit(run_rung, t, f, start_epoch, stop_epoch, states[(t["trial"], f)])
+                       for t in alive for f in fold_ids}
+            for key, future in futures.items():
+                test_acc, states[key], spent = future.result()
+                history[key].extend(test_acc)
+                seconds[key[0]] += spent
+
+            score = {t["trial"]: np.mean([max(history[(t["trial"], f)]) for f in fold_ids]) for t in alive}
+            alive.sort(key=lambda t: score[t["trial"]], reverse=True)
+            if stop_epoch < args.epochs:
+                keep = max(1, math.ceil(len(alive) / args.eta))
+                for t in alive[keep:]:
+                    for f in fold_ids:
+                        states[(t["trial"], f)] = None
+                alive = alive[:keep]
+            logging.info("rung %d (epoch %d): best %.2f%%, %d trials continue"
+                         % (rung, stop_epoch, score[alive[0]["trial"]], len(alive) if stop_epoch < args.epochs else 0))
+            start_epoch = stop_epoch
+
+    results = []
+    for t in trials:
+        runs = [history[(t["trial"], f)] for f in fold_ids]
+        results.append(dict(t, epochs=len(runs[0]), best_test_acc=float(np.mean([max(r) for r in runs])),
+                            final_test_acc=float(np.mean([r[-1] for r in runs])), seconds=seconds[t["trial"]]))
+    results.sort(key=lambda r: (r["epochs"], r["best_test_acc"]), reverse=True)
+    return results
+
+
+def print_results(results, output=None):
+    columns = ["trial"] + GRID + ["epochs", "best_test_acc", "final_test_acc", "seconds"]
+    print("%5s %8s %6s %8s %6s %6s %6s %9s %10s %8s" % ("trial", "lr", "batch", "wd", "opt", "hidden", "epochs",
+                                                      "best acc", "final acc", "time (s)"))
+    for r in results:
+        print("%5d %8g %6d %8g %6s %6d %6d %8.2f%% %9.2f%% %8.1f"
+              % (r["trial"], r["lr"], r["batch_size"], r["wd"], r["client_optimizer"], r["hidden_nodes"],
+                 r["epochs"], r["best_test_acc"], r["final_test_acc"], r["seconds"]))
+    if output:
+        with open(output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, columns)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folds', type=str, default='2', help='folds every trial is trained on, e.g. 2 or 1-5')
+    parser.add_argument('--lr', type=float, nargs='+', default=[0.01, 0.1], help='learning rates')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[300], help='batch sizes')
+    parser.add_argument('--wd', type=float, nargs='+', default=[0.001], help='weight decay (adam)')
+    parser.add_argument('--client_optimizer', type=str, nargs='+', default=['sgd'], choices=['sgd', 'adam'],
+                        help='optimizers')
+    parser.add_argument('--hidden_nodes', type=int, nargs='+', default=[40], help='hidden layer widths')
+    parser.add_argument('--num_trials', type=int, default=0, help='random configurations drawn from the grid; 0 = all')
+    parser.add_argument('--epochs', type=int, default=100, help='epochs of the trials that are never pruned')
+    parser.add_argument('--min_epochs', type=int, default=5, help='epochs before the first pruning')
+    parser.add_argument('--eta', type=int, default=3, help='keep the best 1/eta trials at every rung')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes; 0 = one per core')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the --num_trials draw')
+    parser.add_argument('--output', type=str, default='', help='CSV file for the results table')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    print_results(run_sweep(args), args.output)
@@ -914,6 +914,146 @@ void delta_binarisation()
 }
 
 
+// Top-k sparse delta upload, selected by a heartbit 21 followed by k as 2 bytes (a bare
+// heartbit 21 keeps delta_binarisation()). Only the k largest-magnitude entries of
+// delta + residual are sent, as (u16 index, float16 value) pairs in the partition that
+// holds the index. What is left unsent becomes the residual (error feedback) once the
+// server has read every partition of the upload, so an upload it never collected is
+// added whole to the next round's delta.
+#define HiddenSize ((InputNodes+1) * HiddenNodes)
+#define ModelSize (HiddenSize + (HiddenNodes+1) * OutputNodes)
+#define Partitions 16
+bool topk_mode = false;
+int topk = 194;
+float residual[ModelSize] = {};
+bool topk_sent[ModelSize] = {};
+bool topk_fetched[Partitions] = {};
+int topk_fetched_count = 0;
+
+// flat model index: HiddenWeights first, then OutputWeights, as the server numbers them
+float * delta_entry(int n)
+{
+  if (n < HiddenSize)
+    return &HiddenWeights_delta[n];
+  return &OutputWeights_delta[n - HiddenSize];
+}
+
+// |x| as float bits, which order like the magnitudes they encode
+uint magnitude_bits(const float x)
+{
+  return as_uint(x) & 0x7FFFFFFF;
+}
+
+int count_at_least(uint threshold)
+{
+  int count = 0;
+  for (int n = 0; n < ModelSize; n++)
+    if (magnitude_bits(*delta_entry(n)) >= threshold)
+      count++;
+  return count;
+}
+
+void delta_topk()
+{
+  delta(); //calculate delta
+  for (int n = 0; n < ModelSize; n++)
+    {
+      *delta_entry(n) += residual[n];
+      topk_sent[n] = 0;
+    }
+  for (int p = 0; p < Partitions; p++)
+    topk_fetched[p] = 0;
+  topk_fetched_count = 0;
+
+  int k = topk < ModelSize ? topk : ModelSize;
+  int selected = 0;
+  if (k > 0)
+    {
+      // the largest threshold with at least k magnitudes at or above it, by bisection
+      uint lo = 0, hi = 0x7F800000;
+      while (lo < hi)
+        {
+          uint mid = lo + (hi - lo + 1) / 2;
+          if (count_at_least(mid) >= k)
+            lo = mid;
+          else
+            hi = mid - 1;
+        }
+      // fewer than k are above it; ties at it are taken in index order
+      for (int n = 0; n < ModelSize; n++)
+        if (magnitude_bits(*delta_entry(n)) > lo)
+          {
+            topk_sent[n] = 1;
+            selected++;
+          }
+      for (int n = 0; n < ModelSize && selected < k; n++)
+        if (magnitude_bits(*delta_entry(n)) == lo)
+          {
+            topk_sent[n] = 1;
+            selected++;
+          }
+    }
+
+  // min and max of the values sent, for heartbit 23
+  deltamax = 0;
+  deltamin = 0;
+  for (int n = 0; n < ModelSize; n++)
+    if (topk_sent[n])
+      {
+        float sent = half2float(float2half(*delta_entry(n)));
+        if (sent > deltamax)
+          deltamax = sent;
+        if (sent < deltamin)
+          deltamin = sent;
+      }
+}
+
+// (start, stop) of a partition in the flat model
+void partition_bounds(int a, int *start, int *stop)
+{
+  if (a == 15)
+    {
+      *start = HiddenSize;
+      *stop = ModelSize;
+      return;
+    }
+  *start = 255 * a;
+  *stop = 255 * a + 255 < HiddenSize ? 255 * a + 255 : HiddenSize;
+}
+
+// the pairs of one partition into pairs[]; returns their bytes
+int topk_pairs(int a, uint8_t *pairs)
+{
+  int start, stop, size = 0;
+  partition_bounds(a, &start, &stop);
+  for (int n = start; n < stop; n++)
+    if (topk_sent[n])
+      {
+        ushort value = float2half(*delta_entry(n));
+        pairs[size++] = n & 0xFF;
+        pairs[size++] = (n >> 8) & 0xFF;
+        pairs[size++] = value & 0xFF;
+        pairs[size++] = (value >> 8) & 0xFF;
+      }
+  return size;
+}
+
+// a partition of the upload was read; after the last one, keep what was left unsent
+void topk_read(int a)
+{
+  if (a < 0 || a >= Partitions || topk_fetched[a])
+    return;
+  topk_fetched[a] = 1;
+  topk_fetched_count++;
+  if (topk_fetched_count == Partitions)
+    for (int n = 0; n < ModelSize; n++)
+      {
+        float v = *delta_entry(n);
+        residual[n] = topk_sent[n] ? v - half2float(float2half(v)) : v;
+      }
+}
+
+
 // COap handler for local model
 // récupérer les zéros dans le model
 static int recuperer_zero(char * sortie,char * entree,int size)
@@ -1256,6 +1396,19 @@ static void Model_coapHandler(void *aContext, otMessage *aMessage,
                         bool f[256];
                         int a = actual_partition;
                         nn=0;
+                        if (topk_mode)
+                          {
+                            uint8_t pairs[255*4];
+                            int size = topk_pairs(a, pairs);
+                            error = otMessageAppend(responseMessage, pairs, size);
+                            otEXPECT(OT_ERROR_NONE == error);
+                            error = otCoapSendResponse((otInstance*)aContext, responseMessage,
+                                                                                    aMessageInfo);
+                            otEXPECT(OT_ERROR_NONE == error);
+                            topk_read(a);
+                            nn = 1; // sent, even without pairs
+                            goto exit;
+                          }
                         if (a<=14 )
                           {
                           for (int i= a*255; i<255*a+255;i++)
@@ -1442,7 +1595,10 @@ static void Heartbit_coapHandler(void *aContext, otMessage *aMessage,
                    printintUART(actual_partition);
                    if (actual_partition ==21)
                      {
-
+                       // heartbit 21 + k (u16): top-k sparse upload
+                       topk_mode = read >= 3;
+                       if (topk_mode)
+                         topk = (uint8_t)data[1] | ((uint8_t)data[2] << 8);
 
                        random_batch();
 
@@ -1452,7 +1608,10 @@ static void Heartbit_coapHandler(void *aContext, otMessage *aMessage,
                            train();
 
                        Evaluate();
-                       delta_binarisation();
+                       if (topk_mode)
+                         delta_topk();
+                       else
+                         delta_binarisation();
                      }
 
                    if (actual_partition==22)
@@ -0,0 +1,104 @@
+'''
+Wall-clock time to a target accuracy of synchronous, buffered and async aggregation.
+
+Starts firmware_stub.py devices on synthetic records, the last --stragglers of them
+training --straggler_factor times slower, and trains the same fleet with each
+--aggregation mode of coap_server.py. sync waits for the whole fleet every round,
+buffered aggregates every --client_num_per_round updates and async each one. After
+every new global model version the server's model is scored (argmax accuracy) on
+held-out records of the same distribution:
+
+    python benchmark_async_aggregation.py --clients 9 --stragglers 2 --client_num_per_round 4 --target 0.9
+'''
+
+import argparse
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+import coap_server
+import firmware_inference
+import firmware_protocol as fp
+import firmware_stub
+
+
+def held_out(seed, records=200):
+    """Records drawn like firmware_stub.client_dataset()'s synthetic ones, from a stream no device uses."""
+    centers = np.random.RandomState(seed).normal(0.0, 1.0, (fp.OUTPUT_NODES, fp.INPUT_NODES))
+    rng = np.random.RandomState(seed + 100003)
+    x = centers[:, None, :] + rng.normal(0.0, 1.0, (fp.OUTPUT_NODES, records, fp.INPUT_NODES))
+    return x.reshape(-1, fp.INPUT_NODES).astype(np.float32), np.repeat(np.arange(fp.OUTPUT_NODES), records)
+
+
+async def run(args, mode, port, test):
+    contexts, addresses, _ = await firmware_stub.start_stubs(
+        args.clients, port=port, codec=args.codec, rtt=args.rtt, train_time=args.train_time, seed=args.seed,
+        stragglers=args.stragglers, straggler_factor=args.straggler_factor)
+    curve = []
+    try:
+        # async makes a version of every update; give it as many updates as buffered gets
+        versions = args.versions * args.client_num_per_round if mode == "async" else args.versions
+        # the synchronous baseline is a full-fleet round, not a sampled one
+        client_num_per_round = 0 if mode == "sync" else args.client_num_per_round
+        argv = ["--clients", ",".join(addresses), "--comm_round", str(versions), "--codec", args.codec,
+                "--aggregation", mode, "--client_num_per_round", str(client_num_per_round),
+                "--staleness_exponent", str(args.staleness_exponent), "--async_alpha", str(args.async_alpha),
+                "--server_lr", str(args.server_lr),
+                "--seed", str(args.seed)]
+        server = coap_server.AggregationServer(addresses, coap_server.add_args(argparse.ArgumentParser()).parse_args(argv))
+        start = time.perf_counter()
+
+        def on_model(round_idx, model):
+            acc = firmware_inference.FirmwareInference(model, exact=False).score(*test)["argmax_acc"][0]
+            curve.append((time.perf_counter() - start, float(acc)))
+
+        server.on_model = on_model
+        rounds = await server.train()
+    finally:
+        for context in contexts:
+            await context.shutdown()
+    reached = [version for version, (_, acc) in enumerate(curve) if acc >= args.target]
+    seconds = curve[reached[0]][0] if reached else float("nan")
+    return (seconds, reached[0] + 1 if reached else None, max(acc for _, acc in curve), curve[-1][0] / len(curve),
+            np.mean([r.get("staleness", 0.0) for r in rounds]))
+
+
+async def main(args):
+    test = held_out(args.seed)
+    print("%d clients (%d stragglers x%.0f), train %.2fs, rtt %.3fs, K=%d, target argmax acc %.2f"
+          % (args.clients, args.stragglers, args.straggler_factor, args.train_time, args.rtt,
+             args.client_num_per_round, args.target))
+    print("%10s %16s %16s %10s %12s %10s" % ("mode", "s to target", "versions needed", "best acc", "s/version",
+                                            "staleness"))
+    port = args.port
+    for mode in args.modes:
+        seconds, versions, best, per_version, staleness = await run(args, mode, port, test)
+        port += args.clients
+        print("%10s %16.2f %16s %10.4f %12.3f %10.2f" % (mode, seconds, versions or "-", best, per_version, staleness))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=9, help='fleet size')
+    parser.add_argument('--stragglers', type=int, default=2, help='devices that train slower')
+    parser.add_argument('--straggler_factor', type=float, default=5.0, help='how many times slower they train')
+    parser.add_argument('--client_num_per_round', type=int, default=4, help='buffered: updates per aggregation')
+    parser.add_argument('--modes', type=str, nargs='+', default=['sync', 'buffered', 'async'],
+                        choices=['sync', 'buffered', 'async'], help='aggregation modes to compare')
+    parser.add_argument('--versions', type=int, default=12,
+                        help='global model versions of sync and buffered; async gets K times as many')
+    parser.add_argument('--target', type=float, default=0.9, help='argmax accuracy on the held-out records')
+    parser.add_argument('--staleness_exponent', type=float, default=0.5, help='staleness discount')
+    parser.add_argument('--server_lr', type=float, default=0.5, help='buffered step size')
+    parser.add_argument('--async_alpha', type=float, default=0.6, help='async mixing weight')
+    parser.add_argument('--port', type=int, default=5683, help='first port used by the stand-ins')
+    parser.add_argument('--codec', type=str, default='float16', help='model encoding of the firmware variant')
+    parser.add_argument('--rtt', type=float, default=0.01, help='seconds of latency per request')
+    parser.add_argument('--train_time', type=float, default=0.3, help='seconds a regular device trains')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic records')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,64 @@
+'''
+Round latency of coap_server.py, sequential vs. concurrent, against firmware stand-ins.
+
+Starts --clients firmware_stub.py devices on localhost in the same event loop, with
+--rtt seconds of latency per request and --train_time seconds of training, and
+times --rounds FedAvg rounds each way:
+
+    python benchmark_coap_round.py --clients 9 --rtt 0.02 --train_time 1 --rounds 3
+'''
+
+import argparse
+import asyncio
+import logging
+
+import numpy as np
+
+import coap_server
+import firmware_codecs
+import firmware_stub
+
+
+async def time_rounds(args, port, argv):
+    """Mean seconds per round and retransmissions, against freshly started stand-ins."""
+    contexts, addresses, _ = await firmware_stub.start_stubs(args.clients, port=port, codec=args.codec, rtt=args.rtt,
+                                                             train_time=args.train_time, loss=args.loss)
+    try:
+        server_args = coap_server.add_args(argparse.ArgumentParser()).parse_args(
+            ["--clients", ",".join(addresses), "--comm_round", str(args.rounds), "--timeout", str(args.timeout),
+             "--max_in_flight", str(args.max_in_flight), "--codec", args.codec] + argv)
+        server = coap_server.AggregationServer(addresses, server_args)
+        rounds = await server.train()
+        return np.mean([r["seconds"] for r in rounds]), sum(c.retransmissions for c in server.clients)
+    finally:
+        for context in contexts:
+            await context.shutdown()
+
+
+async def main(args):
+    print("clients=%d codec=%s rtt=%.3fs train_time=%.2fs loss=%.2f rounds=%d"
+          % (args.clients, args.codec, args.rtt, args.train_time, args.loss, args.rounds))
+    print("%12s %14s %14s %8s" % ("mode", "s/round", "retransmits", "speedup"))
+    # Separate stand-ins per mode, so replies still delayed by --loss cannot leak into the next run
+    sequential, retries = await time_rounds(args, args.port, ["--sequential"])
+    print("%12s %14.3f %14d %8s" % ("sequential", sequential, retries, ""))
+    concurrent, retries = await time_rounds(args, args.port + args.clients, [])
+    print("%12s %14.3f %14d %7.1fx" % ("concurrent", concurrent, retries, sequential / concurrent))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=9, help='number of firmware stand-ins')
+    parser.add_argument('--port', type=int, default=5683, help='port of the first stand-in')
+    parser.add_argument('--codec', type=str, default='float16', choices=firmware_codecs.CODECS,
+                        help='model encoding of the firmware variant')
+    parser.add_argument('--rtt', type=float, default=0.02, help='seconds of latency per request')
+    parser.add_argument('--train_time', type=float, default=1.0, help='seconds a device trains')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability that a reply is lost')
+    parser.add_argument('--timeout', type=float, default=2.0, help='seconds before a transfer is retried')
+    parser.add_argument('--max_in_flight', type=int, default=8, help='concurrent partition transfers')
+    parser.add_argument('--rounds', type=int, default=3, help='timed rounds per mode')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(args))
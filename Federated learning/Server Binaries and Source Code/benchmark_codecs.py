@@ -0,0 +1,103 @@
+'''
+Throughput and bytes per round of the firmware codecs in firmware_codecs.py.
+
+Checks the vectorized int8 / delta codes against a per-weight port of the firmware
+loops, times encode/decode of one model and of a stack of client models, and prints
+the bytes moved per round next to the "communication in/out" totals of the client
+readme.txt files. Every downlink is encoded from the float32 global model, and
+"overflow" counts its partitions that are longer than the firmware's receive buffer
+after zero escaping, whose tail the device would drop:
+
+    python benchmark_codecs.py --clients 9 --rounds 120
+'''
+
+import argparse
+import logging
+import time
+
+import numpy as np
+
+import firmware_codecs as fc
+import firmware_protocol as fp
+
+
+def firmware_loop_codes(codec, model, reference):
+    """quantization() / delta_quantization() / delta_binarisation(), one weight at a time."""
+    values = model if codec == "int8" else reference - model
+    vmax = np.float32(0)
+    vmin = np.float32(0)
+    for v in values:
+        if v > vmax:
+            vmax = v
+        if v < vmin:
+            vmin = v
+    codes = np.zeros(len(values), dtype=np.uint8)
+    for i, v in enumerate(values):
+        if codec in ("int8", "delta_quant"):
+            codes[i] = int(v * np.float32(254) / (vmax - vmin)) & 0xFF
+        else:
+            codes[i] = (v - vmin) / (vmax - vmin) > (vmax - v) / (vmax - vmin)
+    return codes
+
+
+def per_second(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return repeat / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=9, help='client models per round')
+    parser.add_argument('--rounds', type=int, default=120, help='rounds in the byte totals')
+    parser.add_argument('--repeat', type=int, default=50, help='timed repetitions')
+    args = parser.parse_args()
+    # fp.downlink_payloads() warns about every oversized partition; the table counts them instead
+    logging.getLogger().setLevel(logging.ERROR)
+
+    rng = np.random.RandomState(0)
+    # The downlink carries the float32 global model; the delta codecs are relative to a device's float16 view of it
+    model = fc.join_model(*fp.init_weights())
+    reference = fc.device_view(model, "float16")
+    models = (reference - rng.normal(0.0, 0.02, (args.clients, fc.MODEL_SIZE))).astype(np.float32)
+
+    for codec in ["int8", "delta_quant", "delta_bin"]:
+        codes, _, _ = fc.compress(codec, models[0], reference)
+        assert np.array_equal(codes, firmware_loop_codes(codec, models[0], reference)), codec
+    print("int8 / delta_quant / delta_bin codes identical to the firmware loops\n")
+
+    print("%-17s %12s %12s %14s %14s" % ("codec", "enc model/s", "dec model/s", "enc stack/s", "dec stack/s"))
+    for codec in fc.CODECS:
+        payloads, stats = fc.encode_uplink(codec, models[0], reference)
+        encode = per_second(lambda: fc.encode_uplink(codec, models[0], reference), args.repeat)
+        decode = per_second(lambda: fc.decode_uplink(codec, payloads, stats, reference), args.repeat)
+        codes, vmin, vmax = fc.compress(codec, models, reference)
+        encode_stack = per_second(lambda: fc.compress(codec, models, reference), args.repeat) * args.clients
+        decode_stack = per_second(lambda: fc.decompress(codec, codes, vmin, vmax, reference), args.repeat) * args.clients
+        print("%-17s %12.0f %12.0f %14.0f %14.0f" % (codec, encode, decode, encode_stack, decode_stack))
+
+    print("\nbytes for %d clients x %d rounds" % (args.clients, args.rounds))
+    print("%-17s %12s %12s %14s %14s %12s %9s" % ("codec", "wire in", "wire out", "readme-style in",
+                                                  "readme-style out", "published", "overflow"))
+    for codec in fc.CODECS:
+        payloads = fc.encode_downlink(codec, model)
+        downlink = sum(len(p) for p in payloads)
+        overflow = sum(len(p) > fp.MAX_DOWNLINK_PAYLOAD for p in payloads)
+        wire_in = args.rounds * args.clients * fc.uplink_bytes(codec)
+        wire_out = (args.rounds + 1) * downlink
+        if codec in ("delta_bin_packed", "delta_topk"):
+            counted, published = ("-", "-"), "-"
+        else:
+            counted = fc.readme_bytes(codec, args.rounds, args.clients)
+            published = "-"
+            if codec in fc.README_TOTALS:
+                _, total_in, total_out = fc.README_TOTALS[codec]
+                published = "match" if counted == (total_in, total_out) else "%d/%d" % (total_in, total_out)
+        print("%-17s %12d %12d %14s %14s %12s %9s" % (codec, wire_in, wire_out, counted[0], counted[1], published,
+                                                      "%d/%d" % (overflow, len(payloads))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+'''
+Server CPU time to prepare one round of downlink payloads as the fleet grows.
+
+"per client" encodes the global model's 16 Local_Model payloads for every client,
+"cached" encodes it once per downlink encoding (DownlinkCache) and hands every client
+memoryviews of the same buffers. The fleet cycles through the --codecs variants:
+
+    python benchmark_downlink_cache.py --clients 1 10 100 1000 --codecs float32 float16 int8
+'''
+
+import argparse
+import time
+
+import coap_server
+import firmware_codecs as fc
+import firmware_protocol as fp
+
+
+def per_client(model, codecs, client_num):
+    sent = 0
+    for i in range(client_num):
+        sent += sum(len(p) for p in fc.encode_downlink(codecs[i % len(codecs)], model, fp.DEFAULT_HYPERPARAMS))
+    return sent
+
+
+def cached(model, codecs, client_num):
+    cache = coap_server.DownlinkCache(fp.DEFAULT_HYPERPARAMS)
+    cache.update(model)
+    sent = 0
+    for i in range(client_num):
+        sent += sum(len(p) for p in cache.payloads(codecs[i % len(codecs)]))
+    return sent
+
+
+def cpu_ms(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        result = fn(*args)
+        best = min(best, time.process_time() - start)
+    return 1000 * best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 100, 1000], help='fleet sizes')
+    parser.add_argument('--codecs', type=str, nargs='+', default=['float32', 'float16', 'int8'],
+                        choices=fc.CODECS, help='firmware variants in the fleet')
+    args = parser.parse_args()
+
+    model = fc.join_model(*fp.init_weights(0))
+    print("codecs: %s" % " ".join(args.codecs))
+    print("%8s %16s %14s %14s %12s" % ("clients", "per client ms", "cached ms", "cached ms/cl", "MB sent"))
+    for client_num in args.clients:
+        t_client, sent = cpu_ms(per_client, model, args.codecs, client_num)
+        t_cached, sent_cached = cpu_ms(cached, model, args.codecs, client_num)
+        assert sent == sent_cached
+        print("%8d %16.2f %14.2f %14.4f %12.2f" % (client_num, t_client, t_cached, t_cached / client_num, sent / 1e6))
+
+    # The cached payloads are the bytes a per-client encoding would send
+    cache = coap_server.DownlinkCache(fp.DEFAULT_HYPERPARAMS)
+    cache.update(model)
+    for codec in args.codecs:
+        assert [bytes(p) for p in cache.payloads(codec)] == fc.encode_downlink(codec, model, fp.DEFAULT_HYPERPARAMS)
+    print("cached payloads identical to fc.encode_downlink()")
+
+
+if __name__ == "__main__":
+    main()
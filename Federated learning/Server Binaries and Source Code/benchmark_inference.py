@@ -0,0 +1,95 @@
+'''
+Scoring N received client models: one float32 torch module per model vs. one
+stacked FirmwareInference pass (firmware order and batched matmul order).
+
+Uses the test fold when given, synthetic device inputs otherwise:
+
+    python benchmark_inference.py --clients 9 100 --codec int8 --test "../../Centralized learning/data/test/fold_2_test.json"
+'''
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import firmware_codecs as fc
+import firmware_inference as fi
+import firmware_protocol as fp
+
+
+def module_from_flat(model):
+    """The per-model route: copy a flat firmware model into a float32 torch module."""
+    net = torch.nn.Sequential(torch.nn.Linear(fp.INPUT_NODES, fp.HIDDEN_NODES), torch.nn.Sigmoid(),
+                              torch.nn.Linear(fp.HIDDEN_NODES, fp.OUTPUT_NODES), torch.nn.Sigmoid())
+    hidden = torch.from_numpy(model[:fp.HIDDEN_SIZE].reshape(fp.INPUT_NODES + 1, fp.HIDDEN_NODES))
+    output = torch.from_numpy(model[fp.HIDDEN_SIZE:].reshape(fp.HIDDEN_NODES + 1, fp.OUTPUT_NODES))
+    with torch.no_grad():
+        net[0].weight.copy_(hidden[:-1].t())
+        net[0].bias.copy_(hidden[-1])
+        net[2].weight.copy_(output[:-1].t())
+        net[2].bias.copy_(output[-1])
+    return net
+
+
+def score_one_by_one(models, x, labels, threshold):
+    x = torch.from_numpy(x)
+    labels = torch.from_numpy(labels)
+    targets = torch.nn.functional.one_hot(labels, fp.OUTPUT_NODES).float()
+    device_acc = []
+    with torch.no_grad():
+        for model in models:
+            outputs = module_from_flat(model)(x)
+            device_acc.append(float((((targets - outputs) ** 2).mean(1) < threshold).float().mean()))
+    return np.array(device_acc)
+
+
+def client_models(codec, client_num, seed=0):
+    """Trained-looking client models around a global model, as the server decodes them."""
+    rng = np.random.RandomState(seed)
+    reference = fc.device_view(fc.join_model(*fp.init_weights(seed)), codec)
+    models = (reference - rng.normal(0.0, 0.05, (client_num, fc.MODEL_SIZE))).astype(np.float32)
+    codes, vmin, vmax = fc.compress(codec, models, reference)
+    return codes, vmin, vmax, reference
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+', default=[9, 100], help='models scored per pass')
+    parser.add_argument('--codec', type=str, default='int8', choices=fc.CODECS, help='codec of the client models')
+    parser.add_argument('--test', type=str, default=None, help='test fold JSON (default: 1365 synthetic records)')
+    parser.add_argument('--threshold', type=float, default=0.2, help='device accuracy threshold')
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+
+    if args.test:
+        x, labels = fi.load_test_fold(args.test)
+    else:
+        rng = np.random.RandomState(1)
+        x = rng.uniform(-1, 1, (1365, fp.INPUT_NODES)).astype(np.float32)
+        labels = rng.randint(0, fp.OUTPUT_NODES, 1365)
+    print("codec=%s records=%d" % (args.codec, len(labels)))
+    print("%8s %14s %14s %14s %16s" % ("models", "one-by-one s", "stacked s", "stacked fast s", "max acc diff"))
+
+    for client_num in args.clients:
+        codes, vmin, vmax, reference = client_models(args.codec, client_num)
+        models = fc.decompress(args.codec, codes, vmin, vmax, reference)
+
+        start = time.perf_counter()
+        loop_acc = score_one_by_one(models, x, labels, args.threshold)
+        t_loop = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exact = fi.FirmwareInference.from_codes(args.codec, codes, vmin, vmax, reference).score(x, labels, args.threshold)
+        t_exact = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fast = fi.FirmwareInference(models, exact=False).score(x, labels, args.threshold)
+        t_fast = time.perf_counter() - start
+
+        diff = max(np.abs(loop_acc - exact["device_acc"]).max(), np.abs(fast["device_acc"] - exact["device_acc"]).max())
+        print("%8d %14.3f %14.3f %14.3f %16.5f" % (client_num, t_loop, t_exact, t_fast, diff))
+
+
+if __name__ == "__main__":
+    main()
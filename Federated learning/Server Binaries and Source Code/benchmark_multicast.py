@@ -0,0 +1,75 @@
+'''
+Downlink bytes and round time of unicast vs. multicast distribution of the global model.
+
+Starts firmware_stub.py devices with a MulticastRelay standing in for the mesh
+(each device misses a datagram with probability --multicast_loss) and runs
+--rounds rounds of coap_server.py each way, for every fleet size in --clients:
+
+    python benchmark_multicast.py --clients 3 9 27 --multicast_loss 0.1 --rtt 0.02
+'''
+
+import argparse
+import asyncio
+import logging
+
+import numpy as np
+
+import coap_server
+import firmware_codecs
+import firmware_stub
+
+
+async def run(args, client_num, port, multicast):
+    relay_port = port + client_num
+    contexts, addresses, _ = await firmware_stub.start_stubs(
+        client_num, port=port, codec=args.codec, rtt=args.rtt, train_time=args.train_time,
+        multicast_port=relay_port, multicast_loss=args.multicast_loss)
+    try:
+        argv = ["--clients", ",".join(addresses), "--comm_round", str(args.rounds), "--codec", args.codec,
+                "--max_in_flight", str(args.max_in_flight), "--multicast_interval", str(args.multicast_interval)]
+        if multicast:
+            argv += ["--multicast", "[::1]:%d" % relay_port]
+        server = coap_server.AggregationServer(addresses, coap_server.add_args(argparse.ArgumentParser()).parse_args(argv))
+        rounds = await server.train()
+    finally:
+        for context in contexts:
+            await context.shutdown()
+
+    requests = server.metrics.summary("request", by=["resource"], ok=True)
+    model_bytes = sum(requests[r]["bytes_out"]["sum"] for r in ("Local_Model", "multicast") if r in requests)
+    all_bytes = sum(s["bytes_out"]["sum"] for s in requests.values())
+    repairs = server.metrics.summary("repair").get(None, {}).get("partitions", {"sum": 0})["sum"]
+    return (model_bytes / args.rounds, all_bytes / args.rounds, repairs / float(args.rounds * client_num),
+            np.mean([r["seconds"] for r in rounds]))
+
+
+async def main(args):
+    print("codec=%s rtt=%.3fs multicast loss=%.2f rounds=%d" % (args.codec, args.rtt, args.multicast_loss, args.rounds))
+    print("%8s %10s %16s %16s %16s %10s" % ("clients", "mode", "model B/round", "downlink B/round",
+                                           "repairs/client", "s/round"))
+    port = args.port
+    for client_num in args.clients:
+        for mode in ("unicast", "multicast"):
+            model_bytes, all_bytes, repairs, seconds = await run(args, client_num, port, mode == "multicast")
+            port += client_num + 1
+            print("%8d %10s %16.0f %16.0f %16s %10.3f" % (client_num, mode, model_bytes, all_bytes,
+                                                           "%.2f" % repairs if mode == "multicast" else "-", seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+', default=[3, 9, 27], help='fleet sizes')
+    parser.add_argument('--port', type=int, default=5683, help='first port used by the stand-ins')
+    parser.add_argument('--codec', type=str, default='float16', choices=firmware_codecs.CODECS,
+                        help='model encoding of the firmware variant')
+    parser.add_argument('--rtt', type=float, default=0.02, help='seconds of latency per request')
+    parser.add_argument('--train_time', type=float, default=0.2, help='seconds a device trains')
+    parser.add_argument('--multicast_loss', type=float, default=0.1,
+                        help='probability that a device misses a multicast datagram')
+    parser.add_argument('--multicast_interval', type=float, default=0.01, help='seconds between datagrams')
+    parser.add_argument('--max_in_flight', type=int, default=8, help='concurrent partition transfers')
+    parser.add_argument('--rounds', type=int, default=3, help='rounds per mode')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,106 @@
+'''
+Accuracy against uplink bytes of the 8-bit, 1-bit and top-k sparse delta uploads.
+
+Runs FedAvg in process, without the network: every client is a firmware_stub.py
+device that loads the global model as its variant decodes it, trains with the NumPy
+port of the firmware and encodes its upload. The server decodes the uploads and
+averages them (delta_topk with the scatter-add of firmware_codecs.sparse_average).
+After each round the global model is scored with the device's argmax on held-out
+records: the records of the last client of --data, which takes no part in training,
+or synthetic records without it. delta_topk runs once per --topk value, with error
+feedback, and once with the largest value without it:
+
+    python benchmark_sparse_uplink.py --data all_activities_merged.npz --rounds 40 --topk 39 194 777
+'''
+
+import argparse
+import time
+
+import numpy as np
+
+import firmware_codecs as fc
+import firmware_inference
+import firmware_protocol as fp
+import firmware_stub
+
+
+def held_out(args):
+    """(x, labels) the clients never train on."""
+    if args.data:
+        merged = np.load(args.data)
+        mine = merged["client"] == args.clients + 1
+        return merged["x"][mine].astype(np.float32), merged["y"][mine]
+    dataset = firmware_stub.client_dataset(None, args.clients, args.seed)
+    return dataset.reshape(-1, fp.INPUT_NODES), np.repeat(np.arange(fp.OUTPUT_NODES), dataset.shape[1])
+
+
+def run(args, codec, test, topk=fc.DEFAULT_TOPK, error_feedback=True):
+    """Per round: (uplink bytes so far, held-out argmax accuracy)."""
+    devices = [firmware_stub.FirmwareStub(firmware_stub.client_dataset(args.data, i, args.seed), codec,
+                                          seed=args.seed + i) for i in range(args.clients)]
+    model = fc.join_model(*fp.init_weights(args.seed))
+    sent, curve = 0, []
+    for _ in range(args.rounds):
+        reference = fc.device_view(model, codec)
+        models, updates = [], []
+        for device in devices:
+            device.hidden, device.output = (w.copy() for w in fc.split_model(reference))
+            device.topk = topk
+            if not error_feedback:
+                device.residual[:] = 0.0
+            device.train()
+            sent += sum(len(p) for p in device.uplink) + len(device.stats)
+            for partition in range(fp.NUM_PARTITIONS):
+                device.uplink_read(partition)
+            if codec == "delta_topk":
+                updates.append(fc.decode_sparse(device.uplink))
+            else:
+                models.append(fc.decode_uplink(codec, device.uplink, device.stats, reference)[0])
+        if codec == "delta_topk":
+            model = fc.sparse_average(reference, updates)
+        else:
+            model = np.mean(models, axis=0).astype(np.float32)
+        acc = firmware_inference.FirmwareInference(model, exact=False).score(*test)["argmax_acc"][0]
+        curve.append((sent, float(acc)))
+    return curve
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default=None,
+                        help='all_activities_merged.npz from merge.py (default: synthetic records)')
+    parser.add_argument('--clients', type=int, default=8, help='training clients; the next one is held out')
+    parser.add_argument('--rounds', type=int, default=30, help='FedAvg rounds per run')
+    parser.add_argument('--topk', type=int, nargs='+', default=[39, 194, 777],
+                        help='delta_topk entries per upload (1%%, 5%%, 20%% of the weights)')
+    parser.add_argument('--target', type=float, default=0.0,
+                        help='report the bytes to reach this accuracy (default: 0.9 of the int8 run\'s best)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    test = held_out(args)
+    runs = [("int8", "int8", {}), ("delta_quant", "delta_quant", {}), ("delta_bin", "delta_bin", {}),
+            ("delta_bin_packed", "delta_bin_packed", {})]
+    runs += [("delta_topk k=%d" % k, "delta_topk", {"topk": k}) for k in args.topk]
+    runs += [("delta_topk k=%d no EF" % max(args.topk), "delta_topk", {"topk": max(args.topk), "error_feedback": False})]
+
+    results = []
+    for name, codec, options in runs:
+        start = time.perf_counter()
+        results.append((name, run(args, codec, test, **options), time.perf_counter() - start))
+    target = args.target or 0.9 * max(acc for _, acc in results[0][1])
+
+    print("%d clients, %d rounds, %d held-out records, target argmax acc %.4f"
+          % (args.clients, args.rounds, len(test[1]), target))
+    print("%-22s %12s %10s %10s %14s %14s %8s" % ("upload", "B/client/rd", "final acc", "best acc", "rounds to tgt",
+                                                "KB to target", "time s"))
+    for name, curve, seconds in results:
+        per_round = curve[-1][0] / float(args.rounds * args.clients)
+        reached = [i for i, (_, acc) in enumerate(curve) if acc >= target]
+        print("%-22s %12.0f %10.4f %10.4f %14s %14s %8.1f" % (
+            name, per_round, curve[-1][1], max(acc for _, acc in curve), reached[0] + 1 if reached else "-",
+            "%.1f" % (curve[reached[0]][0] / 1e3) if reached else "-", seconds))
+
+
+if __name__ == "__main__":
+    main()
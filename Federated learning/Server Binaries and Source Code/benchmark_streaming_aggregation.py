@@ -0,0 +1,117 @@
+'''
+Server memory and finishing time of collect-then-average vs. streaming aggregation.
+
+Replays one round of uploads without the network: the clients' Local_Model GET
+payloads arrive interleaved (partition 0 of every client, then partition 1, ...),
+each one a new buffer, as aiocoap hands them over.
+"collect" is the server without --streaming: a client's payloads are kept until
+its last one, decoded into a model, and all the models are averaged at the end.
+"streaming B" holds up to B payloads of a client (coap_server.py --stream_batch), then
+decodes them together and folds them into a StreamingAggregator. Reported per fleet
+size: peak Python heap (tracemalloc) during the round, CPU time of the whole round
+and CPU time left after the last payload arrived. The CPU times come from a second
+run without tracemalloc, which slows every allocation down:
+
+    python benchmark_streaming_aggregation.py --clients 10 100 1000 5000 --codec float16 --stream_batch 1 4 16
+'''
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+import coap_server
+import firmware_codecs as fc
+import firmware_protocol as fp
+
+
+def uploads(codec, reference, distinct, seed=0):
+    """`distinct` different uploads (payloads, stats) of models trained from reference."""
+    rng = np.random.RandomState(seed)
+    result = []
+    for _ in range(distinct):
+        model = (reference + rng.normal(0.0, 0.05, reference.shape)).astype(np.float32)
+        result.append(fc.encode_uplink(codec, model, fc.device_view(reference, codec), 0.5, 0.5))
+    return result
+
+
+def collect(codec, reference, sent, client_num):
+    held = [[] for _ in range(client_num)]
+    models = []
+    for partition in range(fp.NUM_PARTITIONS):
+        for client in range(client_num):
+            payloads, stats = sent[client % len(sent)]
+            held[client].append(bytearray(payloads[partition]))
+            if partition == fp.OUTPUT_PARTITION:
+                models.append(fc.decode_uplink(codec, held[client], stats, reference)[0])
+                held[client] = None
+    last = time.process_time()
+    model = np.mean(models, axis=0).astype(np.float32)
+    return model, last
+
+
+def streaming(codec, reference, sent, client_num, batch):
+    aggregator = coap_server.StreamingAggregator(reference)
+    held = [[] for _ in range(client_num)]
+    for partition in range(fp.NUM_PARTITIONS):
+        for client in range(client_num):
+            payloads, stats = sent[client % len(sent)]
+            held[client].append(bytearray(payloads[partition]))
+            if len(held[client]) == batch or partition == fp.OUTPUT_PARTITION:
+                first = partition + 1 - len(held[client])
+                aggregator.add(first, fc.decode_partitions(codec, first, held[client], stats, reference))
+                held[client] = []
+    last = time.process_time()
+    return aggregator.model(), last
+
+
+def measure(fn, *args):
+    """(model, peak heap bytes, round CPU s, CPU s after the last payload)."""
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    start = time.process_time()
+    model, last = fn(*args)
+    end = time.process_time()
+    return model, peak, end - start, end - last
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 100, 1000], help='fleet sizes')
+    parser.add_argument('--codec', type=str, default='float16', choices=fc.CODECS, help='firmware variant')
+    parser.add_argument('--distinct', type=int, default=8, help='different uploads the clients cycle through')
+    parser.add_argument('--stream_batch', type=int, nargs='+', default=[1, 4, 16],
+                        help='streaming: payloads of a client decoded together')
+    args = parser.parse_args()
+
+    reference = fc.device_view(fc.join_model(*fp.init_weights(0)), args.codec)
+    sent = uploads(args.codec, reference, args.distinct)
+    print("codec=%s, %d B uploaded per client" % (args.codec, fc.uplink_bytes(args.codec)))
+    print("%8s %12s %12s %12s %16s %12s" % ("clients", "mode", "peak MB", "round ms", "after last ms",
+                                            "max diff"))
+    for client_num in args.clients:
+        expected = None
+        modes = [("collect", collect, ())] + [("streaming %d" % b, streaming, (b,)) for b in args.stream_batch]
+        for mode, fn, options in modes:
+            model, peak, seconds, after = measure(fn, args.codec, reference, sent, client_num, *options)
+            expected = model if expected is None else expected
+            print("%8d %12s %12.2f %12.1f %16.3f %12.2e" % (client_num, mode, peak / 1e6, 1000 * seconds,
+                                                            1000 * after, np.abs(model - expected).max()))
+
+    # A partition beyond the firmware's +-20 bound is left out of the average
+    payloads, stats = fc.encode_uplink("float32", np.full(fc.MODEL_SIZE, 25.0, dtype=np.float32))
+    aggregator = coap_server.StreamingAggregator(reference)
+    assert aggregator.add(3, fc.decode_partition("float32", 3, payloads[3])) == [3]
+    assert aggregator.rejected == 1 and np.array_equal(aggregator.model(), reference)
+    # ... and only that partition when it is decoded with others
+    clean, _ = fc.encode_uplink("float32", reference)
+    assert aggregator.add(2, fc.decode_partitions("float32", 2, [clean[2], payloads[3], clean[4]])) == [3]
+    assert aggregator.rejected == 2 and list(aggregator.weight[2:5]) == [1, 0, 1]
+    print("partitions failing data_checker() are left out")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,625 @@
+'''
+FedCoRE aggregation server: runs FedAvg rounds over the Thread clients with aiocoap.
+
+Every round pushes the global model to each client (16 partitions), starts local
+training through heartbit, pulls the 16 trained partitions back and averages them.
+The clients are served concurrently. A client's partitions stay sequential, since the
+firmware keeps a single selected partition, and --max_in_flight bounds the number of
+partition transfers on the network at once. A transfer that times out is retried;
+a client that still fails is left out of that round's average.
+
+    python coap_server.py --clients "fd11:22::abcd,fd11:22::ef01" --comm_round 120
+
+--sequential serves one client and one partition at a time, for comparison.
+A client address may end in @codec (e.g. "fd11:22::abcd@int8") when the fleet mixes
+firmware variants. The global model's downlink is encoded once per round
+(DownlinkCache), and every client is sent views of the same buffers.
+
+--aggregation buffered / async stop waiting for the slowest device: every client
+trains in its own loop, and its update is folded into whichever model version is
+current when it arrives, discounted by its staleness (versions missed since its
+download). buffered (FedBuff) aggregates every --client_num_per_round updates, async
+(FedAsync) mixes in each update as it arrives. sync with --client_num_per_round
+below the fleet size samples that many clients per round.
+
+--multicast sends each partition once to the devices' multicast group (ff03::1,
+port 234 on the Thread network) instead of to every client. Each client is then
+asked through heartbit which partitions it missed, and only those are sent by
+unicast before it trains.
+
+--streaming keeps no client models: each uploaded partition is decoded as it
+arrives and added to a running per-partition sum (StreamingAggregator), unless it
+fails the firmware's data_checker() bound (|w| >= 20). Memory no longer grows with
+the fleet, and the averaging is done when the last partition arrives.
+
+Every request, partition transfer, retry, heartbit command, aggregation and round
+is recorded as an event (metrics.py): payload bytes and RTT per resource, training
+time per client, aggregation time per round. --metrics_path writes them to a JSONL
+or CSV file, and a per-resource and per-client summary is logged at the end.
+'''
+
+import argparse
+import asyncio
+import logging
+import socket
+import time
+
+import aiocoap
+import aiocoap.error
+import numpy as np
+
+import firmware_codecs as fc
+import firmware_protocol as fp
+from metrics import MetricsRecorder
+
+COMMANDS = {fp.TRAIN: "train", fp.EVALUATE: "evaluate", fp.STATS: "stats", fp.MISSING: "missing"}
+METRIC_COLUMNS = ["event", "time", "round", "client", "resource", "method", "partition", "direction", "command",
+                  "bytes_out", "bytes_in", "rtt", "seconds", "attempts", "ok", "clients", "train_acc", "eval_acc",
+                  "error"]
+
+
+class TransferError(Exception):
+    pass
+
+
+def parse_endpoint(text, default_port):
+    """(host, port) of "[addr]:port", "[addr]", a bare IPv6 address or "host:port"."""
+    if text.startswith("["):
+        host, _, port = text[1:].partition("]")
+        return host, int(port.lstrip(":") or default_port)
+    if text.count(":") > 1:
+        return text, default_port
+    host, _, port = text.partition(":")
+    return host, int(port or default_port)
+
+
+class ClientLink(object):
+    """One device: its address, firmware codec and the lock that serializes its partition transfers."""
+
+    def __init__(self, address, codec):
+        address, _, client_codec = address.partition("@")
+        if ":" in address and not address.startswith("["):
+            address = "[%s]" % address  # a bare IPv6 address
+        self.address = address
+        self.codec = client_codec or codec
+        if self.codec not in fc.CODECS:
+            raise ValueError("%s: unknown codec %s" % (address, self.codec))
+        self.lock = asyncio.Lock()
+        self.retransmissions = 0
+
+    def uri(self, resource):
+        return "coap://%s/%s" % (self.address, resource)
+
+
+class DownlinkCache(object):
+    """
+    The global model's Local_Model POST payloads, encoded once per aggregation.
+
+    Encodings are shared by every codec with the same downlink format: float32 for
+    the 32-bit firmware, float16 for all others. Each encoding is one immutable bytes
+    buffer, and clients get read-only memoryview slices of it, so no send copies or
+    re-serializes a partition. update() installs the next model and drops the old
+    buffers; views still held by in-flight sends keep theirs alive.
+    """
+
+    def __init__(self, hyperparams):
+        self.hyperparams = hyperparams
+        self.model = None
+        self.version = 0
+        self.payload_views = {}
+        self.references = {}
+
+    def update(self, model):
+        self.model = model
+        self.version += 1
+        self.payload_views = {}
+        self.references = {}
+
+    def payloads(self, codec):
+        """The 16 partition payloads for `codec`, as memoryviews."""
+        dtype = fc.downlink_dtype(codec)
+        if dtype not in self.payload_views:
+            parts = fc.encode_downlink(codec, self.model, self.hyperparams)
+            buffer = memoryview(b"".join(parts))
+            ends = np.cumsum([len(p) for p in parts])
+            self.payload_views[dtype] = tuple(buffer[end - len(p):end] for p, end in zip(parts, ends))
+        return self.payload_views[dtype]
+
+    def reference(self, codec):
+        """The model as a `codec` device decodes it; what the delta codecs are relative to."""
+        dtype = fc.downlink_dtype(codec)
+        if dtype not in self.references:
+            self.references[dtype] = fc.device_view(self.model, codec)
+        return self.references[dtype]
+
+
+class StreamingAggregator(object):
+    """
+    A round's FedAvg folded in one partition at a time, as the uploads arrive.
+
+    Keeps a float64 running sum and a weight total per partition instead of every
+    client's model, so memory does not grow with the fleet. A partition that fails
+    the firmware's data_checker() bound is left out. The average of a partition is
+    taken over the clients that delivered it; partitions nobody delivered keep the
+    previous global values.
+    """
+
+    def __init__(self, model):
+        self.base = model
+        self.sum = np.zeros(fc.MODEL_SIZE, dtype=np.float64)
+        self.weight = np.zeros(fp.NUM_PARTITIONS, dtype=np.float64)
+        self.rejected = 0
+
+    def add(self, first, values, weight=1.0):
+        """
+        Fold in the decoded values of partition `first` and the partitions after it
+        (fc.decode_partitions()); returns the partitions data_checker() rejects.
+        """
+        start = fc.PARTITION_SLICES[first].start
+        stop = start + len(values)
+        last = first + int(np.searchsorted(fc.PARTITION_STOPS[first:], stop))
+        # data_checker() of every partition at once; NaN fails the comparison too
+        if np.abs(values).max() < fp.WEIGHT_LIMIT:
+            self.sum[start:stop] += values if weight == 1.0 else weight * values
+            self.weight[first:last + 1] += weight
+            return []
+        bad = ~(np.abs(values) < fp.WEIGHT_LIMIT)
+        rejected = np.logical_or.reduceat(bad, fc.PARTITION_STARTS[first:last + 1] - start)
+        for partition in range(first, last + 1):
+            if not rejected[partition - first]:
+                s = fc.PARTITION_SLICES[partition]
+                self.sum[s] += weight * values[s.start - start:s.stop - start]
+                self.weight[partition] += weight
+        rejected = [first + i for i in np.flatnonzero(rejected)]
+        self.rejected += len(rejected)
+        return rejected
+
+    def model(self):
+        model = self.base.copy()
+        for partition, s in enumerate(fc.PARTITION_SLICES):
+            if self.weight[partition] > 0:
+                model[s] = self.sum[s] / self.weight[partition]
+        return model.astype(np.float32)
+
+
+class AggregationServer(object):
+    def __init__(self, addresses, args):
+        self.args = args
+        self.clients = [ClientLink(a, args.codec) for a in addresses]
+        self.model = fc.join_model(*fp.init_weights(args.seed))
+        self.hyperparams = {"momentum": args.momentum, "lr": args.lr, "sgd_iteration": args.sgd_iteration,
+                            "batch_size": args.batch_size, "threshold_training": args.threshold_training,
+                            "threshold_evaluate": args.threshold_evaluate}
+        self.downlink = DownlinkCache(self.hyperparams)
+        self.downlink.update(self.model)
+        self.context = None
+        self.in_flight = None
+        self.multicast = None
+        self.test_data = None
+        self.scoring = None
+        # Called with (round_idx, model) after every aggregation
+        self.on_model = None
+        self.updates = []
+        self.rounds = []
+        self.round_idx = None
+        self.metrics = MetricsRecorder(args.metrics_path or None, METRIC_COLUMNS,
+                                       labels=["resource", "client", "ok", "command"])
+
+    async def start(self):
+        if self.args.test:
+            # torch is only needed on the server when models are scored
+            import firmware_inference
+            self.test_data = firmware_inference.load_test_fold(self.args.test)
+        self.context = await aiocoap.Context.create_client_context()
+        self.in_flight = asyncio.Semaphore(1 if self.args.sequential else self.args.max_in_flight)
+        if self.args.multicast:
+            await self.open_multicast()
+
+    async def open_multicast(self):
+        host, port = parse_endpoint(self.args.multicast, fp.RECV_PORT)
+        info = socket.getaddrinfo(host, port, socket.AF_INET6, socket.SOCK_DGRAM)[0]
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        if self.args.multicast_if:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF,
+                            socket.if_nametoindex(self.args.multicast_if))
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, self.args.multicast_hops)
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(asyncio.DatagramProtocol, sock=sock)
+        self.multicast = (transport, info[4])
+
+    async def shutdown(self):
+        if self.multicast is not None:
+            self.multicast[0].close()
+        await self.context.shutdown()
+
+    async def send(self, client, code, resource, payload=b"", timeout=None):
+        request = aiocoap.Message(code=code, uri=client.uri(resource), payload=payload)
+        start = time.perf_counter()
+        bytes_in, rtt, ok = 0, None, False
+        try:
+            response = await asyncio.wait_for(self.context.request(request).response,
+                                              timeout or self.args.timeout)
+            rtt = time.perf_counter() - start
+            bytes_in = len(response.payload)
+            if not response.code.is_successful():
+                raise TransferError("%s %s: %s" % (client.address, resource, response.code))
+            ok = True
+            return response.payload
+        finally:
+            # Recorded once the outcome is known: a request that times out has ok=False and no rtt
+            self.metrics.record("request", round=self.round_idx, client=client.address, resource=resource,
+                                method=code.name, bytes_out=len(payload), bytes_in=bytes_in, rtt=rtt, ok=ok)
+
+    async def transfer(self, client, partition, code, payload=b""):
+        """
+        Select a partition through heartbit, then GET or POST it on Local_Model.
+
+        The pair is retried as a whole: a retried GET alone could read whichever
+        partition a lost select left selected.
+        """
+        direction = "down" if code == aiocoap.POST else "up"
+        async with client.lock:
+            start = time.perf_counter()
+            for attempt in range(self.args.retries + 1):
+                try:
+                    async with self.in_flight:
+                        await self.send(client, aiocoap.POST, fp.HEARTBIT_URI, fp.heartbit_code(partition))
+                        data = await self.send(client, code, fp.MODEL_URI, payload)
+                    self.metrics.record("block", round=self.round_idx, client=client.address, partition=partition,
+                                        direction=direction, seconds=time.perf_counter() - start,
+                                        attempts=attempt + 1)
+                    return data
+                except (asyncio.TimeoutError, aiocoap.error.Error) as e:
+                    client.retransmissions += 1
+                    self.metrics.record("retransmission", round=self.round_idx, client=client.address,
+                                        partition=partition, direction=direction, attempts=attempt + 1, error=repr(e))
+                    logging.info("%s partition %d attempt %d failed: %r" % (client.address, partition, attempt + 1, e))
+            raise TransferError("%s: partition %d failed after %d attempts"
+                                % (client.address, partition, self.args.retries + 1))
+
+    async def command(self, client, code, timeout=None, payload=None):
+        """A heartbit command (train / evaluate / stats); not retried, since training twice changes the model."""
+        async with client.lock:
+            async with self.in_flight:
+                start = time.perf_counter()
+                try:
+                    payload = await self.send(client, aiocoap.POST, fp.HEARTBIT_URI,
+                                              payload or fp.heartbit_code(code), timeout)
+                except (asyncio.TimeoutError, aiocoap.error.Error) as e:
+                    raise TransferError("%s: heartbit %d failed: %r" % (client.address, code, e))
+                finally:
+                    self.metrics.record("command", round=self.round_idx, client=client.address,
+                                        command=COMMANDS.get(code, code), seconds=time.perf_counter() - start)
+        return payload
+
+    async def client_round(self, client, aggregator=None):
+        """
+        One round of one client: (model, train_acc, eval_acc). With an aggregator,
+        each uploaded partition is decoded and folded into it as it arrives, and the
+        model is None. An upload that does not decode (a truncated partition or stats
+        reply) raises TransferError, so the client is dropped like one that timed out.
+        """
+        # Taken before the first await: the cache moves on when this round aggregates
+        payloads = self.downlink.payloads(client.codec)
+        # The delta codecs send global - trained, relative to the model as the device decoded it
+        reference = self.downlink.reference(client.codec)
+        partitions = range(fp.NUM_PARTITIONS)
+        if self.multicast is not None:
+            # A device that does not answer with a bitmap is sent the whole model by unicast
+            query = fp.missing_query(self.downlink.version)
+            partitions = fp.read_missing(await self.command(client, fp.MISSING, payload=query))
+            self.metrics.record("repair", round=self.round_idx, client=client.address, partitions=len(partitions))
+        for partition in partitions:
+            await self.transfer(client, partition, aiocoap.POST, payloads[partition])
+        train = fp.train_request(self.args.topk) if client.codec == "delta_topk" else None
+        await self.command(client, fp.TRAIN, self.args.train_timeout, train)
+        stats = None
+        if client.codec not in fc.FLOAT_CODECS:
+            stats = await self.command(client, fp.STATS)
+        if aggregator is None:
+            partitions = [await self.transfer(client, partition, aiocoap.GET)
+                          for partition in range(fp.NUM_PARTITIONS)]
+            try:
+                return fc.decode_uplink(client.codec, partitions, stats, reference)
+            except ValueError as e:
+                raise TransferError("%s: %s" % (client.address, e))
+        held = []
+        for partition in range(fp.NUM_PARTITIONS):
+            payload = await self.transfer(client, partition, aiocoap.GET)
+            held.append(payload)
+            if len(held) < self.args.stream_batch and partition < fp.OUTPUT_PARTITION:
+                continue
+            # --stream_batch partitions are decoded and added together
+            first = partition + 1 - len(held)
+            try:
+                values = fc.decode_partitions(client.codec, first, held, stats, reference)
+            except ValueError as e:
+                raise TransferError("%s: %s" % (client.address, e))
+            held = []
+            for rejected in aggregator.add(first, values):
+                self.metrics.record("rejected", round=self.round_idx, client=client.address, partition=rejected)
+                logging.info("[Round %d] %s partition %d fails data_checker(), left out"
+                             % (self.round_idx, client.address, rejected))
+        try:
+            return (None,) + fc.uplink_accuracies(client.codec, payload, stats)
+        except ValueError as e:
+            raise TransferError("%s: %s" % (client.address, e))
+
+    async def send_multicast(self):
+        """Every partition of the global model once to the multicast group, per downlink encoding in the fleet."""
+        transport, address = self.multicast
+        codecs = {fc.downlink_dtype(c.codec): c.codec for c in self.clients}
+        for dtype, codec in sorted(codecs.items()):
+            for partition, payload in enumerate(self.downlink.payloads(codec)):
+                datagram = fp.multicast_datagram(self.downlink.version, partition, payload, dtype)
+                transport.sendto(datagram, address)
+                self.metrics.record("request", round=self.round_idx, client=self.args.multicast, resource="multicast",
+                                    method="UDP", bytes_out=len(datagram), bytes_in=0, ok=True)
+                # Paced, so a 802.15.4 mesh can forward each datagram before the next one
+                await asyncio.sleep(self.args.multicast_interval)
+
+    def client_sampling(self, round_idx):
+        """--client_num_per_round clients, as FedML's FedAvg samples them: seeded by the round, without replacement."""
+        client_num = self.args.client_num_per_round
+        if not 0 < client_num < len(self.clients):
+            return self.clients
+        np.random.seed(round_idx)
+        return [self.clients[i] for i in sorted(np.random.choice(len(self.clients), client_num, replace=False))]
+
+    async def run_round(self, round_idx):
+        self.round_idx = round_idx
+        start = time.perf_counter()
+        clients = self.client_sampling(round_idx)
+        # Every device trains on the same number of records, so the average is unweighted
+        aggregator = StreamingAggregator(self.model) if self.args.streaming else None
+        if self.multicast is not None:
+            await self.send_multicast()
+        if self.args.sequential:
+            results = []
+            for client in clients:
+                try:
+                    results.append(await self.client_round(client, aggregator))
+                except TransferError as e:
+                    results.append(e)
+        else:
+            results = await asyncio.gather(*(self.client_round(c, aggregator) for c in clients),
+                                           return_exceptions=True)
+
+        models = []
+        for client, result in zip(clients, results):
+            if isinstance(result, TransferError):
+                logging.info("[Round %d] dropping %s: %s" % (round_idx, client.address, result))
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                models.append(result)
+        received = bool(models) if aggregator is None else aggregator.weight.any()
+        if received:
+            with self.metrics.timer("aggregate", round=round_idx, clients=len(models)):
+                if aggregator is not None:
+                    # The partitions are already summed; only the division is left
+                    self.model = aggregator.model()
+                else:
+                    self.model = np.mean([m[0] for m in models], axis=0).astype(np.float32)
+                self.downlink.update(self.model)
+            if self.test_data is not None:
+                # Streaming keeps no client models, so only the global one is scored
+                received = [m[0] for m in models if m[0] is not None]
+                await self.start_scoring(round_idx, np.stack(received + [self.model]))
+            if self.on_model is not None:
+                self.on_model(round_idx, self.model)
+
+        seconds = time.perf_counter() - start
+        train_acc = np.mean([m[1] for m in models]) if models else float("nan")
+        eval_acc = np.mean([m[2] for m in models]) if models else float("nan")
+        logging.info("[Round %d] %d/%d clients, %.2fs, device train acc=%.4f, eval acc=%.4f"
+                     % (round_idx, len(models), len(clients), seconds, train_acc, eval_acc))
+        return self.metrics.record("round", round=round_idx, clients=len(models), seconds=seconds,
+                                   train_acc=float(train_acc), eval_acc=float(eval_acc))
+
+    async def client_loop(self, client, done):
+        """Buffered / async mode: train on the newest model, hand in the update, repeat."""
+        while not done.is_set():
+            # Read in the same step as client_round() takes its payloads
+            version = self.downlink.version
+            base = self.downlink.reference(client.codec)
+            try:
+                model, train_acc, eval_acc = await self.client_round(client)
+            except TransferError as e:
+                logging.info("[Version %d] %s failed, retrying: %s" % (version, client.address, e))
+                await asyncio.sleep(self.args.timeout)
+                continue
+            if done.is_set():
+                break
+            self.updates.append({"client": client.address, "version": version, "model": model,
+                                 "delta": model - base, "train_acc": train_acc, "eval_acc": eval_acc})
+            if len(self.updates) >= self.buffer_size():
+                await self.aggregate_updates(done)
+
+    def buffer_size(self):
+        if self.args.aggregation == "async":
+            return 1
+        return self.args.client_num_per_round if 0 < self.args.client_num_per_round else len(self.clients)
+
+    async def aggregate_updates(self, done):
+        """
+        Fold the buffered updates into the next model version, each weighted by
+        (1 + staleness) ** -staleness_exponent.
+        """
+        updates, self.updates = self.updates, []
+        round_idx = len(self.rounds)
+        staleness = np.array([self.downlink.version - u["version"] for u in updates], dtype=np.float64)
+        weights = (1.0 + staleness) ** -self.args.staleness_exponent
+        with self.metrics.timer("aggregate", round=round_idx, clients=len(updates)):
+            model = self.model.astype(np.float64)
+            if self.args.aggregation == "async":
+                for u, w in zip(updates, weights):
+                    alpha = self.args.async_alpha * w
+                    model = (1.0 - alpha) * model + alpha * u["model"]
+            else:
+                model += self.args.server_lr * np.mean([w * u["delta"] for u, w in zip(updates, weights)], axis=0)
+            self.model = model.astype(np.float32)
+            self.downlink.update(self.model)
+        self.round_idx = round_idx + 1
+
+        now = time.perf_counter()
+        seconds, self.last_aggregation = now - self.last_aggregation, now
+        train_acc = np.mean([u["train_acc"] for u in updates])
+        eval_acc = np.mean([u["eval_acc"] for u in updates])
+        logging.info("[Version %d] %d updates, staleness %.1f, %.2fs, device train acc=%.4f, eval acc=%.4f"
+                     % (round_idx, len(updates), staleness.mean(), seconds, train_acc, eval_acc))
+        self.rounds.append(self.metrics.record("round", round=round_idx, clients=len(updates), seconds=seconds,
+                                               staleness=float(staleness.mean()), train_acc=float(train_acc),
+                                               eval_acc=float(eval_acc)))
+        if len(self.rounds) >= self.args.comm_round:
+            done.set()
+        if self.test_data is not None:
+            await self.start_scoring(round_idx, np.stack([u["model"] for u in updates] + [self.model]))
+        if self.on_model is not None:
+            self.on_model(round_idx, self.model)
+
+    async def run_versions(self):
+        """Buffered / async mode: run the client loops until --comm_round model versions exist."""
+        done = asyncio.Event()
+        self.updates, self.rounds = [], []
+        self.round_idx = 0
+        self.last_aggregation = time.perf_counter()
+        loops = [asyncio.ensure_future(self.client_loop(c, done)) for c in self.clients]
+        await done.wait()
+        # Devices still training finish their round, so none is left mid-transfer; the
+        # updates they hand in after the last version are dropped
+        logging.info("%d model versions, waiting for %d clients" % (len(self.rounds), sum(not l.done() for l in loops)))
+        await asyncio.gather(*loops)
+        return self.rounds
+
+    def log_summary(self):
+        """Log the recorded bytes, requests and latencies per resource and per client."""
+        logging.info("%-12s %9s %12s %12s %10s %10s" % ("resource", "requests", "bytes out", "bytes in",
+                                                        "rtt mean", "rtt p99"))
+        for resource, s in sorted(self.metrics.summary("request", by=["resource"], ok=True).items()):
+            rtt = s.get("rtt", {"mean": float("nan"), "p99": float("nan")})
+            logging.info("%-12s %9d %12d %12d %9.3fs %9.3fs" % (resource, s["count"], s["bytes_out"]["sum"],
+                                                                s["bytes_in"]["sum"], rtt["mean"], rtt["p99"]))
+        requests = self.metrics.summary("request", by=["client"])
+        blocks = self.metrics.summary("block", by=["client"])
+        training = self.metrics.summary("command", by=["client"], command="train")
+        logging.info("%-28s %12s %12s %10s %12s %12s" % ("client", "bytes out", "bytes in", "retries",
+                                                         "block p99", "train mean"))
+        for client in self.clients:
+            s = requests.get(client.address)
+            if s is None:
+                continue
+            block_p99 = blocks[client.address]["seconds"]["p99"] if client.address in blocks else float("nan")
+            train = training[client.address]["seconds"]["mean"] if client.address in training else float("nan")
+            logging.info("%-28s %12d %12d %10d %11.3fs %11.3fs" % (client.address, s["bytes_out"]["sum"],
+                                                                 s["bytes_in"]["sum"], client.retransmissions,
+                                                                 block_p99, train))
+        aggregate = self.metrics.summary("aggregate")
+        if aggregate:
+            logging.info("aggregation: %.2fms mean over %d rounds"
+                         % (1000 * aggregate[None]["seconds"]["mean"], aggregate[None]["count"]))
+
+    def score(self, round_idx, models):
+        import firmware_inference
+        metrics = firmware_inference.FirmwareInference(models).score(*self.test_data,
+                                                                    threshold=self.args.threshold_evaluate)
+        logging.info("[Round %d] test device acc: clients %s, global %.4f, global argmax acc %.4f"
+                     % (round_idx, " ".join("%.4f" % a for a in metrics["device_acc"][:-1]),
+                        metrics["device_acc"][-1], metrics["argmax_acc"][-1]))
+        return metrics
+
+    async def start_scoring(self, round_idx, models):
+        """
+        Score the received models and the new global model in one stacked pass, on a
+        worker thread, while the next round runs.
+        """
+        await self.finish_scoring()
+        self.scoring = asyncio.get_running_loop().run_in_executor(None, self.score, round_idx, models)
+
+    async def finish_scoring(self):
+        if self.scoring is not None:
+            await self.scoring
+            self.scoring = None
+
+    async def train(self):
+        await self.start()
+        try:
+            if self.args.aggregation == "sync":
+                rounds = [await self.run_round(round_idx) for round_idx in range(self.args.comm_round)]
+            else:
+                rounds = await self.run_versions()
+            await self.finish_scoring()
+            return rounds
+        finally:
+            self.metrics.close()
+            await self.shutdown()
+
+
+def add_args(parser):
+    parser.add_argument('--clients', type=str, required=True,
+                        help='comma separated client addresses, each optionally @codec, '
+                             'e.g. "fd11:22::abcd,[::1]:5684@int8"')
+    parser.add_argument('--comm_round', type=int, default=120, help='number of aggregation rounds')
+    parser.add_argument('--codec', type=str, default='float16', choices=fc.CODECS,
+                        help='model encoding of the client firmware variant (clients without @codec)')
+    parser.add_argument('--topk', type=int, default=fc.DEFAULT_TOPK,
+                        help='delta_topk clients: delta entries uploaded per round')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds before a request is retried')
+    parser.add_argument('--train_timeout', type=float, default=120.0, help='seconds a client may train')
+    parser.add_argument('--retries', type=int, default=3, help='retries per partition transfer')
+    parser.add_argument('--max_in_flight', type=int, default=8,
+                        help='partition transfers on the network at once (one per client at most)')
+    parser.add_argument('--sequential', action='store_true', help='serve one client and one partition at a time')
+    parser.add_argument('--lr', type=float, default=0.1, help='device learning rate')
+    parser.add_argument('--momentum', type=float, default=0.9, help='device momentum')
+    parser.add_argument('--sgd_iteration', type=int, default=3, help='device passes over its batch')
+    parser.add_argument('--batch_size', type=int, default=10, help='device records per activity and round')
+    parser.add_argument('--threshold_training', type=float, default=0.00005, help='device training accuracy threshold')
+    parser.add_argument('--threshold_evaluate', type=float, default=0.01, help='device evaluation accuracy threshold')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the initial global model')
+    parser.add_argument('--test', type=str, default=None,
+                        help='test fold JSON; scores every received model each round with the firmware arithmetic')
+    parser.add_argument('--output', type=str, default='global_model.npz', help='where the final model is saved')
+    parser.add_argument('--aggregation', type=str, default='sync', choices=['sync', 'buffered', 'async'],
+                        help='sync rounds, FedBuff-style buffered or FedAsync-style aggregation')
+    parser.add_argument('--client_num_per_round', type=int, default=0,
+                        help='sync: clients sampled per round; buffered: updates per aggregation (0 = all clients)')
+    parser.add_argument('--staleness_exponent', type=float, default=0.5,
+                        help='an update staleness versions old is weighted (1 + staleness) ** -exponent')
+    parser.add_argument('--server_lr', type=float, default=0.5,
+                        help='buffered: step size of the averaged update; below 1, as the first buffers all '
+                             'hold updates trained from the same model')
+    parser.add_argument('--async_alpha', type=float, default=0.6,
+                        help='async: weight of a fresh update when it is mixed into the model')
+    parser.add_argument('--streaming', action='store_true',
+                        help='sync: fold every uploaded partition into a running average as it arrives, '
+                             'instead of keeping each client\'s model until the round ends')
+    parser.add_argument('--stream_batch', type=int, default=4,
+                        help='streaming: uploaded partitions of a client decoded and added together')
+    parser.add_argument('--multicast', type=str, default='',
+                        help='multicast the global model to this group, e.g. "[ff03::1]:234", and repair by unicast')
+    parser.add_argument('--multicast_if', type=str, default='', help='interface of the multicast group, e.g. wpan0')
+    parser.add_argument('--multicast_hops', type=int, default=16, help='hop limit of the multicast datagrams')
+    parser.add_argument('--multicast_interval', type=float, default=0.05,
+                        help='seconds between two multicast datagrams')
+    parser.add_argument('--metrics_path', type=str, default='',
+                        help='JSONL (or .csv) file receiving every request, transfer and round event')
+    return parser
+
+
+if __name__ == "__main__":
+    parser = add_args(argparse.ArgumentParser())
+    args = parser.parse_args()
+    if args.multicast and args.aggregation != "sync":
+        parser.error("--multicast distributes one model per round; use it with --aggregation sync")
+    if args.streaming and args.aggregation != "sync":
+        parser.error("--streaming averages one round's uploads; use it with --aggregation sync")
+    if args.stream_batch < 1:
+        parser.error("--stream_batch must be at least 1")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    server = AggregationServer([a.strip() for a in args.clients.split(",") if a.strip()], args)
+    asyncio.run(server.train())
+    server.log_summary()
+    hidden, output = fc.split_model(server.model)
+    np.savez(args.output, hidden=hidden, output=output)
+    logging.info("global model saved to %s" % args.output)
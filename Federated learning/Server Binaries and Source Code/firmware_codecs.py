@@ -0,0 +1,400 @@
+'''
+Vectorized encode/decode of the five FedCoRE firmware model encodings.
+
+A model is one flat float32 vector of MODEL_SIZE values: HiddenWeights (3640)
+followed by OutputWeights (246), in the firmware's order. Every function also takes
+a stack of models (..., MODEL_SIZE), so all clients of a round are coded at once.
+
+    float32      4-byte floats                        (sleepy-demo-mtd-ultim)
+    float16      firmware-rounded halves              (ultim-float16)
+    int8         (int)(w * 254 / (wmax - wmin))       (ultim-int8)
+    delta_quant  the same on delta = global - trained (ultim-delta-quant)
+    delta_bin    1 if delta is closer to deltamax     (ultim-delta-binarisation)
+
+The firmware sends int8, delta_quant and delta_bin as one byte per value, and
+returns [train acc, eval acc, min, max] as four floats on heartbit code 23.
+delta_bin_packed is delta_bin with eight values per byte (bit i of byte i // 8),
+for firmware that packs its bools.
+
+delta_topk sends only the k largest-magnitude entries of delta, as (u16 index,
+float16 value) pairs. Each partition carries the pairs whose index falls in it, so
+a GET returns 0 to 255 pairs. The device keeps the entries it did not send in a
+residual and adds them to the next round's delta (error feedback). The residual
+only moves on once the server has read every partition of the upload, so an upload
+the server never collected is folded into the next one whole.
+'''
+
+import numpy as np
+
+import firmware_protocol as fp
+
+MODEL_SIZE = fp.HIDDEN_SIZE + fp.OUTPUT_SIZE
+
+CODECS = ["float32", "float16", "int8", "delta_quant", "delta_bin", "delta_bin_packed", "delta_topk"]
+FLOAT_CODECS = ["float32", "float16"]
+DELTA_CODECS = ["delta_quant", "delta_bin", "delta_bin_packed", "delta_topk"]
+QUANT_LEVELS = 254
+# delta_topk: 5% of the weights by default, 4 bytes per entry
+DEFAULT_TOPK = 194
+SPARSE_ENTRY = np.dtype([('index', '<u2'), ('value', '<u2')])
+
+# Published totals: (client readme.txt, communication in, communication out)
+README_TOTALS = {
+    "float32": ("Client bin without optimization (32 bits)", 20736000, 2323200),
+    "float16": ("Client bin with model quatization optimization 16 bits", 12441600, 1393920),
+    "int8": ("Client bin with model quatization optimization 8 bits", 8303040, 1393920),
+    "delta_quant": ("Client bin with Delta quatization  optimization (8bits)", 8303040, 1393920),
+}
+
+
+def downlink_dtype(codec):
+    """Only the 32-bit firmware reads float32 models; the optimized variants all read float16."""
+    return "float32" if codec == "float32" else "float16"
+
+
+def join_model(hidden, output):
+    return np.concatenate([hidden, output], axis=-1).astype(np.float32)
+
+
+def split_model(model):
+    return model[..., :fp.HIDDEN_SIZE], model[..., fp.HIDDEN_SIZE:]
+
+
+def partition_slices():
+    """Where each of the 16 partitions lies in a flat model."""
+    slices = []
+    for partition in range(fp.NUM_PARTITIONS):
+        start, stop = fp.partition_range(partition)
+        offset = fp.HIDDEN_SIZE if partition == fp.OUTPUT_PARTITION else 0
+        slices.append(slice(offset + start, offset + stop))
+    return slices
+
+
+PARTITION_SLICES = partition_slices()
+PARTITION_STARTS = np.array([s.start for s in PARTITION_SLICES])
+PARTITION_STOPS = np.array([s.stop for s in PARTITION_SLICES])
+
+
+def device_view(model, codec):
+    """The global model as the device holds it after the downlink rounding."""
+    model = np.asarray(model, dtype=np.float32)
+    if downlink_dtype(codec) == "float16":
+        return fp.half2float(fp.float2half(model)).reshape(model.shape)
+    return model
+
+
+def value_range(values):
+    """max() / min() in the firmware: both start at 0, so vmin <= 0 <= vmax."""
+    vmax = values.max(axis=-1, initial=np.float32(0))
+    vmin = values.min(axis=-1, initial=np.float32(0))
+    return vmin.astype(np.float32), vmax.astype(np.float32)
+
+
+def quantize(values, vmin, vmax):
+    """
+    (int)(v * 254 / (vmax - vmin)) stored in a u_int8_t, evaluated in float32 like the device.
+
+    Negative codes wrap modulo 256; dequantize() undoes that with vmin/vmax.
+    """
+    scale = (vmax - vmin)[..., None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = values * np.float32(QUANT_LEVELS) / scale
+    q = np.where(scale > 0, q, np.float32(0))
+    return np.trunc(q).astype(np.int32).astype(np.uint8)
+
+
+def dequantize(codes, vmin, vmax):
+    """
+    Recover the signed codes and scale them back.
+
+    Every code lies between trunc(vmin * 254 / range) <= 0 and trunc(vmax * 254 / range) >= 0,
+    fewer than 256 integers, so the modulo-256 byte determines it.
+    """
+    vmin = np.asarray(vmin, dtype=np.float32)
+    vmax = np.asarray(vmax, dtype=np.float32)
+    scale = vmax - vmin
+    with np.errstate(divide='ignore', invalid='ignore'):
+        top = np.where(scale > 0, np.trunc(vmax * np.float32(QUANT_LEVELS) / scale), 0).astype(np.int32)
+    q = codes.astype(np.int32)
+    q = np.where(q > top[..., None], q - 256, q)
+    return (q.astype(np.float32) * (scale / np.float32(QUANT_LEVELS))[..., None]).astype(np.float32)
+
+
+def binarize(values, vmin, vmax):
+    """delta_binarisation(): 1 where (d - min) / range > (max - d) / range."""
+    scale = (vmax - vmin)[..., None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bits = (values - vmin[..., None]) / scale > (vmax[..., None] - values) / scale
+    return bits.astype(np.uint8)
+
+
+def debinarize(bits, vmin, vmax):
+    vmin = np.asarray(vmin, dtype=np.float32)[..., None]
+    vmax = np.asarray(vmax, dtype=np.float32)[..., None]
+    return np.where(bits.astype(bool), vmax, vmin).astype(np.float32)
+
+
+def top_k(values, k):
+    """Sorted indices of the k largest-magnitude values along the last axis."""
+    k = min(k, values.shape[-1])
+    indices = np.argpartition(-np.abs(values), k - 1, axis=-1)[..., :k] if k else values[..., :0].astype(np.int64)
+    return np.sort(indices, axis=-1)
+
+
+def sparsify(values, k):
+    """values with all but the top_k() entries zeroed, the kept ones float16-rounded as sent."""
+    indices = top_k(values, k)
+    kept = np.take_along_axis(values, indices, axis=-1)
+    sparse = np.zeros_like(values)
+    np.put_along_axis(sparse, indices, fp.half2float(fp.float2half(kept)).reshape(kept.shape), axis=-1)
+    return sparse
+
+
+def compress(codec, model, reference=None, k=DEFAULT_TOPK):
+    """
+    Per-value codes of one or more models, with the (vmin, vmax) the device reports.
+
+    reference is the global model as the device received it (see device_view), needed
+    by the delta codecs. Float codecs return float16 bits or the float32 values, and
+    delta_topk the dense delta with everything but its k entries zeroed.
+    """
+    model = np.asarray(model, dtype=np.float32)
+    vmin = vmax = np.zeros(model.shape[:-1], dtype=np.float32)
+    if codec == "float32":
+        return model, vmin, vmax
+    if codec == "float16":
+        return fp.float2half(model).reshape(model.shape), vmin, vmax
+    values = model if codec == "int8" else np.asarray(reference, dtype=np.float32) - model
+    if codec == "delta_topk":
+        values = sparsify(values, k)
+    vmin, vmax = value_range(values)
+    if codec in ("int8", "delta_quant"):
+        return quantize(values, vmin, vmax), vmin, vmax
+    if codec == "delta_topk":
+        return values, vmin, vmax
+    return binarize(values, vmin, vmax), vmin, vmax
+
+
+def decompress(codec, codes, vmin=None, vmax=None, reference=None):
+    """Inverse of compress(): the models the server reconstructs."""
+    if codec == "float32":
+        return np.asarray(codes, dtype=np.float32)
+    if codec == "float16":
+        return fp.half2float(codes).reshape(codes.shape)
+    if codec in ("int8", "delta_quant"):
+        values = dequantize(codes, vmin, vmax)
+    elif codec == "delta_topk":
+        values = np.asarray(codes, dtype=np.float32)
+    else:
+        values = debinarize(codes, vmin, vmax)
+    if codec == "int8":
+        return values
+    return (np.asarray(reference, dtype=np.float32) - values).astype(np.float32)
+
+
+def pack_bits(bits):
+    return np.packbits(bits, axis=-1, bitorder='little')
+
+
+def unpack_bits(packed, count):
+    return np.unpackbits(np.asarray(packed, dtype=np.uint8), axis=-1, count=count, bitorder='little')
+
+
+def encode_sparse(indices, values):
+    """The 16 delta_topk payloads: (index, float16 value) pairs, sorted by index, in their partition."""
+    entries = np.empty(len(indices), dtype=SPARSE_ENTRY)
+    entries['index'] = indices
+    entries['value'] = fp.float2half(np.asarray(values, dtype=np.float32))
+    cuts = np.searchsorted(indices, [s.stop for s in PARTITION_SLICES[:-1]])
+    return [part.tobytes() for part in np.split(entries, cuts)]
+
+
+def decode_sparse(payloads):
+    """(indices, values) of the delta_topk payloads of one device."""
+    data = b"".join(payloads)
+    if len(data) % SPARSE_ENTRY.itemsize:
+        raise ValueError("truncated sparse update: %d bytes" % len(data))
+    entries = np.frombuffer(data, dtype=SPARSE_ENTRY)
+    indices = entries['index'].astype(np.int64)
+    if len(indices) and indices.max() >= MODEL_SIZE:
+        raise ValueError("sparse index %d out of range" % indices.max())
+    return indices, fp.half2float(entries['value']).reshape(-1)
+
+
+def sparse_average(reference, updates):
+    """
+    FedAvg of delta_topk clients that all trained from reference: reference minus
+    the mean of their deltas, scatter-added from the (indices, values) of each update.
+    """
+    reference = np.asarray(reference, dtype=np.float32)
+    if not updates:
+        return reference.copy()
+    indices = np.concatenate([u[0] for u in updates])
+    values = np.concatenate([u[1] for u in updates]).astype(np.float64)
+    delta = np.bincount(indices, weights=values, minlength=MODEL_SIZE) / len(updates)
+    return (reference - delta).astype(np.float32)
+
+
+def encode_uplink(codec, model, reference=None, train_acc=0.0, eval_acc=0.0, k=DEFAULT_TOPK, residual=None,
+                  leftover=None):
+    """
+    What one device sends: the 16 Local_Model GET payloads and, for the non-float
+    codecs, the 16-byte heartbit 23 reply (else None).
+
+    delta_topk sends the k largest entries of delta + residual. leftover, when given,
+    is filled in place with what was left unsent: the device's next residual, once
+    the server has read this upload.
+    """
+    if codec in FLOAT_CODECS:
+        # Partition 15 is padded to 255 values, with the accuracies at 246 and 247
+        values = np.zeros(fp.HIDDEN_SIZE + fp.PARTITION_SIZE, dtype=np.float32)
+        values[:MODEL_SIZE] = model
+        values[fp.HIDDEN_SIZE + fp.TRAIN_ACC_INDEX] = train_acc
+        values[fp.HIDDEN_SIZE + fp.EVAL_ACC_INDEX] = eval_acc
+        raw = fp.pack_values(values, codec)
+        width = len(raw) // len(values)
+        bounds = [(s.start, s.stop) for s in PARTITION_SLICES[:-1]] + [(fp.HIDDEN_SIZE, len(values))]
+        return [raw[start * width:stop * width] for start, stop in bounds], None
+    if codec == "delta_topk":
+        delta = np.asarray(reference, dtype=np.float32) - model
+        if residual is not None:
+            delta = delta + residual
+        indices = top_k(delta, k)
+        sent = fp.half2float(fp.float2half(delta[indices])).reshape(-1)
+        if leftover is not None:
+            leftover[:] = delta
+            leftover[indices] -= sent
+        vmin, vmax = value_range(sent)
+        stats = np.array([train_acc, eval_acc, vmin, vmax], dtype='<f4').tobytes()
+        return encode_sparse(indices, sent), stats
+    codes, vmin, vmax = compress(codec, model, reference)
+    if codec == "delta_bin_packed":
+        payloads = [pack_bits(codes[s]).tobytes() for s in PARTITION_SLICES]
+    else:
+        payloads = [codes[s].tobytes() for s in PARTITION_SLICES]
+    stats = np.array([train_acc, eval_acc, vmin, vmax], dtype='<f4').tobytes()
+    return payloads, stats
+
+
+def decode_uplink(codec, payloads, stats=None, reference=None):
+    """Inverse of encode_uplink(): (model, train_acc, eval_acc)."""
+    if codec in FLOAT_CODECS:
+        values = fp.unpack_values(b"".join(payloads), codec)
+        if len(values) != fp.HIDDEN_SIZE + fp.PARTITION_SIZE:
+            raise ValueError("incomplete model: %d of %d values" % (len(values), fp.HIDDEN_SIZE + fp.PARTITION_SIZE))
+        tail = values[fp.HIDDEN_SIZE:]
+        return values[:MODEL_SIZE].copy(), float(tail[fp.TRAIN_ACC_INDEX]), float(tail[fp.EVAL_ACC_INDEX])
+
+    train_acc, eval_acc, vmin, vmax = np.frombuffer(stats[:16], dtype='<f4')
+    if codec == "delta_topk":
+        indices, values = decode_sparse(payloads)
+        model = np.array(reference, dtype=np.float32)
+        model[indices] -= values
+        return model, float(train_acc), float(eval_acc)
+    if codec == "delta_bin_packed":
+        parts = [unpack_bits(np.frombuffer(payload, dtype=np.uint8), s.stop - s.start)
+                 for payload, s in zip(payloads, PARTITION_SLICES)]
+    else:
+        parts = [np.frombuffer(payload, dtype=np.uint8) for payload in payloads]
+    codes = np.concatenate(parts)
+    if len(codes) != MODEL_SIZE:
+        raise ValueError("incomplete model: %d of %d values" % (len(codes), MODEL_SIZE))
+    model = decompress(codec, codes, vmin, vmax, reference)
+    return model, float(train_acc), float(eval_acc)
+
+
+def decode_partition(codec, partition, payload, stats=None, reference=None):
+    """
+    decode_uplink() for one Local_Model GET payload: the model values of
+    PARTITION_SLICES[partition]. stats is the heartbit 23 reply, read before the
+    partitions, so each partition can be decoded as it arrives.
+    """
+    return decode_partitions(codec, partition, [payload], stats, reference)
+
+
+def decode_partitions(codec, first, payloads, stats=None, reference=None):
+    """
+    decode_partition() of the consecutive partitions first, first + 1, ... in one
+    vectorized pass: the model values from PARTITION_SLICES[first].start on.
+    """
+    slices = PARTITION_SLICES[first:first + len(payloads)]
+    s = slice(slices[0].start, slices[-1].stop)
+    if codec in FLOAT_CODECS:
+        width = 2 if codec == "float16" else 4
+        for partition, (payload, p) in enumerate(zip(payloads, slices), first):
+            if len(payload) % width or len(payload) < (p.stop - p.start) * width:
+                raise ValueError("partition %d: %d bytes for %d values" % (partition, len(payload), p.stop - p.start))
+        # Partition 15 also carries the accuracies and padding
+        data = b"".join(payload[:(p.stop - p.start) * width] for payload, p in zip(payloads, slices))
+        return fp.unpack_values(data, codec)
+
+    _, _, vmin, vmax = np.frombuffer(stats[:16], dtype='<f4')
+    if codec == "delta_topk":
+        for partition, payload in enumerate(payloads, first):
+            if len(payload) % SPARSE_ENTRY.itemsize:
+                raise ValueError("partition %d: truncated sparse update: %d bytes" % (partition, len(payload)))
+        indices, values = decode_sparse(payloads)
+        counts = [len(payload) // SPARSE_ENTRY.itemsize for payload in payloads]
+        # The partition each entry lies in must be the one whose payload carried it
+        outside = np.searchsorted(PARTITION_STOPS, indices, side='right') != np.repeat(
+            np.arange(first, first + len(payloads)), counts)
+        if outside.any():
+            partition = first + int(np.searchsorted(np.cumsum(counts), np.argmax(outside), side='right'))
+            p = PARTITION_SLICES[partition]
+            raise ValueError("partition %d: sparse index outside %d-%d" % (partition, p.start, p.stop))
+        part = np.array(reference[s], dtype=np.float32)
+        part[indices - s.start] -= values
+        return part
+    if codec == "delta_bin_packed":
+        codes = [unpack_bits(np.frombuffer(payload, dtype=np.uint8), p.stop - p.start)
+                 for payload, p in zip(payloads, slices)]
+    else:
+        codes = [np.frombuffer(payload, dtype=np.uint8) for payload in payloads]
+    for partition, (part, p) in enumerate(zip(codes, slices), first):
+        if len(part) != p.stop - p.start:
+            raise ValueError("partition %d: %d of %d values" % (partition, len(part), p.stop - p.start))
+    codes = codes[0] if len(codes) == 1 else np.concatenate(codes)
+    return decompress(codec, codes, vmin, vmax, None if reference is None else reference[s])
+
+
+def uplink_accuracies(codec, last_payload=None, stats=None):
+    """(train_acc, eval_acc) of an upload: from partition 15 for the float codecs, else from stats."""
+    if codec in FLOAT_CODECS:
+        tail = fp.unpack_values(last_payload, codec)
+        return float(tail[fp.TRAIN_ACC_INDEX]), float(tail[fp.EVAL_ACC_INDEX])
+    train_acc, eval_acc = np.frombuffer(stats[:8], dtype='<f4')
+    return float(train_acc), float(eval_acc)
+
+
+def encode_downlink(codec, model, hyperparams=None):
+    """The 16 escaped Local_Model POST payloads for a global model."""
+    hidden, output = split_model(np.asarray(model, dtype=np.float32))
+    return fp.downlink_payloads(hidden, output, hyperparams, downlink_dtype(codec))
+
+
+def uplink_bytes(codec, k=DEFAULT_TOPK):
+    """Payload bytes one device uploads per round, the heartbit 23 reply included."""
+    if codec == "delta_topk":
+        return SPARSE_ENTRY.itemsize * min(k, MODEL_SIZE) + 16
+    if codec in FLOAT_CODECS:
+        per_value = 4 if codec == "float32" else 2
+        return per_value * (fp.HIDDEN_SIZE + fp.PARTITION_SIZE)
+    if codec == "delta_bin_packed":
+        return sum((s.stop - s.start + 7) // 8 for s in PARTITION_SLICES) + 16
+    return MODEL_SIZE + 16
+
+
+def readme_bytes(codec, rounds=120, clients=9, values=3840):
+    """
+    Communication in/out as counted in the client readme.txt files.
+
+    Their convention: `values` values per model, each counted with one byte more than
+    its encoding, plus the min/max floats of the 8-bit codecs on every upload; the
+    model goes down once more than there are rounds.
+    """
+    per_value = {"float32": 4, "float16": 2, "int8": 1, "delta_quant": 1, "delta_bin": 1}[codec]
+    side = 8 if codec in ("int8", "delta_quant") else 0
+    down = 4 if downlink_dtype(codec) == "float32" else 2
+    bytes_in = rounds * clients * (values * (per_value + 1) + side)
+    bytes_out = (rounds + 1) * values * (down + 1)
+    return bytes_in, bytes_out
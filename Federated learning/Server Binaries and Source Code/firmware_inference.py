@@ -0,0 +1,169 @@
+'''
+Server-side evaluation of client models with the firmware's arithmetic.
+
+The devices run a 90-40-6 network with sigmoid hidden and output layers, in
+float32, accumulating every neuron input by input, and count a record as correct
+when its MSE is below threshold_evaluate (Evaluate() in sleepy-mtd.c).
+FirmwareInference reproduces that on a stack of N models in the flat firmware
+layout, as decoded from any codec, and scores all of them in one batched pass:
+
+    python firmware_inference.py --models round_models.npz --test "../../Centralized learning/data/test/fold_2_test.json"
+'''
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+import firmware_codecs as fc
+import firmware_protocol as fp
+
+# generate_json_data.py labels (LabelEncoder: Downstairs, Jogging, Sitting, Standing,
+# Upstairs, Walking) -> the firmware's order (Jogging, Walking, Downstairs, Upstairs,
+# Sitting, Standing; see data/FL_clients_data/merge.py)
+WISDM_TO_FIRMWARE = [2, 0, 4, 5, 3, 1]
+
+
+def device_inputs(windows, normalize=True):
+    """
+    (B, 30, 3) windows as the firmware feeds them: divided by the largest absolute
+    value per axis (max_xyz() / normalize()), then regrouped as 30 x, 30 y, 30 z (tri_xyz()).
+    """
+    x = np.asarray(windows, dtype=np.float32)
+    if normalize:
+        x = x / np.maximum(np.abs(x).max(axis=(0, 1)), np.float32(0.00001))
+    return np.ascontiguousarray(x.transpose(0, 2, 1).reshape(len(x), -1))
+
+
+def load_test_fold(json_path, normalize=True):
+    """A generate_json_data.py fold as (device inputs, firmware labels)."""
+    with open(json_path, 'r') as f:
+        fold = json.load(f)
+    xs, ys = [], []
+    for user_id in fold["users"]:
+        user = fold["user_data"][str(user_id)]
+        xs.append(np.asarray(user["x"], dtype=np.float32))
+        ys.append(np.asarray(user["y"], dtype=np.int64))
+    labels = np.asarray(WISDM_TO_FIRMWARE)[np.concatenate(ys)]
+    return device_inputs(np.concatenate(xs), normalize), labels
+
+
+class FirmwareInference(object):
+    """
+    A stack of N firmware models, evaluated together.
+
+    exact=True replays the device's order of float32 operations: each neuron starts
+    from its bias and adds input * weight one input at a time, the sigmoid is taken
+    in double and stored as float, and the MSE is accumulated like forward().
+    exact=False uses batched matmuls (BLAS summation order) and float32 sigmoids for
+    speed; its outputs differ from the device's in the last bits.
+    """
+
+    def __init__(self, models, exact=True, device="cpu"):
+        models = torch.as_tensor(np.asarray(models, dtype=np.float32), device=device).reshape(-1, fc.MODEL_SIZE)
+        self.num_models = models.size(0)
+        self.hidden = models[:, :fp.HIDDEN_SIZE].reshape(-1, fp.INPUT_NODES + 1, fp.HIDDEN_NODES)
+        self.output = models[:, fp.HIDDEN_SIZE:].reshape(-1, fp.HIDDEN_NODES + 1, fp.OUTPUT_NODES)
+        self.exact = exact
+        self.device = device
+
+    @classmethod
+    def from_codes(cls, codec, codes, vmin=None, vmax=None, reference=None, exact=True, device="cpu"):
+        """Models as the server reconstructs them from firmware_codecs.compress() output."""
+        return cls(fc.decompress(codec, codes, vmin, vmax, reference), exact, device)
+
+    @staticmethod
+    def _sigmoid(accum):
+        # 1.0 / (1.0 + exp(-Accum)) is evaluated in double and stored in a float
+        return (1.0 / (1.0 + torch.exp(-accum.double()))).float()
+
+    def _layer(self, x, weights):
+        """x: (N or 1, B, I) activations, weights: (N, I + 1, O) with the bias row last."""
+        accum = weights[:, -1].unsqueeze(1).repeat(1, x.size(1), 1)
+        product = torch.empty_like(accum)
+        for j in range(weights.size(1) - 1):
+            torch.mul(x[:, :, j:j + 1], weights[:, j].unsqueeze(1), out=product)
+            accum += product
+        return self._sigmoid(accum)
+
+    def _fast_forward(self, x):
+        # One GEMM of the inputs against every model's hidden weights, then a batched one
+        hidden = x @ self.hidden[:, :-1].permute(1, 0, 2).reshape(fp.INPUT_NODES, -1)
+        hidden = hidden.view(x.size(0), self.num_models, fp.HIDDEN_NODES).transpose(0, 1)
+        hidden = torch.sigmoid(hidden + self.hidden[:, -1:])
+        return torch.sigmoid(torch.baddbmm(self.output[:, -1:], hidden, self.output[:, :-1]))
+
+    def forward(self, x):
+        """Sigmoid outputs (N, B, 6) of every model for device inputs x (B, 90)."""
+        x = torch.as_tensor(np.asarray(x, dtype=np.float32), device=self.device)
+        if not self.exact:
+            return self._fast_forward(x)
+        return self._layer(self._layer(x.unsqueeze(0), self.hidden), self.output)
+
+    def mse(self, outputs, labels):
+        """forward()'s error: float error += 1.0/OutputNodes * (t - o)^2, the term in double."""
+        targets = torch.nn.functional.one_hot(labels, fp.OUTPUT_NODES).float()
+        diff = targets.unsqueeze(0) - outputs
+        if not self.exact:
+            return (diff * diff).mean(2)
+        error = torch.zeros(diff.shape[:2], dtype=torch.float32, device=outputs.device)
+        for i in range(fp.OUTPUT_NODES):
+            d = diff[:, :, i].double()
+            error = (error.double() + 1.0 / fp.OUTPUT_NODES * d * d).float()
+        return error
+
+    def score(self, x, labels, threshold=fp.DEFAULT_HYPERPARAMS["threshold_evaluate"], batch_size=1024):
+        """
+        Per-model metrics over a test set: the device's thresholded accuracy, the
+        argmax accuracy and the mean MSE, each an array of N values.
+        """
+        labels = torch.as_tensor(np.asarray(labels), dtype=torch.int64, device=self.device)
+        correct = torch.zeros(self.num_models, device=self.device)
+        argmax_correct = torch.zeros(self.num_models, device=self.device)
+        error_sum = torch.zeros(self.num_models, dtype=torch.float64, device=self.device)
+        with torch.no_grad():
+            for start in range(0, len(labels), batch_size):
+                batch_labels = labels[start:start + batch_size]
+                outputs = self.forward(x[start:start + batch_size])
+                error = self.mse(outputs, batch_labels)
+                correct += (error < threshold).sum(1)
+                argmax_correct += (outputs.argmax(2) == batch_labels).sum(1)
+                error_sum += error.double().sum(1)
+        n = float(len(labels))
+        return {"device_acc": (correct / n).cpu().numpy(), "argmax_acc": (argmax_correct / n).cpu().numpy(),
+                "mse": (error_sum / n).cpu().numpy()}
+
+
+def load_models(path, codec):
+    """An .npz with either `model` (N, 3886) floats or compress() output: codes, vmin, vmax[, reference]."""
+    saved = np.load(path)
+    if "model" in saved:
+        return saved["model"]
+    if {"hidden", "output"} <= set(saved.files):  # coap_server.py --output
+        return fc.join_model(saved["hidden"], saved["output"])
+    reference = saved["reference"] if "reference" in saved else None
+    return fc.decompress(codec, saved["codes"], saved["vmin"], saved["vmax"], reference)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, required=True, help='.npz of models or of codec output')
+    parser.add_argument('--codec', type=str, default='int8', choices=fc.CODECS, help='codec of the stored codes')
+    parser.add_argument('--test', type=str, required=True, help='a test fold written by generate_json_data.py')
+    parser.add_argument('--no_normalize', action='store_true', help='feed the fold without max-abs scaling')
+    parser.add_argument('--threshold', type=float, default=fp.DEFAULT_HYPERPARAMS["threshold_evaluate"],
+                        help="device accuracy threshold (threshold_evaluate)")
+    parser.add_argument('--fast', action='store_true', help='batched matmuls instead of the firmware order')
+    args = parser.parse_args()
+
+    x, labels = load_test_fold(args.test, not args.no_normalize)
+    engine = FirmwareInference(load_models(args.models, args.codec), exact=not args.fast)
+    start = time.perf_counter()
+    metrics = engine.score(x, labels, args.threshold)
+    seconds = time.perf_counter() - start
+    print("%d models x %d records in %.3fs" % (engine.num_models, len(labels), seconds))
+    print("%6s %12s %12s %10s" % ("model", "device acc", "argmax acc", "mse"))
+    for i in range(engine.num_models):
+        print("%6d %12.4f %12.4f %10.5f" % (i, metrics["device_acc"][i], metrics["argmax_acc"][i], metrics["mse"][i]))
@@ -0,0 +1,257 @@
+'''
+The model exchange protocol of the FedCoRE client firmware (sleepy-mtd.c).
+
+The firmware keeps the 90-40-6 network in two flat float arrays,
+HiddenWeights[j*HiddenNodes + i] and OutputWeights[j*OutputNodes + i], where
+row j = InputNodes (resp. HiddenNodes) holds the biases. Both travel in
+partitions of 255 values: partitions 0-14 carry HiddenWeights (the last one
+only 70 values), partition 15 carries OutputWeights.
+
+A transfer is two CoAP requests: a POST of one byte (30 + partition) to
+`heartbit` selects the partition, then a GET on `Local_Model` reads it or a
+POST writes it. Heartbit codes 21 and 22 start local training and evaluation.
+
+The global model can also be multicast to the firmware's MULTICAST_ADDR and
+RECV_PORT, one UDP datagram per partition; heartbit code 24 then returns the
+partitions a device missed, which are repaired by unicast.
+'''
+
+import logging
+import struct
+
+import numpy as np
+
+INPUT_NODES = 90
+HIDDEN_NODES = 40
+OUTPUT_NODES = 6
+
+HIDDEN_SIZE = (INPUT_NODES + 1) * HIDDEN_NODES  # 3640
+OUTPUT_SIZE = (HIDDEN_NODES + 1) * OUTPUT_NODES  # 246
+
+PARTITION_SIZE = 255
+OUTPUT_PARTITION = 15
+NUM_PARTITIONS = OUTPUT_PARTITION + 1
+
+MODEL_URI = "Local_Model"
+HEARTBIT_URI = "heartbit"
+ACTUALINF_URI = "actualinf"
+
+# heartbit POST payload is one byte: HEARTBIT_OFFSET + partition or command
+HEARTBIT_OFFSET = 30
+TRAIN = 21
+EVALUATE = 22
+STATS = 23
+MISSING = 24
+
+# Downlink partition 15 carries the hyperparameters after the output weights;
+# the firmware applies them when it reads value 254.
+HYPERPARAMS = ["momentum", "lr", "sgd_iteration", "batch_size", "threshold_training", "threshold_evaluate"]
+HYPERPARAM_OFFSET = 248
+DEFAULT_HYPERPARAMS = {"momentum": 0.9, "lr": 0.1, "sgd_iteration": 3, "batch_size": 10,
+                       "threshold_training": 0.00005, "threshold_evaluate": 0.01}
+
+# Uplink partition 15 of the float variants appends the device's accuracies
+TRAIN_ACC_INDEX = 246
+EVAL_ACC_INDEX = 247
+
+# recuperer_zero() turns this sequence back into a zero byte
+ZERO_ESCAPE = b'\x01\x03\x01'
+# Local_Model reads the request payload into char data[1200]
+MAX_DOWNLINK_PAYLOAD = 1199
+# data_checker() counts the weights at or beyond this magnitude as corrupt
+WEIGHT_LIMIT = 20
+# otLinkSetPollPeriod() of the sleepy end device
+SLEEPY_POLL_PERIOD_MS = 10000
+
+# Multicast datagram: MULTICAST_MAGIC | round (u16) | 1 if float32 | partition | Local_Model POST payload
+MULTICAST_ADDR = "ff03::1"
+RECV_PORT = 234
+MULTICAST_MAGIC = b'FM'
+MULTICAST_HEADER = struct.Struct('<2sHBB')
+
+
+def partition_range(partition):
+    """(start, stop) of a partition in HiddenWeights (0-14) or OutputWeights (15)."""
+    if partition == OUTPUT_PARTITION:
+        return 0, OUTPUT_SIZE
+    start = partition * PARTITION_SIZE
+    return start, min(start + PARTITION_SIZE, HIDDEN_SIZE)
+
+
+def heartbit_code(code):
+    return bytes([HEARTBIT_OFFSET + code])
+
+
+def init_weights(seed=0, weight_max=0.9):
+    """initWeights(): every weight uniform on the grid 2 * (k/100 - 0.5) * weight_max."""
+    rng = np.random.RandomState(seed)
+    hidden = (2.0 * (rng.randint(0, 101, HIDDEN_SIZE) / 100.0 - 0.5) * weight_max).astype(np.float32)
+    output = (2.0 * (rng.randint(0, 101, OUTPUT_SIZE) / 100.0 - 0.5) * weight_max).astype(np.float32)
+    return hidden, output
+
+
+def float2half(x):
+    """Vectorized port of the firmware's float2half(): float32 -> IEEE half bits (uint16)."""
+    b = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32) + np.uint32(0x1000)
+    e = (b & 0x7F800000) >> 23
+    m = b & 0x007FFFFF
+    normal = np.where(e > 112, (((e - 112) << 10) & 0x7C00) | (m >> 13), 0)
+    shift = np.where((e < 113) & (e > 101), 125 - e, 0)
+    denormal = np.where((e < 113) & (e > 101), (((0x007FF000 + m) >> shift) + 1) >> 1, 0)
+    saturate = np.where(e > 143, 0x7FFF, 0)
+    return (((b & 0x80000000) >> 16) | normal | denormal | saturate).astype(np.uint16)
+
+
+def half2float(h):
+    """Vectorized port of the firmware's half2float(): IEEE half bits (uint16) -> float32."""
+    h = np.asarray(h, dtype=np.uint16)
+    # The firmware only departs from IEEE at exponent 31 (it has no inf / NaN); elsewhere numpy's cast is exact
+    if not np.any(h & 0x7C00 == 0x7C00):
+        return h.view(np.float16).astype(np.float32)
+    x = h.astype(np.uint32)
+    e = (x & 0x7C00) >> 10
+    m = (x & 0x03FF) << 13
+    v = m.astype(np.float32).view(np.uint32) >> 23
+    denormal = (e == 0) & (m != 0)
+    shift = np.where(denormal, 150 - v, 0)
+    bits = ((x & 0x8000) << 16) \
+        | np.where(e != 0, ((e + 112) << 23) | m, 0) \
+        | np.where(denormal, ((v - 37) << 23) | ((m << shift) & 0x007FE000), 0)
+    return bits.astype(np.uint32).view(np.float32)
+
+
+def escape_zeros(payload):
+    """Replace every zero byte with ZERO_ESCAPE, the inverse of recuperer_zero()."""
+    return payload.replace(b'\x00', ZERO_ESCAPE)
+
+
+def unescape_zeros(payload):
+    """recuperer_zero(): a left-to-right scan, so the same as a non-overlapping replace."""
+    return payload.replace(ZERO_ESCAPE, b'\x00')
+
+
+def pack_values(values, dtype):
+    """Little-endian float32 or firmware-rounded float16 bytes."""
+    if dtype == "float16":
+        return float2half(values).astype('<u2').tobytes()
+    return np.asarray(values, dtype='<f4').tobytes()
+
+
+def unpack_values(payload, dtype):
+    if dtype == "float16":
+        return half2float(np.frombuffer(payload, dtype='<u2'))
+    return np.frombuffer(payload, dtype='<f4').astype(np.float32)
+
+
+def downlink_payloads(hidden, output, hyperparams=None, dtype="float16"):
+    """
+    The 16 escaped Local_Model POST payloads that load a global model.
+
+    Only the float32 firmware reads float32 values; every optimized variant reads
+    float16. Partition 14 carries just its 70 weights.
+    """
+    params = dict(DEFAULT_HYPERPARAMS, **(hyperparams or {}))
+    payloads = []
+    for partition in range(OUTPUT_PARTITION):
+        start, stop = partition_range(partition)
+        payloads.append(escape_zeros(pack_values(hidden[start:stop], dtype)))
+
+    last = np.zeros(PARTITION_SIZE - 1, dtype=np.float32)
+    last[:OUTPUT_SIZE] = output
+    last[HYPERPARAM_OFFSET:] = [params[name] for name in HYPERPARAMS]
+    payloads.append(escape_zeros(pack_values(last, dtype)))
+
+    for partition, payload in enumerate(payloads):
+        if len(payload) > MAX_DOWNLINK_PAYLOAD:
+            logging.warning("partition %d is %d bytes after zero escaping; the firmware reads only the first %d"
+                            % (partition, len(payload), MAX_DOWNLINK_PAYLOAD))
+    return payloads
+
+
+def read_downlink(partition, payload, hidden, output, dtype="float16"):
+    """
+    read_data() on the device side: store a POSTed partition into the flat arrays.
+
+    Returns the hyperparameters carried by partition 15, else None.
+    """
+    values = unpack_values(unescape_zeros(payload), dtype)
+    if partition == OUTPUT_PARTITION:
+        output[:OUTPUT_SIZE] = values[:OUTPUT_SIZE]
+        carried = values[HYPERPARAM_OFFSET:HYPERPARAM_OFFSET + len(HYPERPARAMS)]
+        return {name: float(v) for name, v in zip(HYPERPARAMS, carried)}
+    start, stop = partition_range(partition)
+    hidden[start:stop] = values[:stop - start]
+    return None
+
+
+def uplink_payload(partition, hidden, output, train_acc=0.0, eval_acc=0.0, dtype="float16"):
+    """The Local_Model GET response of the float16 / float32 firmware for one partition."""
+    start, stop = partition_range(partition)
+    if partition != OUTPUT_PARTITION:
+        return pack_values(hidden[start:stop], dtype)
+    values = np.zeros(PARTITION_SIZE, dtype=np.float32)
+    values[:OUTPUT_SIZE] = output[:OUTPUT_SIZE]
+    values[TRAIN_ACC_INDEX] = train_acc
+    values[EVAL_ACC_INDEX] = eval_acc
+    return pack_values(values, dtype)
+
+
+def read_uplink(partitions, dtype="float16"):
+    """Reassemble 16 uplink payloads into (hidden, output, train_acc, eval_acc)."""
+    values = [unpack_values(partitions[p], dtype) for p in range(NUM_PARTITIONS)]
+    hidden = np.concatenate(values[:OUTPUT_PARTITION])
+    if len(hidden) != HIDDEN_SIZE or len(values[OUTPUT_PARTITION]) <= EVAL_ACC_INDEX:
+        raise ValueError("incomplete model: %d hidden values, %d in the output partition"
+                         % (len(hidden), len(values[OUTPUT_PARTITION])))
+    last = values[OUTPUT_PARTITION]
+    return hidden, last[:OUTPUT_SIZE].copy(), float(last[TRAIN_ACC_INDEX]), float(last[EVAL_ACC_INDEX])
+
+
+def multicast_datagram(round_tag, partition, payload, dtype="float16"):
+    """A downlink partition for the multicast group; the payload is the escaped Local_Model POST body."""
+    header = MULTICAST_HEADER.pack(MULTICAST_MAGIC, round_tag & 0xFFFF, dtype == "float32", partition)
+    return header + bytes(payload)
+
+
+def data_checker(values):
+    """data_checker(): how many values are at or beyond +-WEIGHT_LIMIT (NaN and inf included)."""
+    values = np.asarray(values)
+    return int(np.count_nonzero(~(np.abs(values) < WEIGHT_LIMIT)))
+
+
+def read_multicast_datagram(datagram):
+    """(round_tag, dtype, partition, payload), or None for any other datagram."""
+    if len(datagram) < MULTICAST_HEADER.size or datagram[:2] != MULTICAST_MAGIC:
+        return None
+    _, round_tag, is_float32, partition = MULTICAST_HEADER.unpack_from(datagram)
+    return round_tag, "float32" if is_float32 else "float16", partition, datagram[MULTICAST_HEADER.size:]
+
+
+def missing_query(round_tag):
+    """heartbit POST asking which partitions of a multicast round were not received."""
+    return heartbit_code(MISSING) + struct.pack('<H', round_tag & 0xFFFF)
+
+
+def missing_bitmap(partitions):
+    """The reply to missing_query(): bit p set when partition p is missing."""
+    return struct.pack('<H', sum(1 << p for p in partitions))
+
+
+def train_request(topk):
+    """heartbit POST starting training on a delta_topk device, with the number of entries to upload."""
+    return heartbit_code(TRAIN) + struct.pack('<H', topk)
+
+
+def read_train_request(payload):
+    """The topk of a train_request(), or None for a bare heartbit 21."""
+    if len(payload) < 3:
+        return None
+    return struct.unpack_from('<H', payload, 1)[0]
+
+
+def read_missing(payload):
+    """Missing partitions from a missing_query() reply; all of them if the reply is not a bitmap."""
+    if len(payload) != 2:
+        return list(range(NUM_PARTITIONS))
+    (bits,) = struct.unpack('<H', payload)
+    return [p for p in range(NUM_PARTITIONS) if bits >> p & 1]
@@ -0,0 +1,383 @@
+'''
+A stand-in for FedCoRE client devices: an aiocoap server per simulated client that
+exposes the firmware's Local_Model, heartbit and actualinf resources on localhost.
+
+Each stand-in keeps the firmware state (flat weight arrays, the selected partition,
+the hyperparameters) and trains with a NumPy port of the firmware's per-sample
+sigmoid/MSE backpropagation, so the aggregation server can be exercised without
+Thread hardware:
+
+    python firmware_stub.py --clients 9 --port 5683 --rtt 0.02 --train_time 2
+
+The clients then answer on coap://[::1]:5683 ... coap://[::1]:5691. Requests to one
+stand-in are handled one at a time, like on the single-threaded device.
+
+With --multicast_port, a MulticastRelay stands in for the mesh's multicast
+forwarding: every datagram it receives on that UDP port is delivered to each
+device, except with probability --multicast_loss.
+
+--stragglers makes the last devices of the fleet train --straggler_factor times
+longer than --train_time, as battery-saving or busy devices do.
+'''
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+import aiocoap
+import aiocoap.resource as resource
+import numpy as np
+
+import firmware_codecs as fc
+import firmware_protocol as fp
+
+RECORDS_PER_CLASS = 60
+TRAIN_RECORDS = 55  # random_batch() draws from 0..54, Evaluate() uses 55..59
+
+
+def client_dataset(data_path, client_idx, seed=0):
+    """
+    The device's dataset[360][90] as (6, 60, 90): 60 records per activity.
+
+    With data_path (the .npz written by data/FL_clients_data/merge.py) the records of
+    client client_idx + 1 are used, drawn with replacement where an activity has fewer
+    than 60. Without it, class-dependent Gaussian records stand in.
+    """
+    rng = np.random.RandomState(seed + client_idx)
+    if data_path is None:
+        centers = np.random.RandomState(seed).normal(0.0, 1.0, (fp.OUTPUT_NODES, fp.INPUT_NODES))
+        x = centers[:, None, :] + rng.normal(0.0, 1.0, (fp.OUTPUT_NODES, RECORDS_PER_CLASS, fp.INPUT_NODES))
+        return x.astype(np.float32)
+
+    merged = np.load(data_path)
+    mine = merged["client"] == client_idx + 1
+    x, y = merged["x"][mine], merged["y"][mine]
+    per_class = []
+    for label in range(fp.OUTPUT_NODES):
+        rows = x[y == label]
+        if len(rows) == 0:
+            rows = x
+        take = rng.choice(len(rows), RECORDS_PER_CLASS, replace=len(rows) < RECORDS_PER_CLASS)
+        per_class.append(rows[take])
+    return np.stack(per_class).astype(np.float32)
+
+
+def sigmoid(x):
+    return np.float32(1.0) / (np.float32(1.0) + np.exp(-x))
+
+
+class FirmwareStub(object):
+    """The state and computation of one sleepy-mtd.c device."""
+
+    def __init__(self, dataset, codec="float16", rtt=0.0, train_time=0.0, loss=0.0, stall=30.0, seed=0):
+        self.dataset = dataset
+        self.targets = np.eye(fp.OUTPUT_NODES, dtype=np.float32)
+        self.codec = codec
+        self.rtt = rtt
+        self.train_time = train_time
+        self.loss = loss
+        self.stall = stall
+        self.random = random.Random(seed)
+        self.rng = np.random.RandomState(seed)
+
+        self.hidden, self.output = fp.init_weights(seed)
+        self.change_hidden = np.zeros(fp.HIDDEN_SIZE, dtype=np.float32)
+        self.change_output = np.zeros(fp.OUTPUT_SIZE, dtype=np.float32)
+        self.hyperparams = dict(fp.DEFAULT_HYPERPARAMS)
+        self.actual_partition = 0
+        self.train_acc = 0.0
+        self.accuracy = 50.77776
+        self.lock = asyncio.Lock()
+        self.global_model = fc.join_model(self.hidden, self.output)
+        self.uplink, self.stats = None, None
+        self.multicast_round = None
+        self.received = set()
+        # delta_topk: entries per upload, the delta left unsent so far, and what the current upload leaves
+        # unsent, which becomes the residual once the server has read all of its partitions
+        self.topk = fc.DEFAULT_TOPK
+        self.residual = np.zeros(fc.MODEL_SIZE, dtype=np.float32)
+        self.leftover = np.zeros(fc.MODEL_SIZE, dtype=np.float32)
+        self.fetched = set()
+
+    async def handle(self):
+        """The radio round trip; the device handles nothing else meanwhile."""
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+
+    async def reply(self, message):
+        """Now and then a reply is lost: it only arrives after the server has given up."""
+        if self.loss and self.random.random() < self.loss:
+            await asyncio.sleep(self.stall)
+        return message
+
+    def receive_multicast(self, datagram):
+        """A partition from the multicast group, stored like a Local_Model POST of the same round."""
+        parsed = fp.read_multicast_datagram(datagram)
+        if parsed is None:
+            return
+        round_tag, dtype, partition, payload = parsed
+        if dtype != fc.downlink_dtype(self.codec) or not 0 <= partition < fp.NUM_PARTITIONS:
+            return
+        if round_tag != self.multicast_round:
+            self.multicast_round = round_tag
+            self.received = set()
+        hyperparams = fp.read_downlink(partition, payload, self.hidden, self.output, dtype)
+        if hyperparams is not None:
+            self.hyperparams = hyperparams
+        self.received.add(partition)
+
+    def missing(self, round_tag):
+        if round_tag != self.multicast_round:
+            return list(range(fp.NUM_PARTITIONS))
+        return [p for p in range(fp.NUM_PARTITIONS) if p not in self.received]
+
+    def backward(self, x, target):
+        """One per-sample momentum SGD step, as backward() in the firmware; returns the MSE."""
+        lr = np.float32(self.hyperparams["lr"])
+        momentum = np.float32(self.hyperparams["momentum"])
+        w1 = self.hidden.reshape(fp.INPUT_NODES + 1, fp.HIDDEN_NODES)
+        w2 = self.output.reshape(fp.HIDDEN_NODES + 1, fp.OUTPUT_NODES)
+        hidden = sigmoid(w1[-1] + x @ w1[:-1])
+        out = sigmoid(w2[-1] + hidden @ w2[:-1])
+        output_delta = (target - out) * out * (np.float32(1.0) - out)
+        hidden_delta = (w2[:-1] @ output_delta) * hidden * (np.float32(1.0) - hidden)
+
+        change1 = self.change_hidden.reshape(w1.shape)
+        change1[:-1] = lr * np.outer(x, hidden_delta) + momentum * change1[:-1]
+        change1[-1] = lr * hidden_delta + momentum * change1[-1]
+        w1 += change1
+        change2 = self.change_output.reshape(w2.shape)
+        change2[:-1] = lr * np.outer(hidden, output_delta) + momentum * change2[:-1]
+        change2[-1] = lr * output_delta + momentum * change2[-1]
+        w2 += change2
+        return float(np.mean((target - out) ** 2))
+
+    def forward(self, x, target):
+        w1 = self.hidden.reshape(fp.INPUT_NODES + 1, fp.HIDDEN_NODES)
+        w2 = self.output.reshape(fp.HIDDEN_NODES + 1, fp.OUTPUT_NODES)
+        out = sigmoid(w2[-1] + sigmoid(w1[-1] + x @ w1[:-1]) @ w2[:-1])
+        return float(np.mean((target - out) ** 2))
+
+    def train(self):
+        """
+        random_batch(), save_global_model(), SGD_iteration + 1 passes of train() and
+        Evaluate(), then the variant's encoding of the trained model.
+        """
+        self.global_model = fc.join_model(self.hidden, self.output)
+        batch = self.rng.choice(TRAIN_RECORDS, int(self.hyperparams["batch_size"]), replace=False)
+        for _ in range(int(self.hyperparams["sgd_iteration"]) + 1):
+            correct = 0
+            for index in batch:
+                for label in range(fp.OUTPUT_NODES):
+                    error = self.backward(self.dataset[label, index], self.targets[label])
+                    correct += error < self.hyperparams["threshold_training"]
+            self.train_acc = correct / float(len(batch) * fp.OUTPUT_NODES)
+        self.evaluate()
+        self.uplink, self.stats = fc.encode_uplink(self.codec, fc.join_model(self.hidden, self.output),
+                                                   self.global_model, self.train_acc, self.accuracy,
+                                                   self.topk, self.residual, self.leftover)
+        self.fetched = set()
+
+    def uplink_payload(self, partition):
+        if self.codec in fc.FLOAT_CODECS:
+            # The float variants encode on request, with the current accuracies
+            return fp.uplink_payload(partition, self.hidden, self.output, self.train_acc, self.accuracy, self.codec)
+        if self.uplink is None or not 0 <= partition < fp.NUM_PARTITIONS:
+            return b""
+        return self.uplink[partition]
+
+    def uplink_read(self, partition):
+        """A Local_Model GET of the upload; once all of its partitions have been read, its leftover is the residual."""
+        if self.uplink is None or not 0 <= partition < fp.NUM_PARTITIONS:
+            return
+        self.fetched.add(partition)
+        if len(self.fetched) == fp.NUM_PARTITIONS:
+            self.residual[:] = self.leftover
+
+    def evaluate(self):
+        correct = 0
+        for index in range(TRAIN_RECORDS, RECORDS_PER_CLASS):
+            for label in range(fp.OUTPUT_NODES):
+                correct += self.forward(self.dataset[label, index], self.targets[label]) \
+                    < self.hyperparams["threshold_evaluate"]
+        self.accuracy = correct / float((RECORDS_PER_CLASS - TRAIN_RECORDS) * fp.OUTPUT_NODES)
+
+
+class LocalModel(resource.Resource):
+    def __init__(self, device):
+        super().__init__()
+        self.device = device
+
+    async def render_get(self, request):
+        async with self.device.lock:
+            await self.device.handle()
+            d = self.device
+            payload = d.uplink_payload(d.actual_partition)
+            d.uplink_read(d.actual_partition)
+        return await self.device.reply(aiocoap.Message(code=aiocoap.CONTENT, payload=payload))
+
+    async def render_post(self, request):
+        async with self.device.lock:
+            await self.device.handle()
+            d = self.device
+            if 0 <= d.actual_partition < fp.NUM_PARTITIONS:
+                hyperparams = fp.read_downlink(d.actual_partition, request.payload, d.hidden, d.output,
+                                                 fc.downlink_dtype(d.codec))
+                if hyperparams is not None:
+                    d.hyperparams = hyperparams
+        # The device sends no response to a model POST; acknowledge it so the server can pace itself
+        return await self.device.reply(aiocoap.Message(code=aiocoap.CHANGED))
+
+    async def render_put(self, request):
+        return await self.render_post(request)
+
+
+class Heartbit(resource.Resource):
+    def __init__(self, device):
+        super().__init__()
+        self.device = device
+
+    async def render_get(self, request):
+        async with self.device.lock:
+            await self.device.handle()
+        return await self.device.reply(aiocoap.Message(code=aiocoap.CONTENT, payload=b"modeldata1"))
+
+    async def render_post(self, request):
+        async with self.device.lock:
+            await self.device.handle()
+            d = self.device
+            d.actual_partition = request.payload[0] - fp.HEARTBIT_OFFSET if request.payload else 0
+            if d.actual_partition == fp.TRAIN:
+                topk = fp.read_train_request(request.payload)
+                if topk is not None:
+                    d.topk = topk
+                start = time.perf_counter()
+                d.train()
+                # The device trains for seconds; the NumPy port takes milliseconds
+                await asyncio.sleep(max(0.0, d.train_time - (time.perf_counter() - start)))
+            elif d.actual_partition == fp.EVALUATE:
+                d.evaluate()
+            if d.actual_partition == fp.STATS and d.stats is not None:
+                payload = d.stats  # [Accuracy, accuracy, min, max]
+            elif d.actual_partition == fp.MISSING and len(request.payload) >= 3:
+                payload = fp.missing_bitmap(d.missing(int.from_bytes(request.payload[1:3], "little")))
+            else:
+                payload = np.float32(d.accuracy).tobytes()
+        return await self.device.reply(aiocoap.Message(code=aiocoap.CHANGED, payload=payload))
+
+
+class ActualInf(resource.Resource):
+    def __init__(self, device):
+        super().__init__()
+        self.device = device
+
+    async def render_get(self, request):
+        async with self.device.lock:
+            await self.device.handle()
+            self.device.accuracy += 0.5
+            payload = np.float32(self.device.accuracy).tobytes()
+        return await self.device.reply(aiocoap.Message(code=aiocoap.CONTENT, payload=payload))
+
+    async def render_post(self, request):
+        return aiocoap.Message(code=aiocoap.CHANGED, payload=bytes(4))
+
+
+class MulticastRelay(asyncio.DatagramProtocol):
+    """
+    The mesh between the border router and the devices: delivers every datagram sent
+    to it to each device after half a round trip, and drops it for a device with
+    probability `loss`.
+    """
+
+    def __init__(self, devices, loss=0.0, seed=0):
+        self.devices = devices
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.transport = None
+        self.datagrams = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.datagrams += 1
+        loop = asyncio.get_running_loop()
+        for device in self.devices:
+            if not (self.loss and self.random.random() < self.loss):
+                loop.call_later(device.rtt / 2, device.receive_multicast, data)
+
+    async def shutdown(self):
+        self.transport.close()
+
+
+async def start_stubs(client_num, host="::1", port=5683, data_path=None, codec="float16",
+                      rtt=0.0, train_time=0.0, loss=0.0, seed=0, multicast_port=None, multicast_loss=0.0,
+                      stragglers=0, straggler_factor=4.0):
+    """
+    Serve client_num stand-ins on consecutive ports; returns (contexts, addresses, devices).
+    With multicast_port, a MulticastRelay listening on it is appended to the contexts.
+    The last `stragglers` devices train straggler_factor times longer.
+    """
+    contexts, addresses, devices = [], [], []
+    for client_idx in range(client_num):
+        slow = client_idx >= client_num - stragglers
+        device = FirmwareStub(client_dataset(data_path, client_idx, seed), codec, rtt,
+                              train_time * straggler_factor if slow else train_time, loss, seed=seed + client_idx)
+        site = resource.Site()
+        site.add_resource([fp.MODEL_URI], LocalModel(device))
+        site.add_resource([fp.HEARTBIT_URI], Heartbit(device))
+        site.add_resource([fp.ACTUALINF_URI], ActualInf(device))
+        contexts.append(await aiocoap.Context.create_server_context(site, bind=(host, port + client_idx)))
+        addresses.append("[%s]:%d" % (host, port + client_idx) if ":" in host else "%s:%d" % (host, port + client_idx))
+        devices.append(device)
+    if multicast_port is not None:
+        _, relay = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: MulticastRelay(devices, multicast_loss, seed), local_addr=(host, multicast_port))
+        contexts.append(relay)
+    return contexts, addresses, devices
+
+
+async def serve(args):
+    contexts, addresses, _ = await start_stubs(args.clients, args.host, args.port, args.data, args.codec,
+                                               args.rtt, args.train_time, args.loss, args.seed,
+                                               args.multicast_port, args.multicast_loss,
+                                               args.stragglers, args.straggler_factor)
+    logging.info("serving %d firmware stand-ins: %s" % (len(addresses), ", ".join(addresses)))
+    if args.multicast_port is not None:
+        logging.info("multicast relay on udp port %d" % args.multicast_port)
+    try:
+        await asyncio.get_running_loop().create_future()
+    finally:
+        for context in contexts:
+            await context.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=9, help='number of simulated devices')
+    parser.add_argument('--host', type=str, default='::1', help='address to bind')
+    parser.add_argument('--port', type=int, default=5683, help='port of the first device')
+    parser.add_argument('--data', type=str, default=None,
+                        help='all_activities_merged.npz from merge.py (default: synthetic records)')
+    parser.add_argument('--codec', type=str, default='float16', choices=fc.CODECS,
+                        help='model encoding of the emulated firmware variant')
+    parser.add_argument('--rtt', type=float, default=0.0, help='seconds of latency added to every request')
+    parser.add_argument('--train_time', type=float, default=0.0, help='seconds a training request takes')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability that a reply is never sent')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--multicast_port', type=int, default=None,
+                        help='UDP port of the relay standing in for multicast to the devices')
+    parser.add_argument('--multicast_loss', type=float, default=0.0,
+                        help='probability that a device misses a multicast datagram')
+    parser.add_argument('--stragglers', type=int, default=0, help='number of devices that train slower')
+    parser.add_argument('--straggler_factor', type=float, default=4.0,
+                        help='how many times longer than --train_time a straggler trains')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
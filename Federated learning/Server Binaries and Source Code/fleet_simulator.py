@@ -0,0 +1,393 @@
+'''
+Discrete-event simulation of a FedCoRE deployment with thousands of sleepy devices.
+
+The aggregation server's synchronous rounds (coap_server.py) are replayed on a
+virtual clock instead of a network. Every client runs the same sequence of CoAP
+exchanges as on the testbed: 16 heartbit selects and Local_Model POSTs, heartbit
+21 (train), heartbit 23 for the non-float codecs, and 16 selects and GETs. The
+transfers of all clients share --max_in_flight slots. Each exchange is costed
+rather than sent:
+
+- sleepy polling: a request waits at the parent until the device's next data poll
+  (every --poll_period seconds, at a random phase per device)
+- 802.15.4 at 250 kbit/s: the message is split into 6LoWPAN fragments of
+  --frame_payload bytes. Each frame pays CSMA backoff, airtime and an ACK on every
+  one of its --hops hops. The devices of one border router share its channel, which
+  sends one frame at a time.
+- frame loss: each transmission is lost with probability --frame_loss and retried
+  up to 3 times by the MAC. A message that loses a frame is resent by CoAP after
+  ACK_TIMEOUT, with the RFC 7252 backoff, at most 4 times. A client whose exchange
+  still fails is left out of the round.
+- compute: train() costs --backprop_ms per record and pass (batch_size records per
+  activity, sgd_iteration + 1 passes), and Evaluate() costs --forward_ms per record.
+  Each device is slower or faster by a log-normal factor (--speed_sigma).
+
+The server side runs for real. It decodes every uplink with firmware_codecs,
+averages the models and encodes the next downlink (DownlinkCache). The measured CPU
+time is charged to a single server thread on the virtual clock. The devices'
+training is not run; they send back the global model. --real_clients runs the NumPy
+firmware port (firmware_stub.FirmwareStub) for the first N devices:
+
+    python fleet_simulator.py --clients 10000 --border_routers 10 --max_in_flight 2000 --frame_loss 0.02
+'''
+
+import argparse
+import heapq
+import logging
+import math
+import random
+import resource
+import time
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+import coap_server
+import firmware_codecs as fc
+import firmware_protocol as fp
+from metrics import MetricsRecorder
+
+BYTE_SECONDS = 8 / 250e3  # O-QPSK in the 2.4 GHz band
+PHY_HEADER = 6  # preamble, SFD and PHR
+MAX_FRAME = 127
+ACK_SECONDS = 192e-6 + (PHY_HEADER + 5) * BYTE_SECONDS  # turnaround and immediate ACK
+CSMA_SECONDS = 3.5 * 320e-6 + 128e-6  # mean backoff at macMinBE 3, and CCA
+FRAME_SECONDS = CSMA_SECONDS + PHY_HEADER * BYTE_SECONDS + ACK_SECONDS  # per frame, besides its bytes
+MAC_RETRIES = 3  # macMaxFrameRetries
+POLL_BYTES = 18  # a data request MAC command frame
+# RFC 7252 confirmable messages
+ACK_TIMEOUT = 2.0
+ACK_RANDOM_FACTOR = 1.5
+MAX_RETRANSMIT = 4
+# IPHC and compressed UDP headers, CoAP header and token
+HEADER_BYTES = 10 + 4 + 4
+
+
+def coap_bytes(uri, payload_len):
+    """Size of a CoAP message with one Uri-Path option, after 6LoWPAN header compression."""
+    return HEADER_BYTES + (1 + len(uri) if uri else 0) + (1 + payload_len if payload_len else 0)
+
+
+def sleep(seconds):
+    return lambda sim, resume: sim.schedule(seconds, resume)
+
+
+class Simulator(object):
+    """
+    Virtual clock and event queue. Processes are generators that yield commands:
+    callables taking (sim, resume) that arrange for resume(value) to be called.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.queue = []
+        self.seq = 0
+        self.events = 0
+
+    def schedule(self, delay, fn, *args):
+        heapq.heappush(self.queue, (self.now + delay, self.seq, fn, args))
+        self.seq += 1
+
+    def process(self, gen, done=None):
+        self.schedule(0.0, self._resume, gen, done, None)
+
+    def _resume(self, gen, done, value):
+        try:
+            command = gen.send(value)
+        except StopIteration as e:
+            if done is not None:
+                done(e.value)
+            return
+        command(self, lambda v=None: self._resume(gen, done, v))
+
+    def run(self):
+        while self.queue:
+            self.now, _, fn, args = heapq.heappop(self.queue)
+            self.events += 1
+            fn(*args)
+
+
+class Channel(object):
+    """One frame at a time, first come first served: a border router's radio channel, or a server thread."""
+
+    def __init__(self):
+        self.free_at = 0.0
+        self.busy = 0.0
+
+    def occupy(self, seconds):
+        def command(sim, resume):
+            self.free_at = max(sim.now, self.free_at) + seconds
+            self.busy += seconds
+            sim.schedule(self.free_at - sim.now, resume)
+        return command
+
+
+class Slots(object):
+    """A counting semaphore: coap_server.py's --max_in_flight."""
+
+    def __init__(self, count):
+        self.count = count
+        self.waiters = deque()
+
+    def acquire(self):
+        def command(sim, resume):
+            if self.count > 0:
+                self.count -= 1
+                sim.schedule(0.0, resume)
+            else:
+                self.waiters.append(resume)
+        return command
+
+    def release(self, sim):
+        if self.waiters:
+            sim.schedule(0.0, self.waiters.popleft())
+        else:
+            self.count += 1
+
+
+class Device(object):
+    def __init__(self, idx, codec, channel, args, rng):
+        self.idx = idx
+        self.codec = codec
+        self.channel = channel
+        self.hops = args.hops
+        self.poll_phase = rng.uniform(0.0, args.poll_period)
+        self.speed = rng.lognormvariate(0.0, args.speed_sigma) if args.speed_sigma else 1.0
+        self.stub = None
+
+    def next_poll(self, now, period):
+        if period <= 0:
+            return now
+        return self.poll_phase + math.ceil((now - self.poll_phase) / period) * period
+
+
+class FleetSimulator(object):
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.sim = Simulator()
+        self.channels = [Channel() for _ in range(args.border_routers)]
+        self.slots = Slots(args.max_in_flight if args.max_in_flight > 0 else args.clients)
+        self.server_cpu = Channel()
+        self.devices = [Device(i, args.codecs[i % len(args.codecs)], self.channels[i % args.border_routers],
+                               args, self.random) for i in range(args.clients)]
+        self.hyperparams = dict(fp.DEFAULT_HYPERPARAMS, batch_size=args.batch_size, sgd_iteration=args.sgd_iteration)
+        self.metrics = MetricsRecorder(args.metrics_path or None)
+        # This round's client events only, summarized when the round ends
+        self.round_metrics = None
+
+        self.downlink = coap_server.DownlinkCache(self.hyperparams)
+        self.model = fc.join_model(*fp.init_weights(args.seed))
+        self.downlink.update(self.model)
+        for device in self.devices[:args.real_clients]:
+            import firmware_stub
+            device.stub = firmware_stub.FirmwareStub(firmware_stub.client_dataset(args.data, device.idx, args.seed),
+                                                     device.codec, seed=args.seed + device.idx)
+            device.stub.hyperparams.update(self.hyperparams)
+            device.stub.topk = args.topk
+
+    def compute_seconds(self, device):
+        backprops = (self.hyperparams["sgd_iteration"] + 1) * self.hyperparams["batch_size"] * fp.OUTPUT_NODES
+        evaluations = self.args.eval_records
+        return device.speed * (backprops * self.args.backprop_ms + evaluations * self.args.forward_ms) / 1000.0
+
+    def send_frames(self, device, message_bytes, stats):
+        """Put a message on the device's channel; returns whether every fragment got through."""
+        frames = max(1, -(-message_bytes // self.args.frame_payload))
+        # Full fragments, the last one holding the rest
+        frame_seconds = FRAME_SECONDS + (MAX_FRAME - self.args.frame_payload
+                                         + message_bytes / float(frames)) * BYTE_SECONDS
+        transmissions, delivered = 0, True
+        for _ in range(frames * device.hops):
+            tries = 1
+            while self.args.frame_loss and self.random.random() < self.args.frame_loss:
+                if tries > MAC_RETRIES:
+                    delivered = False
+                    break
+                tries += 1
+            transmissions += tries
+            if not delivered:
+                break
+        stats["frames"] += transmissions
+        stats["bytes"] += message_bytes
+        yield device.channel.occupy(transmissions * frame_seconds)
+        return delivered
+
+    def exchange(self, device, request_bytes, response_bytes, stats, handle_seconds=0.0):
+        """One confirmable request and its piggybacked response; False once CoAP gives up."""
+        timeout = ACK_TIMEOUT * self.random.uniform(1.0, ACK_RANDOM_FACTOR)
+        handled = False
+        for attempt in range(MAX_RETRANSMIT + 1):
+            start = self.sim.now
+            # The parent holds the request until the device polls for it
+            yield sleep(device.next_poll(self.sim.now, self.args.poll_period) - self.sim.now)
+            yield device.channel.occupy(FRAME_SECONDS + POLL_BYTES * BYTE_SECONDS)
+            if (yield from self.send_frames(device, request_bytes, stats)):
+                if not handled:
+                    # A retransmitted request hits CoAP deduplication, not the handler
+                    yield sleep(handle_seconds)
+                    handled = True
+                if (yield from self.send_frames(device, response_bytes, stats)):
+                    return True
+            stats["retransmissions"] += 1
+            remaining = start + timeout - self.sim.now
+            if remaining > 0:
+                yield sleep(remaining)
+            timeout *= 2
+        return False
+
+    def transfer(self, device, partition_request, partition_response, stats):
+        """Select a partition through heartbit, then POST or GET it, in one --max_in_flight slot."""
+        yield self.slots.acquire()
+        try:
+            return ((yield from self.exchange(device, coap_bytes(fp.HEARTBIT_URI, 1), coap_bytes(None, 4), stats))
+                    and (yield from self.exchange(device, partition_request, partition_response, stats)))
+        finally:
+            self.slots.release(self.sim)
+
+    def uplink(self, device, templates):
+        """What the device sends back: a real training run for --real_clients, else the global model."""
+        if device.stub is None:
+            return templates[device.codec]
+        stub = device.stub
+        hidden, output = fc.split_model(self.downlink.reference(device.codec))
+        stub.hidden, stub.output = hidden.copy(), output.copy()
+        stub.train()
+        if device.codec in fc.FLOAT_CODECS:
+            return [stub.uplink_payload(p) for p in range(fp.NUM_PARTITIONS)], None
+        return stub.uplink, stub.stats
+
+    def client_round(self, device, templates, results):
+        start = self.sim.now
+        stats = {"frames": 0, "bytes": 0, "retransmissions": 0}
+        payloads = self.downlink.payloads(device.codec)
+        reference = self.downlink.reference(device.codec)
+        heartbit = coap_bytes(fp.HEARTBIT_URI, 1)
+        ok = True
+        for payload in payloads:
+            ok = ok and (yield from self.transfer(device, coap_bytes(fp.MODEL_URI, len(payload)), coap_bytes(None, 4),
+                                                  stats))
+        train = coap_bytes(fp.HEARTBIT_URI, len(fp.train_request(0)) if device.codec == "delta_topk" else 1)
+        ok = ok and (yield from self.exchange(device, train, coap_bytes(None, 4), stats, self.compute_seconds(device)))
+        uplink, uplink_stats = self.uplink(device, templates) if ok else (None, None)
+        if ok and uplink_stats is not None:
+            ok = yield from self.exchange(device, heartbit, coap_bytes(None, len(uplink_stats)), stats)
+        for partition in range(fp.NUM_PARTITIONS):
+            ok = ok and (yield from self.transfer(device, coap_bytes(fp.MODEL_URI, 0),
+                                                  coap_bytes(None, len(uplink[partition])), stats))
+        if ok:
+            cpu = time.process_time()
+            results.append(fc.decode_uplink(device.codec, uplink, uplink_stats, reference))
+            yield self.server_cpu.occupy(time.process_time() - cpu)
+        event = dict(round=self.round_idx, client=device.idx, ok=ok, seconds=self.sim.now - start, **stats)
+        self.metrics.record("client", **event)
+        self.round_metrics.record("client", **event)
+
+    def templates(self):
+        """Per codec, the uplink of a device that returns the global model unchanged."""
+        templates = {}
+        for codec in set(d.codec for d in self.devices):
+            reference = self.downlink.reference(codec)
+            templates[codec] = fc.encode_uplink(codec, reference, reference, 0.0, 0.0, self.args.topk)
+        return templates
+
+    def run_round(self, round_idx):
+        self.round_idx = round_idx
+        self.round_metrics = MetricsRecorder(labels=["ok"])
+        wall, cpu_start = time.perf_counter(), self.server_cpu.busy
+        start, events = self.sim.now, self.sim.events
+        busy = [c.busy for c in self.channels]
+        results = []
+        templates = self.templates()
+        for device in self.devices:
+            self.sim.process(self.client_round(device, templates, results))
+        self.sim.run()
+
+        # The received models are held until the round's average, as coap_server.py does
+        held = sum(m[0].nbytes for m in results)
+        tracemalloc.start()
+        cpu = time.process_time()
+        if results:
+            self.model = np.mean([m[0] for m in results], axis=0).astype(np.float32)
+            self.downlink.update(self.model)
+            for codec in set(d.codec for d in self.devices):
+                self.downlink.payloads(codec)
+        aggregate_cpu = time.process_time() - cpu
+        aggregate_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        # The next round starts once the server thread is done with this one
+        self.sim.now = max(self.sim.now, self.server_cpu.free_at) + aggregate_cpu
+        self.server_cpu.free_at = self.sim.now
+        self.server_cpu.busy += aggregate_cpu
+
+        seconds = self.sim.now - start
+        utilization = max((c.busy - b) / seconds for c, b in zip(self.channels, busy)) if seconds else 0.0
+        return self.metrics.record("round", round=round_idx, clients=len(results), seconds=seconds,
+                                   channel_utilization=utilization, server_cpu=self.server_cpu.busy - cpu_start,
+                                   aggregate_cpu=aggregate_cpu, server_mb=(held + aggregate_peak) / 1e6,
+                                   events=self.sim.events - events, wall_seconds=time.perf_counter() - wall)
+
+    def run(self):
+        logging.info("%d clients on %d border routers, %d hops, poll %.1fs, frame loss %.3f, %d slots"
+                     % (len(self.devices), len(self.channels), self.args.hops, self.args.poll_period,
+                        self.args.frame_loss, self.slots.count))
+        print("%5s %8s %10s %10s %10s %10s %10s %8s %8s %10s %9s %8s" % (
+            "round", "clients", "round s", "client p50", "client p99", "client max", "retrans", "channel",
+            "cpu ms", "server MB", "events", "wall s"))
+        rounds = []
+        try:
+            for round_idx in range(self.args.rounds):
+                r = self.run_round(round_idx)
+                clients = self.round_metrics.summary("client")
+                nan = {"p50": float("nan"), "p99": float("nan"), "max": float("nan"), "sum": 0}
+                latency = self.round_metrics.summary("client", ok=True).get(None, {}).get("seconds", nan)
+                print("%5d %8d %10.1f %10.1f %10.1f %10.1f %10d %7.1f%% %8.1f %10.1f %9d %8.1f" % (
+                    round_idx, r["clients"], r["seconds"], latency["p50"], latency["p99"], latency["max"],
+                    clients[None]["retransmissions"]["sum"], 100 * r["channel_utilization"], 1000 * r["server_cpu"],
+                    r["server_mb"], r["events"], r["wall_seconds"]))
+                rounds.append(r)
+        finally:
+            self.metrics.close()
+        print("peak RSS of the simulator: %.0f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+        return rounds
+
+
+def add_args(parser):
+    parser.add_argument('--clients', type=int, default=1000, help='simulated devices')
+    parser.add_argument('--rounds', type=int, default=3, help='FedAvg rounds')
+    parser.add_argument('--codecs', type=str, nargs='+', default=['float16'], choices=fc.CODECS,
+                        help='firmware variants, assigned to the devices in turn')
+    parser.add_argument('--border_routers', type=int, default=1,
+                        help='border routers (one 802.15.4 channel each); devices are spread evenly')
+    parser.add_argument('--hops', type=int, default=1, help='mesh hops between a device and its border router')
+    parser.add_argument('--poll_period', type=float, default=fp.SLEEPY_POLL_PERIOD_MS / 1000.0,
+                        help='seconds between two data polls of a sleepy device (0 = always listening)')
+    parser.add_argument('--frame_payload', type=int, default=96,
+                        help='bytes of an IPv6 packet carried per 802.15.4 frame, after MAC and fragment headers')
+    parser.add_argument('--frame_loss', type=float, default=0.0, help='probability that a frame transmission is lost')
+    parser.add_argument('--max_in_flight', type=int, default=8,
+                        help='partition transfers on the network at once, as in coap_server.py (0 = unlimited)')
+    parser.add_argument('--backprop_ms', type=float, default=4.0, help='device milliseconds per training record')
+    parser.add_argument('--forward_ms', type=float, default=1.0, help='device milliseconds per evaluated record')
+    parser.add_argument('--eval_records', type=int, default=30, help='records Evaluate() scores')
+    parser.add_argument('--speed_sigma', type=float, default=0.2,
+                        help='sigma of the log-normal device speed factor (0 = identical devices)')
+    parser.add_argument('--batch_size', type=int, default=fp.DEFAULT_HYPERPARAMS["batch_size"],
+                        help='device records per activity and round')
+    parser.add_argument('--sgd_iteration', type=int, default=fp.DEFAULT_HYPERPARAMS["sgd_iteration"],
+                        help='device passes over its batch')
+    parser.add_argument('--topk', type=int, default=fc.DEFAULT_TOPK, help='entries a delta_topk device uploads')
+    parser.add_argument('--real_clients', type=int, default=0,
+                        help='devices that really train, with the NumPy firmware port')
+    parser.add_argument('--data', type=str, default=None, help='merge.py .npz for the --real_clients')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--metrics_path', type=str, default='',
+                        help='JSONL (or .csv) file receiving every client and round event')
+    return parser
+
+
+if __name__ == "__main__":
+    args = add_args(argparse.ArgumentParser()).parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    FleetSimulator(args).run()
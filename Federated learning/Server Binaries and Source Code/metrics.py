@@ -0,0 +1,219 @@
+'''
+Run metrics: timed events written to a JSONL or CSV file and summarized in process.
+
+Every event is one flat record: its name, the seconds since the recorder was
+created and its fields. Records are buffered and appended to the file every
+`flush_every` events, then dropped, so memory does not grow with the run.
+summary() groups the events of one kind by some of their `labels` fields and
+reduces the numeric ones. It reads running aggregates that record() updates, so
+neither the events nor a rescan of them is needed:
+
+    metrics = MetricsRecorder("run_metrics.jsonl", labels=["resource"])
+    metrics.record("request", client="fd11:22::abcd", resource="heartbit", bytes_out=1, rtt=0.05)
+    metrics.summary("request", by=["resource"])["heartbit"]["rtt"]["p99"]
+
+Count, sum, mean, min and max are exact; p50 and p99 come from a log-bucketed
+histogram and are within 1% of the exact percentile.
+
+The training code in "Centralized learning/" imports this module from here.
+'''
+
+import csv
+import json
+import math
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Histogram buckets grow by GAMMA, so a bucket's midpoint is within 1% of its values
+GAMMA = 1.02
+LOG_GAMMA = math.log(GAMMA)
+
+
+class FieldStats(object):
+    """Count, sum, min, max and a log-bucketed histogram of one numeric field."""
+
+    __slots__ = ("count", "sum", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = defaultdict(int)
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        # Bucket (1, i) holds the values in (GAMMA^(i-1), GAMMA^i], (-1, i) their negatives, (0, 0) zero
+        if value == 0:
+            self.buckets[0, 0] += 1
+        else:
+            self.buckets[1 if value > 0 else -1, math.ceil(math.log(abs(value)) / LOG_GAMMA)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for key, n in other.buckets.items():
+            self.buckets[key] += n
+
+    def percentile(self, q, values):
+        """Interpolated between the two nearest ranks, as np.percentile does."""
+        rank = q / 100.0 * (self.count - 1)
+        low = int(rank)
+        below = above = None
+        seen = 0
+        for value, n in values:
+            seen += n
+            if below is None and seen > low:
+                below = value
+            if seen > low + 1:
+                above = value
+                break
+        above = below if above is None else above
+        value = below + (rank - low) * (above - below)
+        return float(min(max(value, self.min), self.max))
+
+    def reduce(self):
+        values = []
+        for (sign, index), n in self.buckets.items():
+            # The bucket midpoint 2 * GAMMA^i / (GAMMA + 1)
+            values.append((sign * 2.0 * GAMMA ** index / (GAMMA + 1.0), n))
+        values.sort()
+        return {"sum": self.sum, "mean": self.sum / self.count, "min": float(self.min), "max": float(self.max),
+                "p50": self.percentile(50, values), "p99": self.percentile(99, values)}
+
+
+class MetricsRecorder(object):
+    """
+    Buffered event log. path=None writes nothing; a path ending in .csv writes one
+    table holding every field of every event kind (`columns` first, then new fields
+    as they appear), any other path writes one JSON object per line.
+
+    `labels` are the fields summary() can group by and match on. The events of the
+    kinds in `keep` are also kept in memory for select().
+    """
+
+    def __init__(self, path=None, columns=None, flush_every=256, labels=(), keep=()):
+        self.path = path
+        self.columns = list(columns or [])
+        self.flush_every = flush_every
+        self.labels = tuple(labels)
+        self.pending = []
+        self.written = False
+        self.kept = {event: [] for event in keep}
+        # {event: {label values: {field: FieldStats}}}, with the event count under None
+        self.aggregates = defaultdict(dict)
+        self.start = time.perf_counter()
+        if path:
+            open(path, 'w').close()
+
+    def record(self, event, **fields):
+        fields["event"] = event
+        fields["time"] = round(time.perf_counter() - self.start, 6)
+        key = tuple(fields.get(k) for k in self.labels)
+        stats = self.aggregates[event].get(key)
+        if stats is None:
+            stats = self.aggregates[event][key] = {None: 0}
+        stats[None] += 1
+        for k, v in fields.items():
+            # bool is an int, but a flag rather than a measurement; nan/inf are left out
+            if isinstance(v, (int, float)) and not isinstance(v, bool) and k not in self.labels and k != "time" \
+                    and math.isfinite(v):
+                field = stats.get(k)
+                if field is None:
+                    field = stats[k] = FieldStats()
+                field.add(v)
+        if event in self.kept:
+            self.kept[event].append(fields)
+        if self.path:
+            self.pending.append(fields)
+            if len(self.pending) >= self.flush_every:
+                self.flush()
+        return fields
+
+    @contextmanager
+    def timer(self, event, **fields):
+        """Record `event` with the seconds spent in the with block."""
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(event, seconds=time.perf_counter() - start, **fields)
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if not self.path or not pending:
+            return
+        if not self.path.endswith(".csv"):
+            with open(self.path, 'a') as f:
+                f.writelines(json.dumps(e, default=float) + "\n" for e in pending)
+            return
+        known = set(self.columns)
+        new = [k for k in dict.fromkeys(k for e in pending for k in e) if k not in known]
+        if not self.written:
+            self.columns = list(dict.fromkeys(["event", "time"] + self.columns + new))
+        elif new:
+            self.widen(new)
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, self.columns)
+            if not self.written:
+                writer.writeheader()
+                self.written = True
+            writer.writerows(pending)
+
+    def widen(self, new):
+        """Rewrite the CSV file with `new` columns appended, streaming its rows through a temporary file."""
+        columns = self.columns + new
+        tmp = self.path + ".tmp"
+        with open(self.path, newline='') as src, open(tmp, 'w', newline='') as dst:
+            writer = csv.DictWriter(dst, columns)
+            writer.writeheader()
+            writer.writerows(csv.DictReader(src))
+        os.replace(tmp, self.path)
+        self.columns = columns
+
+    def close(self):
+        self.flush()
+
+    def select(self, event, **match):
+        """The recorded events of one kind in `keep` whose fields equal `match`."""
+        if event not in self.kept:
+            raise ValueError("%s events are not kept; pass keep=[%r]" % (event, event))
+        return [e for e in self.kept[event] if all(e.get(k) == v for k, v in match.items())]
+
+    def summary(self, event, by=(), **match):
+        """
+        {group: {"count": n, field: {"sum", "mean", "min", "max", "p50", "p99"}}} over
+        the numeric fields of the selected events. The group is the value of the single
+        `by` field, a tuple of values for several, and None without grouping. `by` and
+        `match` are label fields.
+        """
+        unknown = [k for k in list(by) + list(match) if k not in self.labels]
+        if unknown:
+            raise ValueError("summary() groups and matches on labels %s, not %s" % (self.labels, unknown))
+        groups = {}
+        for key, stats in self.aggregates.get(event, {}).items():
+            values = dict(zip(self.labels, key))
+            if any(values[k] != v for k, v in match.items()):
+                continue
+            group = tuple(values[k] for k in by)
+            group = group[0] if len(by) == 1 else (group or None)
+            merged = groups.setdefault(group, {None: 0})
+            merged[None] += stats[None]
+            for k, field in stats.items():
+                if k is not None:
+                    merged.setdefault(k, FieldStats()).merge(field)
+
+        summary = {}
+        for group, stats in groups.items():
+            summary[group] = {"count": stats.pop(None)}
+            for k, field in stats.items():
+                if k not in by:
+                    summary[group][k] = field.reduce()
+        return summary
@@ -0,0 +1,71 @@
+'''
+A device whose upload does not decode is dropped from the round instead of stopping the server.
+
+Runs coap_server.py against firmware_stub.py stand-ins on localhost, one of which
+truncates its uploads:
+
+    python -m pytest test_coap_server.py
+'''
+
+import argparse
+import asyncio
+
+import pytest
+
+import coap_server
+import firmware_protocol as fp
+import firmware_stub
+
+PORT = 5783
+
+
+def server_args(addresses, codec, *argv):
+    return coap_server.add_args(argparse.ArgumentParser()).parse_args(
+        ["--clients", ",".join(addresses), "--codec", codec, "--comm_round", "2", "--timeout", "1",
+         "--retries", "0"] + list(argv))
+
+
+async def rounds_with_broken_device(codec, broken, argv, port):
+    contexts, addresses, devices = await firmware_stub.start_stubs(3, port=port, codec=codec)
+    broken(devices[0])
+    try:
+        server = coap_server.AggregationServer(addresses, server_args(addresses, codec, *argv))
+        return await asyncio.wait_for(server.train(), 60)
+    finally:
+        for context in contexts:
+            await context.shutdown()
+
+
+def truncate_partition(device):
+    """The last Local_Model GET payload loses its last byte."""
+    uplink_payload = device.uplink_payload
+
+    def truncated(partition):
+        payload = uplink_payload(partition)
+        return payload[:-1] if partition == fp.NUM_PARTITIONS - 1 else payload
+    device.uplink_payload = truncated
+
+
+def truncate_stats(device):
+    """The heartbit 23 reply is cut to 6 of its 16 bytes."""
+    train = device.train
+
+    def short_stats():
+        train()
+        device.stats = device.stats[:6]
+    device.train = short_stats
+
+
+@pytest.mark.parametrize("codec, broken", [("float16", truncate_partition), ("int8", truncate_partition),
+                                           ("delta_topk", truncate_partition), ("int8", truncate_stats),
+                                           ("delta_topk", truncate_stats)])
+@pytest.mark.parametrize("argv", [[], ["--streaming"], ["--streaming", "--stream_batch", "1"]])
+def test_sync_round_drops_undecodable_upload(codec, broken, argv):
+    rounds = asyncio.run(rounds_with_broken_device(codec, broken, argv, PORT))
+    assert [r["clients"] for r in rounds] == [2, 2]
+
+
+def test_async_loop_survives_undecodable_upload():
+    rounds = asyncio.run(rounds_with_broken_device("float16", truncate_partition, ["--aggregation", "async"],
+                                                   PORT + 10))
+    assert len(rounds) == 2 and all(r["clients"] == 1 for r in rounds)
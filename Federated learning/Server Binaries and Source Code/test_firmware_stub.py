@@ -0,0 +1,57 @@
+'''
+delta_topk stand-ins: error feedback only moves on once the upload has been read, and
+a heartbit 21 asking for 0 entries uploads none.
+
+    python -m pytest test_firmware_stub.py
+'''
+
+import asyncio
+
+import aiocoap
+import numpy as np
+
+import firmware_codecs as fc
+import firmware_protocol as fp
+import firmware_stub
+
+PORT = 5803
+
+
+def test_residual_moves_on_once_every_partition_is_read():
+    device = firmware_stub.FirmwareStub(firmware_stub.client_dataset(None, 0), "delta_topk")
+    device.topk = 10
+    device.train()
+    # A heartbit 21 sent again, or a server that gives up on the device, reads nothing
+    device.train()
+    for partition in range(fp.NUM_PARTITIONS - 1):
+        device.uplink_read(partition)
+    assert not device.residual.any()
+    device.uplink_read(fp.OUTPUT_PARTITION)
+    assert device.residual.any() and np.array_equal(device.residual, device.leftover)
+
+    # The next upload carries the entries the first one left unsent
+    residual = device.residual.copy()
+    device.train()
+    delta = device.global_model - fc.join_model(device.hidden, device.output) + residual
+    indices, _ = fc.decode_sparse(device.uplink)
+    assert np.array_equal(indices, fc.top_k(delta, 10))
+
+
+async def train_with_topk(topk):
+    contexts, addresses, devices = await firmware_stub.start_stubs(1, port=PORT, codec="delta_topk")
+    client = await aiocoap.Context.create_client_context()
+    try:
+        request = aiocoap.Message(code=aiocoap.POST, uri="coap://%s/%s" % (addresses[0], fp.HEARTBIT_URI),
+                                  payload=fp.train_request(topk))
+        await client.request(request).response
+        return devices[0]
+    finally:
+        await client.shutdown()
+        for context in contexts:
+            await context.shutdown()
+
+
+def test_train_request_for_zero_entries():
+    device = asyncio.run(train_with_topk(0))
+    assert device.topk == 0
+    assert all(payload == b"" for payload in device.uplink)
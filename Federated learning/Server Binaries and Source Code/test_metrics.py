@@ -0,0 +1,63 @@
+'''
+MetricsRecorder: bounded memory, summary() from running aggregates, CSV with every field.
+
+    python -m pytest test_metrics.py
+'''
+
+import csv
+
+import numpy as np
+import pytest
+
+from metrics import MetricsRecorder
+
+
+def test_summary_matches_the_events():
+    rng = np.random.RandomState(0)
+    rtt = rng.lognormal(-3.0, 1.0, 4000)
+    metrics = MetricsRecorder(labels=["resource", "ok"])
+    for i, value in enumerate(rtt):
+        metrics.record("request", resource="heartbit" if i % 2 else "Local_Model", ok=i % 3 > 0, rtt=float(value),
+                       bytes_out=i % 5)
+    summary = metrics.summary("request", by=["resource"], ok=True)
+    selected = [(i % 2 == 1, v, i % 5) for i, v in enumerate(rtt) if i % 3 > 0]
+    for resource, odd in (("heartbit", True), ("Local_Model", False)):
+        values = np.array([v for o, v, _ in selected if o == odd])
+        s = summary[resource]
+        assert s["count"] == len(values)
+        assert s["rtt"]["mean"] == pytest.approx(values.mean())
+        assert s["rtt"]["min"] == values.min() and s["rtt"]["max"] == values.max()
+        for q in (50, 99):
+            assert s["rtt"]["p%d" % q] == pytest.approx(np.percentile(values, q), rel=0.02)
+        assert s["bytes_out"]["sum"] == sum(b for o, _, b in selected if o == odd)
+    with pytest.raises(ValueError):
+        metrics.summary("request", by=["client"])
+
+
+def test_flushed_events_are_dropped(tmp_path):
+    metrics = MetricsRecorder(str(tmp_path / "run.jsonl"), flush_every=100, labels=["client"], keep=["round"])
+    for i in range(10000):
+        metrics.record("request", client="c%d" % (i % 4), rtt=0.01)
+    metrics.record("round", clients=4)
+    assert len(metrics.pending) <= 100
+    assert metrics.summary("request")[None]["count"] == 10000
+    assert [e["clients"] for e in metrics.select("round")] == [4]
+    with pytest.raises(ValueError):
+        metrics.select("request")
+    metrics.close()
+    with open(str(tmp_path / "run.jsonl")) as f:
+        assert sum(1 for _ in f) == 10001
+
+
+def test_csv_keeps_the_fields_of_every_event_kind(tmp_path):
+    path = str(tmp_path / "run.csv")
+    metrics = MetricsRecorder(path, columns=["event", "time", "client"], flush_every=2)
+    for _ in range(3):
+        metrics.record("request", client="fd11::1", rtt=0.05)
+    metrics.record("round", round=0, clients=1, seconds=1.5)
+    metrics.close()
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [r["event"] for r in rows] == ["request"] * 3 + ["round"]
+    assert rows[0]["rtt"] == "0.05" and rows[0]["clients"] == ""
+    assert rows[3]["clients"] == "1" and rows[3]["seconds"] == "1.5"